@@ -1,8 +1,3 @@
 from django.db import models
 
 # Create your models here.
-
-class AlignmentConsensus(models.Model):
-    slug = models.SlugField(max_length=100, unique=True)
-    alignment = models.BinaryField()
-    gn_consensus = models.BinaryField(blank=True) # Store conservation calculation for each GN
\ No newline at end of file
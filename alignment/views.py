@@ -2,16 +2,11 @@
 from django.conf import settings
 from django.views.generic import TemplateView
 from django.db.models import Case, When
-from django.core.cache import cache
-from django.core.cache import caches
-try:
-    cache_alignment = caches['alignments']
-except:
-    cache_alignment = cache
 
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
 from common.views import AbsMiscSelection
+from common.export import export_response
 from structure.functions import BlastSearch
 
 # from common.alignment_SITE_NAME import Alignment
@@ -20,7 +15,6 @@ from protein.models import Protein, ProteinSegment,ProteinFamily, ProteinSet
 from residue.models import ResiduePositionSet
 
 import inspect, os
-import hashlib
 from collections import OrderedDict
 
 from common import definitions
@@ -231,49 +225,32 @@ def render_alignment(request):
 
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
+    a.use_cache = True
 
     # load data from selection into the alignment
     a.load_proteins_from_selection(simple_selection)
     a.load_segments_from_selection(simple_selection)
 
-    #create unique proteins_id
-    protein_ids = []
-    for p in a.proteins:
-        protein_ids.append(p.pk)
-    protein_list = ','.join(str(x) for x in sorted(protein_ids))
-
-    #create unique proteins_id
-    segments_ids = []
-    for s in a.segments:
-        segments_ids.append(s)
-    segments_list = ','.join(str(x) for x in sorted(segments_ids))
-
-    s = str(protein_list+"_"+segments_list)
-    key = "ALIGNMENT_"+hashlib.md5(s.encode('utf-8')).hexdigest()
-    return_html = cache_alignment.get(key)
-
-    if return_html==None or 'Custom' in segments_ids:
-        # build the alignment data matrix
-        check = a.build_alignment()
-        if check == 'Too large':
-            return render(request, 'alignment/error.html', {'proteins': len(a.proteins), 'residues':a.number_of_residues_total})
-        # calculate consensus sequence + amino acid and feature frequency
-        a.calculate_statistics()
-
-        num_of_sequences = len(a.proteins)
-        num_residue_columns = len(a.positions) + len(a.segments)
-
-        return_html = render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
-            'num_residue_columns': num_residue_columns})
-    if 'Custom' not in segments_ids:
-        #update it if used
-        cache_alignment.set(key,return_html, 60*60*24*7) #set alignment cache one week
-
-    return return_html
+    # build the alignment data matrix
+    check = a.build_alignment()
+    if check == 'Too large':
+        return render(request, 'alignment/error.html', {'proteins': len(a.proteins), 'residues':a.number_of_residues_total})
+
+    # calculate consensus sequence + amino acid and feature frequency
+    a.calculate_statistics()
+
+    num_of_sequences = len(a.proteins)
+    num_residue_columns = len(a.positions) + len(a.segments)
+
+    return render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
+        'num_residue_columns': num_residue_columns})
 
 def render_family_alignment(request, slug):
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
+    a.use_cache = True
 
     # fetch proteins and segments
     proteins = Protein.objects.filter(family__slug__startswith=slug, sequence_type__slug='wt')
@@ -297,49 +274,30 @@ def render_family_alignment(request, slug):
             # if many more proteins exluclude more segments
             segments = ProteinSegment.objects.filter(partial=False, proteinfamily='GPCR').exclude(slug__in=['N-term','C-term']).exclude(category='loop')
 
-    protein_ids = []
-    for p in proteins:
-        protein_ids.append(p.pk)
-    protein_list = ','.join(str(x) for x in sorted(protein_ids))
-
-    #create unique proteins_id
-    segments_ids = []
-    for s in segments:
-        segments_ids.append(s.slug)
-    segments_list = ','.join(str(x) for x in sorted(segments_ids))
-
-    s = str(protein_list+"_"+segments_list)
-    key = "ALIGNMENT_"+hashlib.md5(s.encode('utf-8')).hexdigest()
-    return_html = cache_alignment.get(key)
-
-    if return_html==None:
-        # load data into the alignment
-        a.load_proteins(proteins)
-        a.load_segments(segments)
+    # load data into the alignment
+    a.load_proteins(proteins)
+    a.load_segments(segments)
 
-        # build the alignment data matrix
-        a.build_alignment()
+    # build the alignment data matrix
+    a.build_alignment()
 
-        # calculate consensus sequence + amino acid and feature frequency
-        a.calculate_statistics()
+    # calculate consensus sequence + amino acid and feature frequency
+    a.calculate_statistics()
 
-        num_of_sequences = len(a.proteins)
-        num_residue_columns = len(a.positions) + len(a.segments)
+    num_of_sequences = len(a.proteins)
+    num_residue_columns = len(a.positions) + len(a.segments)
 
-        return_html = render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
+    return render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
         'num_residue_columns': num_residue_columns})
 
-    #update it if used
-    cache_alignment.set(key,return_html, 60*60*24*7) #set alignment cache one week
-
-    return return_html
-
 def render_fasta_alignment(request):
     # get the user selection from session
     simple_selection = request.session.get('selection', False)
 
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
+    a.use_cache = True
     a.show_padding = False
 
     # load data from selection into the alignment
@@ -356,6 +314,8 @@ def render_fasta_alignment(request):
 def render_fasta_family_alignment(request, slug):
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
+    a.use_cache = True
     a.show_padding = False
 
     # fetch proteins and segments
@@ -379,6 +339,8 @@ def render_csv_alignment(request):
 
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
+    a.use_cache = True
     a.show_padding = False
 
     # load data from selection into the alignment
@@ -391,6 +353,4 @@ def render_csv_alignment(request):
     # calculate consensus sequence + amino acid and feature frequency
     a.calculate_statistics()
 
-    response = render(request, 'alignment/alignment_csv.html', context={'a': a}, content_type='text/csv')
-    response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.csv"
-    return response
+    return export_response(settings.SITE_TITLE + "_alignment", None, a.csv_rows(), 'csv')
@@ -21,6 +21,7 @@ from api.renderers import PDBRenderer
 from common.alignment import Alignment
 from common.definitions import *
 from drugs.models import Drugs
+from ligand.fingerprints import search_ligands
 
 import json, os
 from io import StringIO
@@ -352,6 +353,8 @@ class FamilyAlignment(views.APIView):
                 ss = ProteinSegment.objects.filter(partial=False)
             # create an alignment object
             a = Alignment()
+            a.use_matrix = True
+            a.use_cache = True
             a.show_padding = False
 
             # load data from selection into the alignment
@@ -551,6 +554,8 @@ class ProteinAlignment(views.APIView):
 
             # create an alignment object
             a = Alignment()
+            a.use_matrix = True
+            a.use_cache = True
             a.show_padding = False
 
             # load data from selection into the alignment
@@ -787,3 +792,24 @@ class DrugList(views.APIView):
             druglist.append({'name':drugname, 'approval': approval, 'indication': indication, 'status':status, 'drugtype':drugtype, 'moa':moa, 'novelty': novelty})
 
         return Response(druglist)
+
+class LigandSearch(views.APIView):
+    """
+    Get the ligands most similar to a SMILES (Tanimoto similarity of Morgan fingerprints), or containing it as a
+    substructure, with the targets of their assay experiments
+    \n/ligands/search/{search_type}/?smiles={smiles}&top={top}
+    \n{search_type} is similarity or substructure
+    \n{smiles} is the SMILES of the query, e.g. c1ccccc1O
+    \n{top} is the maximum number of ligands (default 50, from 1 to 1000)
+    """
+    def get(self, request, search_type='similarity'):
+        smiles = request.GET.get('smiles', '').strip()
+        try:
+            top = max(1, min(int(request.GET.get('top', 50)), 1000))
+        except ValueError:
+            return Response({'error': 'top must be an integer'}, status=400)
+
+        results = search_ligands(smiles, search_type, top) if smiles else None
+        if results is None:
+            return Response({'error': 'Invalid SMILES, or the ligand fingerprint index is not available'}, status=400)
+        return Response(results)
@@ -0,0 +1,206 @@
+from django.db import connection
+
+from collections import deque, namedtuple
+from multiprocessing import Pipe, Process, Queue
+from multiprocessing.connection import wait
+import logging
+import pickle
+import time
+import traceback
+
+
+# outcome of one item: the return value of the function, the formatted exception if it failed, and the run time
+JobResult = namedtuple('JobResult', ['result', 'error', 'time'])
+
+
+def run_worker(worker_id, func, items, tasks, results):
+    """Worker process: run func for each batch of item indices received, until a None batch is received"""
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            break
+        for index in batch:
+            start = time.time()
+            try:
+                result = func(items[index])
+                error = None
+            except Exception:
+                result = None
+                error = traceback.format_exc()
+            # results are pickled here, so that unpicklable results are reported as errors
+            try:
+                result = pickle.dumps(result)
+            except Exception:
+                result = pickle.dumps(None)
+                error = traceback.format_exc()
+            results.send((worker_id, index, result, error, time.time() - start))
+    results.close()
+    connection.close()
+
+
+class JobQueue(object):
+    """Runs a function for each item of a list in a number of worker processes. Workers receive batches of items,
+    sized by the measured time per item, and a new batch as soon as they finish the previous one. The result, run time
+    and exception (if any) of each item are collected in the parent. Items of a worker that crashed are retried one
+    by one in a new worker"""
+
+    def __init__(self, func, processes=1, batch_time=10, max_batch_size=1000, retries=1, progress_interval=60,
+        name='items', logger=None):
+        self.func = func
+        self.processes = max(processes, 1)
+        # time a batch should take (in seconds)
+        self.batch_time = batch_time
+        self.max_batch_size = max_batch_size
+        # number of times an item is retried after crashing a worker
+        self.retries = retries
+        self.progress_interval = progress_interval
+        self.name = name
+        self.logger = logger or logging.getLogger('build')
+
+    def start_worker(self, worker_id):
+        # each worker opens its own database connection
+        connection.close()
+        tasks = Queue()
+        # each worker has its own result pipe, so that a worker that crashes while sending can not block the others
+        results, worker_results = Pipe(duplex=False)
+        process = Process(target=run_worker, args=(worker_id, self.func, self.items, tasks, worker_results))
+        process.start()
+        worker_results.close()
+        self.workers[worker_id] = {'process': process, 'tasks': tasks, 'results': results, 'in_flight': set()}
+
+    def next_batch(self):
+        """Indices of the next batch, crashed items are retried alone"""
+        if not self.pending:
+            return None
+        if self.attempts.get(self.pending[0]):
+            return [self.pending.popleft()]
+
+        if self.total_time and self.num_timed:
+            size = int(self.batch_time / (self.total_time / self.num_timed))
+        else:
+            size = 1
+        # leave work for the other workers at the end of the queue
+        size = max(1, min(size, self.max_batch_size, len(self.pending) // self.processes or 1))
+        batch = []
+        while self.pending and len(batch) < size and not self.attempts.get(self.pending[0]):
+            batch.append(self.pending.popleft())
+        return batch
+
+    def assign_batch(self, worker_id):
+        worker = self.workers[worker_id]
+        batch = self.next_batch()
+        if batch:
+            worker['in_flight'] = set(batch)
+            worker['tasks'].put(batch)
+        else:
+            worker['tasks'].put(None)
+
+    def collect(self, message):
+        worker_id, index, result, error, elapsed = message
+        # an item can be reported twice if it was retried after its worker crashed before its result arrived
+        if self.output[index] is None:
+            self.output[index] = JobResult(pickle.loads(result), error, elapsed)
+            self.done += 1
+            self.total_time += elapsed
+            self.num_timed += 1
+            if error:
+                self.failed += 1
+                self.logger.error('Error with {} {}: {}'.format(self.name, self.items[index], error))
+
+        worker = self.workers.get(worker_id)
+        if worker:
+            worker['in_flight'].discard(index)
+            if not worker['in_flight']:
+                self.assign_batch(worker_id)
+
+    def check_workers(self):
+        """Replace workers that crashed, and retry their unfinished items"""
+        for worker_id, worker in list(self.workers.items()):
+            if worker['process'].is_alive():
+                continue
+            worker['process'].join()
+            del self.workers[worker_id]
+            # collect the results that were sent before the worker stopped
+            for message in self.receive(worker):
+                self.collect(message)
+                worker['in_flight'].discard(message[1])
+            worker['results'].close()
+            if not worker['in_flight']:
+                continue
+
+            self.logger.error('Worker for {} crashed (exit code {})'.format(self.name, worker['process'].exitcode))
+            for index in sorted(worker['in_flight'], reverse=True):
+                self.attempts[index] = self.attempts.get(index, 0) + 1
+                if self.attempts[index] > self.retries:
+                    self.output[index] = JobResult(None, 'Worker crashed (exit code {})'.format(
+                        worker['process'].exitcode), None)
+                    self.done += 1
+                    self.failed += 1
+                    self.logger.error('Giving up on {} {}'.format(self.name, self.items[index]))
+                else:
+                    self.pending.appendleft(index)
+
+            if self.pending:
+                self.worker_count += 1
+                self.start_worker(self.worker_count)
+                self.assign_batch(self.worker_count)
+
+    def receive(self, worker):
+        """Results waiting in the pipe of a worker"""
+        messages = []
+        try:
+            while worker['results'].poll():
+                messages.append(worker['results'].recv())
+        except (EOFError, OSError, pickle.UnpicklingError):
+            # the pipe of a worker that crashed can be closed or end with an incomplete result
+            pass
+        return messages
+
+    def report_progress(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.progress_interval:
+            return
+        self.last_report = now
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed else 0
+        message = '{} of {} {} done ({:.1f}/s, {} failed, {} s elapsed)'.format(self.done, len(self.items), self.name,
+            rate, self.failed, int(elapsed))
+        self.logger.info(message)
+
+    def run(self, items):
+        """Run the function for all items, returns a JobResult for each item"""
+        self.items = items
+        self.output = [None] * len(items)
+        self.pending = deque(range(len(items)))
+        self.attempts = {}
+        self.done = 0
+        self.failed = 0
+        self.total_time = 0
+        self.num_timed = 0
+        self.start_time = self.last_report = time.time()
+        if not items:
+            return self.output
+
+        # workers are forked with the items, only indices and results are sent through the queues and pipes
+        self.workers = {}
+        self.worker_count = min(self.processes, len(items))
+        for worker_id in range(1, self.worker_count + 1):
+            self.start_worker(worker_id)
+            self.assign_batch(worker_id)
+
+        while self.done < len(items):
+            ready = wait([worker['results'] for worker in self.workers.values()], timeout=1)
+            for worker in list(self.workers.values()):
+                if worker['results'] in ready:
+                    for message in self.receive(worker):
+                        self.collect(message)
+            self.check_workers()
+            self.report_progress()
+
+        for worker_id, worker in self.workers.items():
+            worker['tasks'].put(None)
+        for worker in self.workers.values():
+            worker['process'].join()
+            worker['results'].close()
+        self.report_progress(force=True)
+        return self.output
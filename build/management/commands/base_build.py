@@ -3,6 +3,8 @@ from django.core.management import call_command
 from django.conf import settings
 from django.db import connection
 
+from build.job_queue import JobQueue
+
 import datetime
 import logging
 from multiprocessing import Queue, Process, Value, Lock
@@ -54,4 +56,9 @@ class Command(BaseCommand):
             p.start()
 
         for p in procs:
-            p.join()
\ No newline at end of file
+            p.join()
+
+    def run_jobs(self, proc, items, func, name='items'):
+        """Run func for each item in a job queue of proc worker processes (see build.job_queue.JobQueue). Returns a
+        JobResult (result, error, time) for each item"""
+        return JobQueue(func, proc, name=name, logger=self.logger).run(items)
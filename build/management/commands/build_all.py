@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.core.management import call_command
+
+from build.scheduler import BuildStage, BuildScheduler
 
 import datetime
 
@@ -24,50 +25,78 @@ class Command(BaseCommand):
                             dest='hommod',
                             default=False,
                             help='Include build of homology models')
+        parser.add_argument('--resume',
+                            action='store_true',
+                            dest='resume',
+                            default=False,
+                            help='Skip the stages that were completed by the last (failed or interrupted) build')
 
     def handle(self, *args, **options):
         if options['test']:
             print('Running in test mode')
 
-        commands = [
-            ['build_common'],
-            ['build_human_proteins'],
-            ['build_blast_database'],
-            ['build_other_proteins', {'constructs_only': options['test'] ,'proc': options['proc']}], # build only constructs in test mode
-            ['build_annotation', {'proc': options['proc']}],
-            ['build_blast_database'],
-            ['build_links'],
-            ['build_construct_proteins'],
-            ['build_structures', {'proc': options['proc']}],
-            ['build_construct_data'],
-            ['build_ligands_from_cache', {'proc': options['proc']}],
-            ['build_ligand_assays', {'proc': options['proc']}],
-            ['build_mutant_data', {'proc': options['proc']}],
-            # ['build_crystal_interactions', {'proc': options['proc']}],
-            ['update_construct_mutations'],
-            ['build_protein_sets'],
-            ['build_consensus_sequences', {'proc': options['proc']}],
-            ['build_g_proteins'],
-            ['build_arrestins'],
-            ['build_drugs'],
-            ['build_nhs'],
-            ['build_mutational_landscape'],
-            ['build_residue_sets'],
-            ['build_homology_models', ['--update', '-z'], {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_blast_database'],
-            ['build_text'],
-            ['build_release_notes'],
+        proc = {'proc': options['proc']}
+        stages = [
+            BuildStage('common', 'build_common', outputs=['common']),
+            BuildStage('human_proteins', 'build_human_proteins', ['common'], ['proteins']),
+            BuildStage('blast_database_human', 'build_blast_database', ['proteins'], ['blast_database']),
+            # build only constructs in test mode
+            BuildStage('other_proteins', 'build_other_proteins', ['common', 'proteins', 'blast_database'],
+                ['proteins'], kwargs={'constructs_only': options['test'], 'proc': options['proc']}),
+            BuildStage('annotation', 'build_annotation', ['common', 'proteins'], ['residues'], kwargs=proc),
+            BuildStage('blast_database', 'build_blast_database', ['proteins'], ['blast_database']),
+            BuildStage('links', 'build_links', ['common', 'proteins'], ['links']),
+            BuildStage('construct_proteins', 'build_construct_proteins', ['common', 'proteins'], ['proteins']),
+            BuildStage('structures', 'build_structures', ['common', 'proteins', 'residues', 'blast_database'],
+                ['structures'], kwargs=proc),
+            BuildStage('construct_data', 'build_construct_data', ['proteins', 'residues', 'structures'],
+                ['constructs']),
+            BuildStage('ligands', 'build_ligands_from_cache', ['common', 'proteins'], ['ligands'], kwargs=proc),
+            BuildStage('ligand_assays', 'build_ligand_assays', ['common', 'proteins', 'ligands'], ['ligands'],
+                kwargs=proc),
+            BuildStage('ligand_fingerprints', 'build_ligand_fingerprints', ['ligands'], ['ligand_fingerprints'],
+                kwargs=proc),
+            BuildStage('ligand_summaries', 'build_ligand_summaries', ['proteins', 'ligands'], ['ligand_summaries']),
+            BuildStage('mutant_data', 'build_mutant_data', ['common', 'proteins', 'residues', 'ligands'],
+                ['mutations'], kwargs=proc),
+            # BuildStage('crystal_interactions', 'build_crystal_interactions', ['residues', 'structures'],
+            #     ['interactions'], kwargs=proc),
+            BuildStage('construct_mutations', 'update_construct_mutations', ['residues', 'constructs'],
+                ['constructs']),
+            BuildStage('protein_sets', 'build_protein_sets', ['proteins', 'structures'], ['protein_sets']),
+            BuildStage('consensus_sequences', 'build_consensus_sequences', ['proteins', 'residues'],
+                ['consensus_sequences'], kwargs=proc),
+            BuildStage('similarity_matrix', 'build_similarity_matrix', ['proteins', 'residues'],
+                ['similarity_matrix'], kwargs=proc),
+            BuildStage('g_proteins', 'build_g_proteins', ['common', 'proteins'], ['g_proteins']),
+            BuildStage('arrestins', 'build_arrestins', ['common', 'proteins'], ['arrestins']),
+            BuildStage('drugs', 'build_drugs', ['common', 'proteins'], ['drugs']),
+            BuildStage('nhs', 'build_nhs', ['drugs'], ['nhs']),
+            BuildStage('mutational_landscape', 'build_mutational_landscape', ['common', 'proteins', 'residues'],
+                ['mutational_landscape']),
+            BuildStage('residue_sets', 'build_residue_sets', ['residues', 'structures'], ['residue_sets']),
+            BuildStage('functional_annotations', 'build_functional_annotations', ['proteins', 'residues', 'structures',
+                'interactions', 'mutational_landscape', 'residue_sets'], ['functional_annotations']),
+            BuildStage('homology_model_templates', 'build_homology_model_templates', ['proteins', 'residues',
+                'structures'], ['homology_model_templates'], kwargs=proc),
+            BuildStage('homology_models', 'build_homology_models', ['common', 'proteins', 'residues', 'structures',
+                'blast_database', 'homology_model_templates'], ['homology_models'], ['--update', '-z'], {'proc': options['proc'],
+                'test_run': options['test']}),
+            BuildStage('rmsd_matrix', 'build_rmsd_matrix', ['structures', 'homology_models'], ['rmsd_matrix'],
+                kwargs=proc),
+            BuildStage('blast_database_final', 'build_blast_database', ['proteins', 'g_proteins', 'arrestins'],
+                ['blast_database']),
+            BuildStage('text', 'build_text', ['common'], ['text']),
+            BuildStage('release_notes', 'build_release_notes', ['*'], ['release_notes']),
+            BuildStage('statistics_snapshots', 'build_statistics_snapshots', ['*'], ['statistics_snapshots']),
         ]
 
-        for c in commands:
-            print('{} Running {}'.format(
-                datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), c[0]))
-            if len(c) == 2:
-                call_command(c[0], **c[1])
-            elif len(c) == 3:
-                call_command(c[0], *c[1], **c[2])
-            else:
-                call_command(c[0])
+        # independent stages run at the same time, within the number of processes given by --proc
+        scheduler = BuildScheduler(stages, options['proc'], {'test': options['test']})
+        failed = scheduler.run(resume=options['resume'])
+        if failed:
+            raise CommandError('Build failed, stages not completed: {}. Fix the problem and run build_all again with '
+                '--resume to continue from the last completed stage.'.format(', '.join(failed)))
 
         print('{} Build completed'.format(datetime.datetime.strftime(
             datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')))
@@ -534,20 +534,8 @@ class Command(BaseBuild):
             aln_human = pw2[0][0]
             aln_ortholog = pw2[0][1]
         else:
-            # write sequences to files
-            seq_filename = "/tmp/" + ortholog.entry_name + ".fa"
-            with open(seq_filename, 'w') as seq_file:
-                seq_file.write("> ref\n")
-                seq_file.write(human_seq + "\n")
-                seq_file.write("> seq\n")
-                seq_file.write(ortholog.sequence + "\n")
-
-            try:
-                ali_filename = "/tmp/"+ortholog.entry_name +"_out.fa"
-                acmd = ClustalOmegaCommandline(infile=seq_filename, outfile=ali_filename, force=True)
-                stdout, stderr = acmd()
-                pw2 = AlignIO.read(ali_filename, "fasta")
-            except:
+            pw2 = clustal_align_pair(human_seq, ortholog.sequence)
+            if not pw2:
                 return False
 
             aln_human = pw2[0]
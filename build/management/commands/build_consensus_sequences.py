@@ -7,11 +7,11 @@ from build.management.commands.build_human_proteins import Command as BuildHuman
 from residue.functions import *
 from protein.models import Protein, ProteinConformation, ProteinFamily, ProteinSegment, ProteinSequenceType
 from common.alignment import Alignment
-from alignment.models import AlignmentConsensus
+from common.conservation import ConservationStore, conservation_generic_numbers, residue_codes
 
+import datetime
 import os
 import yaml
-import pickle
 
 class Command(BuildHumanProteins):
     help = 'Builds consensus sequences for human proteins in all families'
@@ -35,13 +35,26 @@ class Command(BuildHumanProteins):
             self.logger.info('CREATING CONSENSUS SEQUENCES')
             self.prepare_input(options['proc'], self.families)
             self.logger.info('COMPLETED CREATING CONSENSUS SEQUENCES')
+            self.build_conservation_store()
         except Exception as msg:
             print(msg)
             self.logger.error(msg)
 
     def purge_consensus_sequences(self):
         Protein.objects.filter(sequence_type__slug='consensus').delete()
-        AlignmentConsensus.objects.all().delete()
+
+    def build_conservation_store(self):
+        self.logger.info('BUILDING CONSERVATION STORE')
+        proteins = list(Protein.objects.filter(sequence_type__slug='wt').order_by('pk').values_list('pk',
+            'family__slug', 'source__name', 'species__common_name'))
+        protein_ids = [p[0] for p in proteins]
+        generic_numbers = conservation_generic_numbers()
+        residues = residue_codes(protein_ids, generic_numbers)
+        reference = [source == 'SWISSPROT' and species == 'Human' for pk, family, source, species in proteins]
+        ConservationStore().save(protein_ids, [p[1] for p in proteins], reference, generic_numbers, residues,
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        self.logger.info('COMPLETED BUILDING CONSERVATION STORE ({} proteins, {} positions)'.format(len(protein_ids),
+            len(generic_numbers)))
 
     def get_segment_residue_information(self, consensus_sequence):
         ref_positions = dict()
@@ -104,16 +117,6 @@ class Command(BuildHumanProteins):
             a.build_alignment()
             a.calculate_statistics()
 
-            try:
-                # Save alignment
-                AlignmentConsensus.objects.create(slug=family.slug, alignment=pickle.dumps(a))
-
-                # Load alignment to ensure it works
-                a = pickle.loads(AlignmentConsensus.objects.get(slug=family.slug).alignment)
-                self.logger.info('Succesfully pickled {}'.format(family))
-            except:
-                self.logger.error('Failed pickle for {}'.format(family))
-
             self.logger.info('Completed building alignment for {}'.format(family))
 
             # get (forced) consensus sequence from alignment object
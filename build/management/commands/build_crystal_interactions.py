@@ -4,14 +4,12 @@ from build.management.commands.base_build import Command as BaseBuild
 from django.db import transaction
 
 from contactnetwork.models import *
-from residue.models import Residue
-
-import contactnetwork.interaction as ci
 
 import logging
 import datetime
 
 from contactnetwork.cube import compute_interactions
+from contactnetwork.bulk import save_interactions
 
 from django.contrib.contenttypes.models import ContentType
 
@@ -26,13 +24,30 @@ class Command(BaseBuild):
             dest='proc',
             default=1,
             help='Number of processes to run')
+        parser.add_argument('-s', '--structure',
+            action='append',
+            dest='structure',
+            help='PDB code of structure to compute interactions for. Can be used multiple times')
 
     def handle(self, *args, **options):
-        self.delete_all()
-        self.structures = Structure.objects.all().exclude(refined=True)
-        self.prepare_input(options['proc'], self.structures)
+        structures = Structure.objects.all().exclude(refined=True).select_related(
+            'protein_conformation__protein').order_by('pk')
+        if options['structure']:
+            structures = structures.filter(pdb_code__index__in=[pdb.upper() for pdb in options['structure']])
+            self.delete_structures(structures)
+        else:
+            self.delete_all()
+
+        # structures are evaluated before the workers are forked, the PDB data is read by each worker
+        self.structures = list(structures)
+        self.run_jobs(options['proc'], self.structures, self.build_structure, 'structures')
         self.logger.info('Finished building crystal interaction data for all PDBs!')
 
+    def delete_structures(self, structures):
+        Interaction.objects.filter(interacting_pair__referenced_structure__in=structures).delete()
+        InteractingResiduePair.objects.filter(referenced_structure__in=structures).delete()
+        self.logger.info('Deleted crystal interactions data for {} PDBs...'.format(len(structures)))
+
     def delete_all(self):
         VanDerWaalsInteraction.objects.all().delete()
         HydrophobicInteraction.objects.all().delete()
@@ -44,95 +59,11 @@ class Command(BaseBuild):
         InteractingResiduePair.objects.all().delete()
         self.logger.info('Deleted crystal interactions data all PDBs...')
 
-    # @transaction.atomic
-    def main_func(self, positions, iteration,count,lock):
-        while count.value<len(self.structures):
-            with lock:
-                s = self.structures[count.value]
-                pdb_code = s.protein_conformation.protein.entry_name
-                count.value +=1 
-                self.logger.info('Generating crystal interactions data for PDB \'{}\'... ({} out of {})'.format(pdb_code, count.value, len(self.structures)))
-
-            try:
-                interacting_pairs = compute_interactions(pdb_code)
-            except:
-                self.logger.error('Error with computing interactions (%s)' % (pdb_code))
-                continue
-
-            for p in interacting_pairs:
-                # Create the pair
-                res1_seq_num = p.get_residue_1().id[1]
-                res2_seq_num = p.get_residue_2().id[1]
-                conformation = s.protein_conformation
-
-                # Get the residues
-                try:
-                    res1 = Residue.objects.get(sequence_number=res1_seq_num, protein_conformation=conformation)
-                    res2 = Residue.objects.get(sequence_number=res2_seq_num, protein_conformation=conformation)
-                except Residue.DoesNotExist:
-                    self.logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
-                    continue
-
-                # Save the pair
-                pair = InteractingResiduePair()
-                pair.res1 = res1
-                pair.res2 = res2
-                pair.referenced_structure = s
-                pair.save()
+    def build_structure(self, s):
+        pdb_code = s.protein_conformation.protein.entry_name
+        self.logger.info('Generating crystal interactions data for PDB \'{}\'...'.format(pdb_code))
 
-                # Add the interactions to the pair
-                for i in p.get_interactions():
-                    if type(i) is ci.VanDerWaalsInteraction:
-                        ni = VanDerWaalsInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.HydrophobicInteraction:
-                        ni = HydrophobicInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.PolarSidechainSidechainInteraction:
-                        ni = PolarSidechainSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.save()
-                    elif type(i) is ci.PolarBackboneSidechainInteraction:
-                        ni = PolarBackboneSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.res1_is_sidechain = False
-                        ni.save()
-                    elif type(i) is ci.PolarSideChainBackboneInteraction:
-                        ni = PolarBackboneSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.res1_is_sidechain = True
-                        ni.save()
-                    elif type(i) is ci.FaceToFaceInteraction:
-                        ni = FaceToFaceInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.FaceToEdgeInteraction:
-                        ni = FaceToEdgeInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_face = True
-                        ni.save()
-                    elif type(i) is ci.EdgeToFaceInteraction:
-                        ni = FaceToEdgeInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_face = False
-                        ni.save()
-                    elif type(i) is ci.PiCationInteraction:
-                        ni = PiCationInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_pi = True
-                        ni.save()
-                    elif type(i) is ci.CationPiInteraction:
-                        ni = PiCationInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_pi = False
-                        ni.save()
+        interacting_pairs = compute_interactions(pdb_code, s)
+        save_interactions(s, interacting_pairs)
 
-            self.logger.info('Generated crystal interactions data for PDB \'{}\'...'.format(pdb_code))
+        self.logger.info('Generated crystal interactions data for PDB \'{}\'...'.format(pdb_code))
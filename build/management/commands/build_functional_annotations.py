@@ -0,0 +1,75 @@
+from build.management.commands.base_build import Command as BaseBuild
+from django.db import transaction
+
+from interaction.models import ResidueFragmentInteraction
+from mutational_landscape.models import PTMs, ResidueFunctionalAnnotation
+from protein.models import Protein
+from residue.models import Residue, ResiduePositionSet
+
+from collections import defaultdict, OrderedDict
+
+
+class Command(BaseBuild):
+    help = ('Builds the functional annotation of the residues of wild-type receptors (sodium pocket, microswitches, '
+        'PTMs, ligand interactions in structures of orthologs and G protein contacts), shown on the variant pages')
+
+    batch_size = 5000
+
+    # ResiduePositionSet name of each annotation
+    position_sets = OrderedDict([
+        ('sodium_pocket', 'Sodium pocket'),
+        ('microswitch', 'Microswitches'),
+        ('gprotein_contact', 'Signalling protein pocket'),
+    ])
+
+    def handle(self, *args, **options):
+        self.logger.info('BUILDING FUNCTIONAL ANNOTATIONS')
+        annotations = defaultdict(dict)
+        proteins = dict(Protein.objects.filter(sequence_type__slug='wt').values_list('id', 'family'))
+
+        # residues in the position sets, by generic number
+        labels = {}
+        for field, name in self.position_sets.items():
+            try:
+                labels[field] = set(ResiduePositionSet.objects.get(name=name).residue_position.values_list('label',
+                    flat=True))
+            except ResiduePositionSet.DoesNotExist:
+                self.logger.warning('Residue position set {} not found'.format(name))
+                labels[field] = set()
+        all_labels = set().union(*labels.values())
+        for residue, protein, label in Residue.objects.filter(protein_conformation__protein__sequence_type__slug='wt',
+            generic_number__label__in=all_labels).values_list('id', 'protein_conformation__protein',
+            'generic_number__label').iterator():
+            for field in self.position_sets:
+                if label in labels[field]:
+                    annotations[(protein, residue)][field] = True
+
+        for residue, protein, modification in PTMs.objects.filter(protein__sequence_type__slug='wt').order_by(
+            'id').values_list('residue', 'protein', 'modification').iterator():
+            annotations[(protein, residue)]['ptm'] = modification
+
+        # interaction types of the ligand complexes of each receptor family, by sequence number. The structures of
+        # all orthologs are used, as in the variant browser
+        family_interactions = defaultdict(lambda: defaultdict(list))
+        for family, sequence_number, interaction_type in ResidueFragmentInteraction.objects.filter(
+            structure_ligand_pair__annotated=True, rotamer__residue__generic_number__isnull=False).exclude(
+            interaction_type__type='hidden').order_by('rotamer__residue__sequence_number', 'id').values_list(
+            'structure_ligand_pair__structure__protein_conformation__protein__parent__family',
+            'rotamer__residue__sequence_number', 'interaction_type__name').iterator():
+            if interaction_type not in family_interactions[family][sequence_number]:
+                family_interactions[family][sequence_number].append(interaction_type)
+
+        for residue, protein, sequence_number in Residue.objects.filter(
+            protein_conformation__protein__sequence_type__slug='wt',
+            protein_conformation__protein__family__in=list(family_interactions)).values_list('id',
+            'protein_conformation__protein', 'sequence_number').iterator():
+            interaction_types = family_interactions[proteins[protein]].get(sequence_number)
+            if interaction_types:
+                annotations[(protein, residue)]['ligand_interactions'] = ', '.join(interaction_types)
+
+        with transaction.atomic():
+            ResidueFunctionalAnnotation.objects.all().delete()
+            ResidueFunctionalAnnotation.objects.bulk_create([ResidueFunctionalAnnotation(protein_id=protein,
+                residue_id=residue, **fields) for (protein, residue), fields in annotations.items()],
+                batch_size=self.batch_size)
+        self.logger.info('COMPLETED BUILDING FUNCTIONAL ANNOTATIONS ({} residues)'.format(len(annotations)))
@@ -36,17 +36,84 @@ class Command(BaseBuild):
         try:
             self.logger.info('CREATING RESIDUES')
 
-            # run the function twice (second run for proteins without reference positions)
-            iterations = 2
-            for i in range(1,iterations+1):
-                self.prepare_input(options['proc'], self.pconfs, i)
+            # run the function twice (second run for proteins without reference positions, which are aligned to a
+            # template in between)
+            self.prepare_input(options['proc'], self.pconfs, 1)
+            self.align_missing_reference_positions(options['proc'])
+            self.prepare_input(options['proc'], self.pconfs, 2)
 
             self.logger.info('COMPLETED CREATING RESIDUES')
         except Exception as msg:
             print(msg)
             self.logger.error(msg)
 
-    def main_func(self, positions, iteration):
+    def find_template(self, pconf):
+        """Find the closest protein (by family) with annotated reference positions"""
+        # - level 3 parent family
+        # - - level2 parent family
+        # - - - level1 parent family
+        # - - - - current proteins family
+        # - - - - - current protein
+
+        # try level1 families first, then level2, then level3
+        parent_family_levels = [pconf.protein.family.parent, pconf.protein.family.parent.parent,
+            pconf.protein.family.parent.parent.parent]
+        for parent_family in parent_family_levels:
+            # find sub families
+            related_families = ProteinFamily.objects.filter(parent=parent_family)
+
+            # loop through families and search for proteins to use as template
+            for family in related_families:
+                proteins = Protein.objects.filter(family=family)
+                if not proteins:
+                    proteins = Protein.objects.filter(family__parent=family)
+                    if not proteins:
+                        proteins = Protein.objects.filter(family__parent__parent=family)
+                for p in proteins:
+                    tpl_ref_position_file_path = os.sep.join([self.ref_position_source_dir, p.entry_name + '.yaml'])
+                    if load_reference_positions(tpl_ref_position_file_path):
+                        self.logger.info("Found template {}".format(p))
+                        return p, tpl_ref_position_file_path
+        return False
+
+    def align_missing_reference_positions(self, proc):
+        """Generate reference positions for proteins that lack them, by aligning them to a template. The alignments
+        are run in a pool of processes, and the results written to the auto reference position files"""
+        self.aligned_proteins = set()
+        jobs = []
+        for pconf in self.pconfs:
+            ref_position_file_path = os.sep.join([self.ref_position_source_dir, pconf.protein.entry_name + '.yaml'])
+            auto_ref_position_file_path = os.sep.join([self.auto_ref_position_source_dir,
+                pconf.protein.entry_name + '.yaml'])
+            if (load_reference_positions(ref_position_file_path)
+                or load_reference_positions(auto_ref_position_file_path)):
+                continue
+
+            self.logger.info("Reference positions for {} not annotated, looking for a template".format(
+                pconf.protein))
+            template = self.find_template(pconf)
+            if not template:
+                self.logger.error('No template reference positions found for {}'.format(pconf.protein))
+                continue
+
+            # required information about this protein
+            up = {}
+            up['entry_name'] = pconf.protein.entry_name
+            up['sequence'] = pconf.protein.sequence
+            jobs.append((up, template[1], template[0]))
+
+        results = align_proteins_to_references(jobs, proc)
+        for (up, tpl_ref_position_file_path, template), ref_positions in zip(jobs, results):
+            if not ref_positions:
+                continue
+
+            # write reference positions to a file
+            auto_ref_position_file_path = os.sep.join([self.auto_ref_position_source_dir, up['entry_name'] + '.yaml'])
+            with open(auto_ref_position_file_path, "w") as auto_ref_position_file:
+                yaml.dump(ref_positions, auto_ref_position_file, default_flow_style=False)
+            self.aligned_proteins.add(up['entry_name'])
+
+    def main_func(self, positions, iteration, count, lock):
         # pconfs
         if not positions[1]:
             pconfs = self.pconfs[positions[0]:]
@@ -64,65 +131,11 @@ class Command(BaseBuild):
                     pconf.protein.entry_name + '.yaml'])
                 ref_positions = load_reference_positions(auto_ref_position_file_path)
 
-            # if auto refs are not found, generate them
-            if not ref_positions:
-                # is this the second iteration of this function? We want all proteins with reference positions to be
-                # processed before looking for positions for those who lack them
-                if iteration == 2:
-                    self.logger.info("Reference positions for {} not annotated, looking for a template".format(
-                        pconf.protein))
-
-                    # required information about this protein
-                    up = {}
-                    up['entry_name'] = pconf.protein.entry_name
-                    up['sequence'] = pconf.protein.sequence
-
-                    # find closest protein (by family) to get ref positions
-                    # - level 3 parent family
-                    # - - level2 parent family
-                    # - - - level1 parent family
-                    # - - - - current proteins family
-                    # - - - - - current protein
-                    template_found = False
-
-                    # try level1 families first, then level2, then level3
-                    parent_family_levels = [pconf.protein.family.parent, pconf.protein.family.parent.parent,
-                        pconf.protein.family.parent.parent.parent]
-                    for parent_family in parent_family_levels:
-                        if template_found:
-                            break
-
-                        # find sub families
-                        related_families = ProteinFamily.objects.filter(parent=parent_family)
-
-                        # loop through families and search for proteins to use as template
-                        for family in related_families:
-                            if template_found:
-                                break
-                            proteins = Protein.objects.filter(family=family)
-                            if not proteins:
-                                proteins = Protein.objects.filter(family__parent=family)
-                                if not proteins:
-                                    proteins = Protein.objects.filter(family__parent__parent=family)
-                            for p in proteins:
-                                tpl_ref_position_file_path = os.sep.join([self.ref_position_source_dir,
-                                    p.entry_name + '.yaml'])
-                                tpl_ref_positions = load_reference_positions(tpl_ref_position_file_path)
-                                if tpl_ref_positions:
-                                    self.logger.info("Found template {}".format(p))
-                                    ref_positions = align_protein_to_reference(up, tpl_ref_position_file_path, p)
-                                    # write reference positions to a file
-                                    with open(auto_ref_position_file_path, "w") as auto_ref_position_file:
-                                        yaml.dump(ref_positions, auto_ref_position_file, default_flow_style=False)
-                                    template_found = True
-                                    break
-                    else:
-                        if not template_found:
-                            self.logger.error('No template reference positions found for {}'.format(pconf.protein))
-                else:
-                    continue
-            elif iteration == 2:
-                # proteins with ref positions have already been processed in the first iteration
+            # proteins without reference positions are aligned to a template after the first iteration, and processed
+            # in the second one
+            if iteration == 1 and not ref_positions:
+                continue
+            elif iteration == 2 and pconf.protein.entry_name not in self.aligned_proteins:
                 continue
 
             # remote empty ref positions
@@ -9,7 +9,7 @@ from protein.models import Protein
 from ligand.models import Ligand, LigandProperities, LigandRole, LigandType, ChemblAssay, AssayExperiment
 from ligand.models import LigandVendorLink, LigandVendors
 from ligand.functions import get_or_make_ligand
-from common.tools import fetch_from_web_api
+from common.tools import fetch_from_web_api, fetch_many_from_web_api
 from collections import defaultdict
 import requests
 from optparse import make_option
@@ -90,164 +90,145 @@ class Command(BaseBuild):
         print('Data rows that seem duplicated',count)
             
         # Load all ligands ( possible to skip if believed to be included or already imported )
-        #self.prepare_input(options['proc'], self.chembl_mol_ids, 0)
+        #self.run_jobs(options['proc'], self.chembl_mol_ids, self.load_ligand, 'ligands')
         # Insert the actual data points
-        self.prepare_input(options['proc'], self.data ,1)
+        self.wr_chembl_assays = WebResource.objects.get(slug='chembl_assays')
+        self.missing_proteins = set()
+        results = self.run_jobs(options['proc'], self.data, self.load_assay_experiment, 'assay experiments')
+        failed = [r for r in results if r.error]
+        if failed:
+            self.logger.error('Failed loading {} assay experiments'.format(len(failed)))
+        print('done, skipped:', len([r for r in results if r.result is False]))
 
         
-    def main_func(self, positions, iteration,count,lock):
+    def load_ligand(self, chembl_ligand):
         #####Create chembl compound link and connect it to the corresponding ligand/cid#####
+        # First load makes sure ligands are there
+        l = Ligand.objects.filter(properities__web_links__web_resource__slug = 'chembl_ligand', properities__web_links__index=chembl_ligand).first()
+        if l:
+            cid = l.properities.web_links.filter(web_resource__slug = 'pubchem').first()
+            if cid:
+                cid = cid.index
+            else:
+                l = None
+                # make sure code blow is run
+
+        if not l:
+            # if l already has chembl link, assume all is good.
+            if chembl_ligand not in self.chembl_cid_dict.keys():
+                cids, not_found = self.find_cid_for_chembl(chembl_ligand)
+                if not_found:
+                    print('SKIPPED: Could not determine CID',chembl_ligand,cids)
+                    return
+            else:
+                cids = self.chembl_cid_dict[chembl_ligand]
 
-        if iteration==0:
-            # First load makes sure ligands are there
-            list_of_chembl_ids = self.chembl_mol_ids
-            while count.value<len(list_of_chembl_ids):
-                with lock:
-                    chembl_ligand = list_of_chembl_ids[count.value]
-                    count.value +=1 
-                    if count.value % 1000 == 0:
-                        print('{} Status {} out of {}'.format(
-                        datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), count.value, len(list_of_chembl_ids)))
-
-                l = Ligand.objects.filter(properities__web_links__web_resource__slug = 'chembl_ligand', properities__web_links__index=chembl_ligand).first()
-                if l:
-                    cid = l.properities.web_links.filter(web_resource__slug = 'pubchem').first()
-                    if cid:
-                        cid = cid.index
-                    else:
-                        l = None
-                        # make sure code blow is run
-
-                if not l:
-                    # if l already has chembl link, assume all is good.
-                    if chembl_ligand not in self.chembl_cid_dict.keys():
-                        cids, not_found = self.find_cid_for_chembl(chembl_ligand)
-                        if not_found:
-                            print('SKIPPED: Could not determine CID',chembl_ligand,cids)
-                            continue
-                    else:
-                        cids = self.chembl_cid_dict[chembl_ligand]
-
-                    temp = str(cids).split(';') #perhaps we should load all of the CIDs
-                    cid = str(temp[0])
-
-                    l = get_or_make_ligand(cid,'PubChem CID') #call the first cid if there are more than one
-                    if not l:
-                        print('SKIPPED: Ligand not found in PubChem', cid)
-                        continue
-
-                    if not l.properities.web_links.filter(web_resource__slug = 'pubchem',index = cid).exists():
-                        # NO CID FOR LIGAND! Rare cases where SMILES was used for initial look up
-                        wl, created = WebLink.objects.get_or_create(index=cid, web_resource=self.wr_pubchem)
-                        l.properities.web_links.add(wl)
+            temp = str(cids).split(';') #perhaps we should load all of the CIDs
+            cid = str(temp[0])
 
-                    if not l.properities.web_links.filter(web_resource__slug = 'chembl_ligand',index = chembl_ligand).exists():
-                        wl, created = WebLink.objects.get_or_create(index=chembl_ligand, web_resource=self.wr)
-                        l.properities.web_links.add(wl)
-                
-                ###### Vendor stuff  ######
-                if not len(l.properities.vendors.all()):
-                    # If it has some, assume they are all loaded
-                    cache_dir = ['pubchem', 'cid', 'vendors']
-                    url = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/categories/compound/$index/JSON/'
-                    vendors = fetch_from_web_api(url, cid, cache_dir)
-                    
-                    if vendors:
-                        for vendor_data in vendors['SourceCategories']['Categories'][0]['Sources'] :
-                            lv, created = LigandVendors.objects.get_or_create(slug = slugify(vendor_data['SourceName']))
-                            lv.name = vendor_data['SourceName']
-                            if 'SourceURL' in vendor_data:
-                                lv.url = vendor_data['SourceURL']
-                            lv.save()
-
-                            if 'SID' in vendor_data:
-                                #print (vendor_data['SID'])
-                                lvls = LigandVendorLink.objects.filter(sid = vendor_data['SID'] )
-                                if not lvls.exists():
-                                    lvl = LigandVendorLink()
-                                    lvl.vendor = lv
-                                    lvl.lp = l.properities
-                                    lvl.sid =  vendor_data['SID'] 
-                                    if 'RegistryID' in vendor_data:
-                                        lvl.vendor_external_id = vendor_data['RegistryID']
-                                    if 'SourceRecordURL' in vendor_data:
-                                        lvl.url = vendor_data['SourceRecordURL']
-                                    else:
-                                        continue
-                                    lvl.save()
-
-        elif iteration==1:
-            # Third load loads the exp (based on ligand/assay)
-            header = self.header_dict
-            skipped = 0
-            non_p = []
-            wr_chembl_assays = WebResource.objects.get(slug='chembl_assays')
-            while count.value<len(self.data):
-                with lock:
-                    record = self.data[count.value]
-                    count.value +=1 
-                    if count.value % 10000 == 0:
-                        print('{} Status {} out of {}'.format(
-                        datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), count.value, len(self.data)))
-
-
-                target = record[header['target_chembl_id']]
-                assay_id = record[header['assay_chembl_id']]
-
-                assay, created = ChemblAssay.objects.get_or_create(assay_id=assay_id)
-                if created:
-                    wl, created = WebLink.objects.get_or_create(index=assay_id, web_resource=wr_chembl_assays)
-                    assay.web_links.add(wl)
-
-
-                ligand =record[header['molecule_chembl_id']]
-                p = Protein.objects.filter(web_links__index = target, web_links__web_resource__slug = 'chembl').first()
-                if not p:
-                    if not target in non_p:
-                        non_p.append(target)
-                        print('Not found protein!',target)
-                    continue
+            l = get_or_make_ligand(cid,'PubChem CID') #call the first cid if there are more than one
+            if not l:
+                print('SKIPPED: Ligand not found in PubChem', cid)
+                return
 
-                ls = Ligand.objects.filter(properities__web_links__index=ligand, properities__web_links__web_resource__slug = 'chembl_ligand', canonical=True)
-                if not ls.exists():
-                    # if no ligand matches this, then ignore -- be sure this works later.
-                    skipped += 1
-                    continue
-                for l in ls:
-                    if len(ls)>1:
-                        print('issue with canonical! give to munk',l,l.pk,ligand)
-                        break
-                assay_experiments = AssayExperiment.objects.filter( protein=p, ligand=l, assay=assay)
-                
-                if assay_experiments.exists():
-                    assay_experiment = assay_experiments.get()
-                else:
-                    assay_experiment = AssayExperiment()
-                    assay_experiment.assay = assay
-                    assay_experiment.ligand = l
-                    assay_experiment.protein = p
+            if not l.properities.web_links.filter(web_resource__slug = 'pubchem',index = cid).exists():
+                # NO CID FOR LIGAND! Rare cases where SMILES was used for initial look up
+                wl, created = WebLink.objects.get_or_create(index=cid, web_resource=self.wr_pubchem)
+                l.properities.web_links.add(wl)
 
-                
-                
-                assay_experiment.assay_type = record[header['assay_type']]
-                assay_experiment.pchembl_value = record[header['pchembl_value']]
-                assay_experiment.assay_description = record[header['assay_description']]
-                assay_experiment.published_value = record[header['published_value']]
-                assay_experiment.published_relation = record[header['published_relation']]
-                assay_experiment.published_type = record[header['published_type']]
-                assay_experiment.published_units = record[header['published_units']]
-                
-                assay_experiment.standard_value = record[header['standard_value']]
-                assay_experiment.standard_relation = record[header['standard_relation']]
-                assay_experiment.standard_type = record[header['standard_type']]
-                assay_experiment.standard_units = record[header['standard_units']]
-                
-                try:
-                    assay_experiment.save()
-                except IntegrityError:
-                    assay_experiment = AssayExperiment.objects.get( protein=p, ligand=l, assay=assay)
+            if not l.properities.web_links.filter(web_resource__slug = 'chembl_ligand',index = chembl_ligand).exists():
+                wl, created = WebLink.objects.get_or_create(index=chembl_ligand, web_resource=self.wr)
+                l.properities.web_links.add(wl)
+        
+        ###### Vendor stuff  ######
+        if not len(l.properities.vendors.all()):
+            # If it has some, assume they are all loaded
+            cache_dir = ['pubchem', 'cid', 'vendors']
+            url = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug_view/categories/compound/$index/JSON/'
+            vendors = fetch_from_web_api(url, cid, cache_dir)
+            
+            if vendors:
+                for vendor_data in vendors['SourceCategories']['Categories'][0]['Sources'] :
+                    lv, created = LigandVendors.objects.get_or_create(slug = slugify(vendor_data['SourceName']))
+                    lv.name = vendor_data['SourceName']
+                    if 'SourceURL' in vendor_data:
+                        lv.url = vendor_data['SourceURL']
+                    lv.save()
+
+                    if 'SID' in vendor_data:
+                        #print (vendor_data['SID'])
+                        lvls = LigandVendorLink.objects.filter(sid = vendor_data['SID'] )
+                        if not lvls.exists():
+                            lvl = LigandVendorLink()
+                            lvl.vendor = lv
+                            lvl.lp = l.properities
+                            lvl.sid =  vendor_data['SID'] 
+                            if 'RegistryID' in vendor_data:
+                                lvl.vendor_external_id = vendor_data['RegistryID']
+                            if 'SourceRecordURL' in vendor_data:
+                                lvl.url = vendor_data['SourceRecordURL']
+                            else:
+                                continue
+                            lvl.save()
+
+    def load_assay_experiment(self, record):
+        # Second load loads the exp (based on ligand/assay)
+        header = self.header_dict
+        target = record[header['target_chembl_id']]
+        assay_id = record[header['assay_chembl_id']]
+
+        assay, created = ChemblAssay.objects.get_or_create(assay_id=assay_id)
+        if created:
+            wl, created = WebLink.objects.get_or_create(index=assay_id, web_resource=self.wr_chembl_assays)
+            assay.web_links.add(wl)
+
+
+        ligand =record[header['molecule_chembl_id']]
+        p = Protein.objects.filter(web_links__index = target, web_links__web_resource__slug = 'chembl').first()
+        if not p:
+            if not target in self.missing_proteins:
+                self.missing_proteins.add(target)
+                print('Not found protein!',target)
+            return
+
+        ls = Ligand.objects.filter(properities__web_links__index=ligand, properities__web_links__web_resource__slug = 'chembl_ligand', canonical=True)
+        if not ls.exists():
+            # if no ligand matches this, then ignore -- be sure this works later.
+            return False
+        for l in ls:
+            if len(ls)>1:
+                print('issue with canonical! give to munk',l,l.pk,ligand)
+                break
+        assay_experiments = AssayExperiment.objects.filter( protein=p, ligand=l, assay=assay)
+        
+        if assay_experiments.exists():
+            assay_experiment = assay_experiments.get()
+        else:
+            assay_experiment = AssayExperiment()
+            assay_experiment.assay = assay
+            assay_experiment.ligand = l
+            assay_experiment.protein = p
 
-            print('done, skipped:',skipped)
+        
+        
+        assay_experiment.assay_type = record[header['assay_type']]
+        assay_experiment.pchembl_value = record[header['pchembl_value']]
+        assay_experiment.assay_description = record[header['assay_description']]
+        assay_experiment.published_value = record[header['published_value']]
+        assay_experiment.published_relation = record[header['published_relation']]
+        assay_experiment.published_type = record[header['published_type']]
+        assay_experiment.published_units = record[header['published_units']]
+        
+        assay_experiment.standard_value = record[header['standard_value']]
+        assay_experiment.standard_relation = record[header['standard_relation']]
+        assay_experiment.standard_type = record[header['standard_type']]
+        assay_experiment.standard_units = record[header['standard_units']]
+        
+        try:
+            assay_experiment.save()
+        except IntegrityError:
+            assay_experiment = AssayExperiment.objects.get( protein=p, ligand=l, assay=assay)
+        return True
 
     def find_cid_for_chembl(self, chembl_mol_id):
         # function to find cid based on chembl
@@ -299,6 +280,12 @@ class Command(BaseBuild):
     ##call pubchem service to find cids for chembl
     def find_cid(self, chembl_mol_ids, chembl_cid_dict):
         notfound = set()
+
+        # fetch all missing ids at once
+        cache_dir = ['ebi', 'chembl', 'src_compound_id_all']
+        url = 'https://www.ebi.ac.uk/unichem/rest/src_compound_id_all/$index/1/22'
+        all_lig_data = fetch_many_from_web_api(url, [c for c in chembl_mol_ids if c not in chembl_cid_dict],
+            cache_dir)
         for chembl_mol_id in chembl_mol_ids:
             
             if chembl_mol_id not in chembl_cid_dict.keys():
@@ -307,9 +294,7 @@ class Command(BaseBuild):
                 # url = 'https://www.ebi.ac.uk/unichem/rest/src_compound_id_all/'+chembl_mol_id+'/1/22'
                 # response = requests.get(url)
                 # lig_data = response.json()
-                cache_dir = ['ebi', 'chembl', 'src_compound_id_all']
-                url = 'https://www.ebi.ac.uk/unichem/rest/src_compound_id_all/$index/1/22'
-                lig_data = fetch_from_web_api(url, chembl_mol_id, cache_dir)
+                lig_data = all_lig_data[chembl_mol_id]
                 # print("Searching for ",chembl_mol_id,len(chembl_mol_ids))
                 if not lig_data:
                     #if not successful
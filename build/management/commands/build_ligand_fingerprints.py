@@ -0,0 +1,51 @@
+from build.management.commands.base_build import Command as BaseBuild
+from ligand.models import LigandProperities
+from ligand.fingerprints import FingerprintStore, smiles_fingerprints, FINGERPRINT_BITS
+
+import datetime
+import numpy as np
+
+
+class Command(BaseBuild):
+    help = 'Builds the fingerprint index of all ligands with a SMILES, used by the ligand similarity search'
+
+    # number of ligands per job
+    chunk_size = 5000
+
+    def handle(self, *args, **options):
+        self.logger.info('BUILDING LIGAND FINGERPRINTS')
+        store = FingerprintStore()
+        build = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+        ligands = list(LigandProperities.objects.exclude(smiles=None).exclude(smiles='').order_by('pk').values_list(
+            'pk', 'smiles'))
+        chunks = [ligands[i:i + self.chunk_size] for i in range(0, len(ligands), self.chunk_size)]
+        results = self.run_jobs(options['proc'], chunks, self.chunk_fingerprints, 'ligand chunks')
+        if any([r.error for r in results]):
+            self.logger.error('Ligand fingerprints not built for all ligands, keeping previous fingerprints')
+            return
+
+        ids = np.concatenate([r.result[0] for r in results]) if results else np.zeros(0, dtype=np.int64)
+        morgan = (np.concatenate([r.result[1] for r in results]) if results
+            else np.zeros((0, FINGERPRINT_BITS // 8), dtype=np.uint8))
+        pattern = (np.concatenate([r.result[2] for r in results]) if results
+            else np.zeros((0, FINGERPRINT_BITS // 8), dtype=np.uint8))
+        store.save(ids, morgan, pattern, build)
+        self.logger.info('COMPLETED BUILDING LIGAND FINGERPRINTS ({} of {} ligands)'.format(len(ids), len(ligands)))
+
+    def chunk_fingerprints(self, chunk):
+        """Ids and packed fingerprints of the ligands of a chunk that RDKit can parse"""
+        ids = []
+        morgan = []
+        pattern = []
+        for pk, smiles in chunk:
+            fingerprints = smiles_fingerprints(smiles)
+            if fingerprints is None:
+                continue
+            ids.append(pk)
+            morgan.append(fingerprints[0])
+            pattern.append(fingerprints[1])
+
+        empty = np.zeros((0, FINGERPRINT_BITS // 8), dtype=np.uint8)
+        return (np.array(ids, dtype=np.int64), np.array(morgan, dtype=np.uint8) if morgan else empty,
+            np.array(pattern, dtype=np.uint8) if pattern else empty)
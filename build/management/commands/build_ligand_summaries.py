@@ -0,0 +1,79 @@
+from build.management.commands.base_build import Command as BaseBuild
+from django.db import transaction
+from django.db.models import Count, Min, Avg, Max
+
+from ligand.models import (AssayExperiment, AssayExperimentSummary, LigandFamilyStatistics, LigandVendorLink,
+    NON_VENDOR_SOURCES)
+from protein.models import Protein, ProteinFamily
+
+from collections import defaultdict, OrderedDict
+
+
+class Command(BaseBuild):
+    help = ('Builds the per ligand and target summaries of assay experiments, and the ligand counts of protein '
+        'families, that are shown on the ligand pages')
+
+    batch_size = 5000
+
+    def handle(self, *args, **options):
+        self.logger.info('BUILDING LIGAND SUMMARIES')
+        with transaction.atomic():
+            AssayExperimentSummary.objects.all().delete()
+            LigandFamilyStatistics.objects.all().delete()
+            self.build_assay_summaries()
+            self.build_family_statistics()
+        self.logger.info('COMPLETED BUILDING LIGAND SUMMARIES')
+
+    def build_assay_summaries(self):
+        # assay and value types, and units, of each ligand and target
+        types = defaultdict(lambda: (OrderedDict(), OrderedDict(), OrderedDict()))
+        for ligand, protein, assay_type, standard_type, standard_units in AssayExperiment.objects.values_list(
+            'ligand', 'protein', 'assay_type', 'standard_type', 'standard_units').distinct().order_by('assay_type',
+            'standard_type').iterator():
+            assay_types, value_types, units = types[(ligand, protein)]
+            assay_types[assay_type] = True
+            value_types[standard_type] = True
+            units[standard_units] = True
+
+        purchasable = set(LigandVendorLink.objects.exclude(vendor__name__in=NON_VENDOR_SOURCES).values_list('lp',
+            flat=True))
+
+        summaries = AssayExperiment.objects.values('ligand', 'protein', 'ligand__properities').annotate(
+            record_count=Count('id'), min_standard_value=Min('standard_value'),
+            avg_standard_value=Avg('standard_value'), min_pchembl_value=Min('pchembl_value'),
+            avg_pchembl_value=Avg('pchembl_value'), max_pchembl_value=Max('pchembl_value')).order_by()
+        bulk = []
+        for s in summaries.iterator():
+            assay_types, value_types, units = types[(s['ligand'], s['protein'])]
+            bulk.append(AssayExperimentSummary(ligand_id=s['ligand'], protein_id=s['protein'],
+                record_count=s['record_count'], assay_types=', '.join(assay_types),
+                value_types=', '.join(value_types), standard_units=', '.join(units),
+                min_standard_value=s['min_standard_value'], avg_standard_value=s['avg_standard_value'],
+                min_pchembl_value=s['min_pchembl_value'], avg_pchembl_value=s['avg_pchembl_value'],
+                max_pchembl_value=s['max_pchembl_value'], purchasable=s['ligand__properities'] in purchasable))
+        AssayExperimentSummary.objects.bulk_create(bulk, batch_size=self.batch_size)
+        self.logger.info('Summarized assay experiments of {} ligand and target pairs'.format(len(bulk)))
+
+    def build_family_statistics(self):
+        parents = dict(ProteinFamily.objects.values_list('id', 'parent'))
+
+        def lineage(family):
+            while family is not None:
+                yield family
+                family = parents[family]
+
+        ligands = defaultdict(set)
+        targets = defaultdict(set)
+        receptors = defaultdict(set)
+        for family in Protein.objects.values_list('family', flat=True).distinct():
+            for ancestor in lineage(family):
+                receptors[ancestor].add(family)
+        for ligand, family in AssayExperiment.objects.values_list('ligand', 'protein__family').distinct().iterator():
+            for ancestor in lineage(family):
+                ligands[ancestor].add(ligand)
+                targets[ancestor].add(family)
+
+        LigandFamilyStatistics.objects.bulk_create([LigandFamilyStatistics(family_id=family,
+            num_ligands=len(ligands[family]), num_targets=len(targets[family]),
+            num_receptors=len(receptors[family])) for family in receptors], batch_size=self.batch_size)
+        self.logger.info('Counted ligands of {} protein families'.format(len(receptors)))
@@ -0,0 +1,91 @@
+from build.management.commands.base_build import Command as BaseBuild
+from protein.models import ProteinSegment
+from structure.models import Structure, StructureModel
+from structure.rmsd_matrix import RMSDStore, BACKBONE_ATOMS, OVERALL, TM, TM_SEGMENTS, item_key, \
+    backbone_coordinates, pairwise_rmsd
+
+from collections import OrderedDict
+import datetime
+import numpy as np
+
+
+class Command(BaseBuild):
+    help = 'Builds a precomputed matrix of the pairwise backbone RMSD of all crystal structures and homology models, ' \
+        + 'overall, for the 7TM bundle and per segment'
+
+    # number of matrix rows per job
+    block_size = 200
+
+    def handle(self, *args, **options):
+        self.logger.info('BUILDING RMSD MATRIX')
+        self.store = RMSDStore()
+        self.build = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+        # all structures and homology models, the order of this list is the row order of the stored matrices
+        self.items = list(Structure.objects.filter(refined=False).order_by('pk').select_related('pdb_code',
+            'pdb_data', 'protein_conformation__protein'))
+        self.items += list(StructureModel.objects.order_by('pk').select_related('protein', 'state'))
+
+        results = self.run_jobs(options['proc'], self.items, backbone_coordinates, 'structures')
+        failed = [str(item) for item, r in zip(self.items, results) if r.error]
+        if failed:
+            self.logger.warning('No coordinates for {} structures: {}'.format(len(failed), ', '.join(failed)))
+        self.load_coordinates([r.result or {} for r in results])
+
+        # each process calculates and saves blocks of rows of all regions
+        self.store.create_regions(list(self.region_points), len(self.items), self.build)
+        blocks = list(range(0, len(self.items), self.block_size))
+        results = self.run_jobs(options['proc'], blocks, self.build_block, 'row blocks')
+
+        # only save the index if all rows were built
+        if any([r.error for r in results]):
+            self.logger.error('RMSD matrix not built for all structures, keeping previous matrix')
+        else:
+            self.store.save_index([item_key(item) for item in self.items], [self.item_name(item) for item in
+                self.items], list(self.region_points), self.build)
+            self.logger.info('COMPLETED BUILDING RMSD MATRIX ({} structures and models, {} regions)'.format(
+                len(self.items), len(self.region_points)))
+
+    def item_name(self, item):
+        if isinstance(item, StructureModel):
+            return '{} {}'.format(item.protein.entry_name, item.state.slug)
+        return item.pdb_code.index
+
+    def load_coordinates(self, item_atoms):
+        """Coordinate array (items x points x 3) of the backbone atoms at all generic number positions, in segment
+        order, with the mask of the atoms present in each item. Sets the points of each region"""
+        segments = list(ProteinSegment.objects.filter(partial=False, proteinfamily='GPCR').values_list('slug',
+            flat=True))
+        position_segments = {}
+        for atoms in item_atoms:
+            for label, (segment, coordinates) in atoms.items():
+                position_segments.setdefault(label, segment)
+        positions = sorted(position_segments, key=lambda label: (segments.index(position_segments[label])
+            if position_segments[label] in segments else len(segments), label))
+        columns = {label: i for i, label in enumerate(positions)}
+
+        num_atoms = len(BACKBONE_ATOMS)
+        coordinates = np.full((len(item_atoms), len(positions), num_atoms, 3), np.nan)
+        for i, atoms in enumerate(item_atoms):
+            for label, (segment, atom_coordinates) in atoms.items():
+                coordinates[i, columns[label]] = atom_coordinates
+        coordinates = coordinates.reshape(len(item_atoms), len(positions) * num_atoms, 3)
+        self.mask = ~np.isnan(coordinates).any(axis=2)
+        self.coordinates = np.nan_to_num(coordinates)
+
+        point_segments = np.repeat([position_segments[label] for label in positions], num_atoms)
+        self.region_points = OrderedDict([(OVERALL, np.arange(len(point_segments))),
+            (TM, np.nonzero(np.isin(point_segments, TM_SEGMENTS))[0])])
+        for segment in segments:
+            points = np.nonzero(point_segments == segment)[0]
+            if len(points):
+                self.region_points[segment] = points
+
+    def build_block(self, first):
+        rows = slice(first, first + self.block_size)
+        for region, points in self.region_points.items():
+            rmsd = pairwise_rmsd(self.coordinates[rows][:, points], self.mask[rows][:, points],
+                self.coordinates[:, points], self.mask[:, points])
+            self.store.save_rows(region, self.build, first, rmsd)
+        self.logger.info('Completed RMSD matrix rows {} to {}'.format(first, min(first + self.block_size,
+            len(self.items))))
@@ -0,0 +1,70 @@
+from build.management.commands.base_build import Command as BaseBuild
+from protein.models import Protein, ProteinSegment
+from common.alignment import Alignment
+from common.similarity import SimilarityStore
+
+import datetime
+import os
+import numpy as np
+
+
+class Command(BaseBuild):
+    help = 'Builds a precomputed matrix of the pairwise sequence identity, similarity and similarity score of all wt ' \
+        + 'receptors, per segment'
+
+    def handle(self, *args, **options):
+        self.logger.info('BUILDING SIMILARITY MATRIX')
+        self.store = SimilarityStore()
+        self.build = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+        # all wt receptors, the order of this list is the row order of the stored matrices
+        self.proteins = list(Protein.objects.filter(sequence_type__slug='wt', family__slug__startswith='00')
+            .order_by('pk').select_related('residue_numbering_scheme', 'species'))
+        self.segments = list(ProteinSegment.objects.filter(partial=False, proteinfamily='GPCR'))
+
+        # each process calculates and saves whole segments
+        self.run_jobs(options['proc'], self.segments, self.build_segment, 'segments')
+
+        # only save the index if all segments were built
+        segments = [s.slug for s in self.segments]
+        missing = [s for s in segments if not os.path.isfile(self.store.segment_path(s, self.build))]
+        if missing:
+            self.logger.error('Similarity matrix not built for segments {}, keeping previous matrix'.format(missing))
+        else:
+            self.store.save_index([p.pk for p in self.proteins], segments, self.build)
+            self.logger.info('COMPLETED BUILDING SIMILARITY MATRIX')
+
+    def build_segment(self, segment):
+        self.logger.info('Building similarity matrix for segment {}'.format(segment.slug))
+        a = Alignment()
+        a.use_matrix = True
+        a.max_matrix_residues = float('inf')
+        a.ignore_alternative_residue_numbering_schemes = True
+        a.load_proteins(self.proteins)
+        a.load_segments([segment])
+        a.build_alignment()
+
+        # matrix rows in the order of the protein list (proteins without residues in this segment get zero counts)
+        protein_rows = {}
+        for pc in a.proteins:
+            if pc.protein_id not in protein_rows:
+                protein_rows[pc.protein_id] = pc.matrix_row
+        store_rows = [i for i, p in enumerate(self.proteins) if p.pk in protein_rows]
+        matrix_rows = np.array([protein_rows[self.proteins[i].pk] for i in store_rows], dtype=np.intp)
+
+        counts = np.zeros((len(self.proteins), len(self.proteins), len(self.store.fields)), dtype=np.int32)
+        if len(matrix_rows) and a.matrix.shape[1]:
+            identities, similarities, scores, lengths = a.matrix_similarity(matrix_rows, matrix_rows)
+            residues = (a.matrix[matrix_rows] != 0).astype(np.float32)
+            paired_lengths = np.rint(residues @ residues.T)
+            block = np.ix_(store_rows, store_rows)
+            for i, values in enumerate([identities, similarities, scores, lengths, paired_lengths]):
+                counts[:, :, i][block] = values
+
+        # use the smallest integer type that holds the counts
+        if np.abs(counts).max() < np.iinfo(np.int16).max:
+            counts = counts.astype(np.int16)
+        else:
+            counts = counts.astype(np.int32)
+        self.store.save_segment(segment.slug, counts, self.build)
+        self.logger.info('Completed building similarity matrix for segment {}'.format(segment.slug))
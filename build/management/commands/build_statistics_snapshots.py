@@ -0,0 +1,40 @@
+from build.management.commands.base_build import Command as BaseBuild
+from common.models import ReleaseNotes
+from common.snapshots import STATISTICS_SNAPSHOTS, SnapshotStore, calculate_snapshot
+
+
+class Command(BaseBuild):
+    help = 'Builds the snapshots of the statistics pages (structures, ligands, mutation coverage and variants) for ' \
+        + 'the current data release'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--snapshot',
+            action='append',
+            dest='snapshots',
+            choices=list(STATISTICS_SNAPSHOTS),
+            help='Build only these snapshots (default all)')
+
+    def handle(self, *args, **options):
+        self.logger.info('BUILDING STATISTICS SNAPSHOTS')
+        store = SnapshotStore()
+        release = ReleaseNotes.current_version()
+
+        failed = []
+        for name in options['snapshots'] or list(STATISTICS_SNAPSHOTS):
+            try:
+                data = calculate_snapshot(name)
+            except Exception as msg:
+                self.logger.error('Statistics snapshot {} not built: {}'.format(name, msg))
+                failed.append(name)
+                continue
+            if store.save(name, data, release):
+                self.logger.info('Built statistics snapshot {}'.format(name))
+            else:
+                self.logger.info('Statistics snapshot {} is unchanged'.format(name))
+
+        if failed:
+            self.logger.error('Statistics snapshots not built: {}, these pages are calculated on each request'.format(
+                ', '.join(failed)))
+        else:
+            self.logger.info('COMPLETED BUILDING STATISTICS SNAPSHOTS (release {})'.format(release))
@@ -15,8 +15,8 @@ from structure.models import (Structure, StructureType, StructureSegment, Struct
 from construct.functions import *
 
 from contactnetwork.models import *
-import contactnetwork.interaction as ci
 from contactnetwork.cube import compute_interactions
+from contactnetwork.bulk import save_interactions
 
 from Bio.PDB import PDBParser,PPBuilder
 from Bio import pairwise2
@@ -627,7 +627,7 @@ class Command(BaseBuild):
                                 #print('inserted',residue.sequence_number) #sanity check
                                 # residue.save()
                                 residues_bulk.append(residue)
-                                rotamer_data, created = PdbData.objects.get_or_create(pdb=temp)
+                                rotamer_data, created = PdbData.objects.get_or_create_pdb(temp)
                                 #rotamer_data_bulk.append(PdbData(pdb=temp))
                                 missing_atoms = False
                                 if rotamer_data.pdb.startswith('COMPND'):
@@ -775,88 +775,13 @@ class Command(BaseBuild):
 
     def build_contact_network(self,s,pdb_code):
         try:
-            interacting_pairs = compute_interactions(pdb_code)
+            interacting_pairs = compute_interactions(pdb_code, s)
         except:
             self.logger.error('Error with computing interactions (%s)' % (pdb_code))
             return
 
-        for p in interacting_pairs:
-            # Create the pair
-            res1_seq_num = p.get_residue_1().id[1]
-            res2_seq_num = p.get_residue_2().id[1]
-            conformation = s.protein_conformation
-
-            # Get the residues
-            try:
-                res1 = Residue.objects.get(sequence_number=res1_seq_num, protein_conformation=conformation)
-                res2 = Residue.objects.get(sequence_number=res2_seq_num, protein_conformation=conformation)
-            except Residue.DoesNotExist:
-                self.logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
-                # print('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
-                continue
-
-            # Save the pair
-            pair = InteractingResiduePair()
-            pair.res1 = res1
-            pair.res2 = res2
-            pair.referenced_structure = s
-            pair.save()
-
-            # Add the interactions to the pair
-            for i in p.get_interactions():
-                if type(i) is ci.VanDerWaalsInteraction:
-                    ni = VanDerWaalsInteraction()
-                    ni.interacting_pair = pair
-                    ni.save()
-                elif type(i) is ci.HydrophobicInteraction:
-                    ni = HydrophobicInteraction()
-                    ni.interacting_pair = pair
-                    ni.save()
-                elif type(i) is ci.PolarSidechainSidechainInteraction:
-                    ni = PolarSidechainSidechainInteraction()
-                    ni.interacting_pair = pair
-                    ni.is_charged_res1 = i.is_charged_res1
-                    ni.is_charged_res2 = i.is_charged_res2
-                    ni.save()
-                elif type(i) is ci.PolarBackboneSidechainInteraction:
-                    ni = PolarBackboneSidechainInteraction()
-                    ni.interacting_pair = pair
-                    ni.is_charged_res1 = i.is_charged_res1
-                    ni.is_charged_res2 = i.is_charged_res2
-                    ni.res1_is_sidechain = False
-                    ni.save()
-                elif type(i) is ci.PolarSideChainBackboneInteraction:
-                    ni = PolarBackboneSidechainInteraction()
-                    ni.interacting_pair = pair
-                    ni.is_charged_res1 = i.is_charged_res1
-                    ni.is_charged_res2 = i.is_charged_res2
-                    ni.res1_is_sidechain = True
-                    ni.save()
-                elif type(i) is ci.FaceToFaceInteraction:
-                    ni = FaceToFaceInteraction()
-                    ni.interacting_pair = pair
-                    ni.save()
-                elif type(i) is ci.FaceToEdgeInteraction:
-                    ni = FaceToEdgeInteraction()
-                    ni.interacting_pair = pair
-                    ni.res1_has_face = True
-                    ni.save()
-                elif type(i) is ci.EdgeToFaceInteraction:
-                    ni = FaceToEdgeInteraction()
-                    ni.interacting_pair = pair
-                    ni.res1_has_face = False
-                    ni.save()
-                elif type(i) is ci.PiCationInteraction:
-                    ni = PiCationInteraction()
-                    ni.interacting_pair = pair
-                    ni.res1_has_pi = True
-                    ni.save()
-                elif type(i) is ci.CationPiInteraction:
-                    ni = PiCationInteraction()
-                    ni.interacting_pair = pair
-                    ni.res1_has_pi = False
-                    ni.save()
-
+        # residues are mapped in one query, pairs and interactions are inserted in bulk in one transaction
+        save_interactions(s, interacting_pairs)
 
     def main_func(self, positions, iteration,count,lock):
         # filenames
@@ -965,7 +890,7 @@ class Command(BaseBuild):
                         with open(pdb_path, 'r') as pdb_file:
                             pdbdata_raw = pdb_file.read()
 
-                    pdbdata, created = PdbData.objects.get_or_create(pdb=pdbdata_raw)
+                    pdbdata, created = PdbData.objects.get_or_create_pdb(pdbdata_raw)
                     s.pdb_data = pdbdata
 
                     # UPDATE HETSYN with its PDB reference instead + GRAB PUB DATE, PMID, DOI AND RESOLUTION
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from common.tools import web_store_get, web_store_dir
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import logging
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebStoreHandler(BaseHTTPRequestHandler):
+    """Answers requests for http://host:port/<original URL> with the stored response of the original URL"""
+    store_dir = None
+
+    def do_GET(self):
+        stored = web_store_get(self.path[1:], self.store_dir)
+        if not stored:
+            self.send_error(404, 'Not in the web store')
+            return
+
+        status, content = stored
+        if status != 200:
+            self.send_error(status)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.getLogger('build').debug(format % args)
+
+
+class Command(BaseCommand):
+    help = ('Serve the responses in the web store over HTTP, as a stand-in for PubChem, ChEMBL, GtoP etc. Point the '
+        'WEB_API_STUB_URL setting to this server to use it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port',
+            type=int,
+            action='store',
+            dest='port',
+            default=8765,
+            help='Port to listen on')
+        parser.add_argument('--store',
+            action='store',
+            dest='store',
+            default=None,
+            help='Web store directory to serve, e.g. a set of test responses (default: the web store of the build)')
+
+    def handle(self, *args, **options):
+        WebStoreHandler.store_dir = options['store'] or web_store_dir()
+        server = ThreadingHTTPServer(('localhost', options['port']), WebStoreHandler)
+        print('Serving {} on http://localhost:{}/'.format(WebStoreHandler.store_dir, options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,137 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+
+from multiprocessing import Process
+import datetime
+import logging
+import os
+import time
+import yaml
+
+
+logger = logging.getLogger('build')
+
+
+def timestamp():
+    return datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')
+
+
+class BuildStage(object):
+    """A build command, with the data it reads (inputs) and writes (outputs). An input of '*' means all data written
+    by the stages before it"""
+
+    def __init__(self, name, command, inputs=[], outputs=[], args=[], kwargs={}):
+        self.name = name
+        self.command = command
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.args = args
+        self.kwargs = kwargs
+        # number of processes used by the command
+        self.processes = kwargs.get('proc', 1)
+        self.requires = set()
+
+    def __repr__(self):
+        return self.name
+
+    def run(self):
+        call_command(self.command, *self.args, **self.kwargs)
+
+
+class BuildScheduler(object):
+    """Runs build stages in separate processes, starting each stage as soon as the stages it depends on are
+    completed, and as long as the number of processes in use stays within the budget. Completed stages are recorded
+    in a checkpoint file, so that a failed or interrupted build can be resumed"""
+
+    checkpoint_file_path = os.sep.join([settings.BUILD_CACHE_DIR, 'build_all', 'checkpoints.yaml'])
+    poll_interval = 5
+
+    def __init__(self, stages, processes=1, options={}):
+        self.stages = stages
+        self.processes = max(processes, 1)
+        # options of the build, a build can only be resumed with the same options
+        self.options = options
+        self.resolve_dependencies()
+
+    def resolve_dependencies(self):
+        """A stage depends on earlier stages that write its inputs, write its outputs, or read its outputs, so that
+        the result is the same as running the stages one by one in the given order"""
+        for i, stage in enumerate(self.stages):
+            for earlier in self.stages[:i]:
+                if ('*' in stage.inputs or earlier.outputs & (stage.inputs | stage.outputs)
+                    or earlier.inputs & stage.outputs):
+                    stage.requires.add(earlier.name)
+
+    def load_checkpoints(self):
+        if not os.path.isfile(self.checkpoint_file_path):
+            return {}
+        with open(self.checkpoint_file_path) as checkpoint_file:
+            checkpoints = yaml.safe_load(checkpoint_file) or {}
+        if checkpoints.get('options') != self.options:
+            print('Build options differ from the interrupted build, starting from the beginning')
+            return {}
+        return checkpoints.get('completed', {})
+
+    def save_checkpoints(self, completed):
+        os.makedirs(os.path.dirname(self.checkpoint_file_path), exist_ok=True)
+        tmp_file_path = self.checkpoint_file_path + '.tmp'
+        with open(tmp_file_path, 'w') as checkpoint_file:
+            yaml.dump({'options': self.options, 'completed': completed}, checkpoint_file, default_flow_style=False)
+        os.replace(tmp_file_path, self.checkpoint_file_path)
+
+    def run(self, resume=False):
+        """Run all stages, returns the names of the stages that failed or were skipped because of a failure"""
+        completed = self.load_checkpoints() if resume else {}
+        for name in completed:
+            print('{} Skipping {}, completed {}'.format(timestamp(), name, completed[name]))
+        self.save_checkpoints(completed)
+
+        pending = [stage for stage in self.stages if stage.name not in completed]
+        running = {}
+        failed = []
+        while pending or running:
+            # collect finished stages
+            for name, (process, stage) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[name]
+                if process.exitcode == 0:
+                    completed[name] = timestamp()
+                    self.save_checkpoints(completed)
+                    print('{} Completed {}'.format(timestamp(), name))
+                else:
+                    failed.append(name)
+                    logger.error('Build stage {} failed with exit code {}'.format(name, process.exitcode))
+                    print('{} Failed {}'.format(timestamp(), name))
+
+            # stages depending on a failed stage can not be run
+            for stage in list(pending):
+                if stage.requires & set(failed):
+                    pending.remove(stage)
+                    failed.append(stage.name)
+                    print('{} Skipping {}, depends on a failed stage'.format(timestamp(), stage.name))
+
+            # start stages in order, until one does not fit in the process budget
+            used = sum([min(stage.processes, self.processes) for process, stage in running.values()])
+            for stage in list(pending):
+                if not stage.requires <= set(completed):
+                    continue
+                processes = min(stage.processes, self.processes)
+                if running and used + processes > self.processes:
+                    break
+                print('{} Running {}'.format(timestamp(), stage.name))
+
+                # each process needs its own database connection
+                connection.close()
+                process = Process(target=stage.run)
+                process.start()
+                running[stage.name] = (process, stage)
+                pending.remove(stage)
+                used += processes
+
+            if running:
+                time.sleep(self.poll_interval)
+
+        return failed
@@ -1,3 +1,129 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from build.scheduler import BuildStage, BuildScheduler
+from build.job_queue import JobQueue
+
+import os
+import shutil
+import tempfile
+import time
+
+
+class RecordedStage(BuildStage):
+    """Build stage that records when it starts and ends in a log file instead of running a command"""
+
+    def __init__(self, name, log_path, inputs=[], outputs=[], fail=False):
+        super(RecordedStage, self).__init__(name, name, inputs, outputs)
+        self.log_path = log_path
+        self.fail = fail
+
+    def run(self):
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('start {}\n'.format(self.name))
+        time.sleep(0.1)
+        if self.fail:
+            raise Exception('Stage {} failed'.format(self.name))
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('end {}\n'.format(self.name))
+
+
+class BuildSchedulerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.sep.join([self.tmp_dir, 'stages.log'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def scheduler(self, stages, processes=4):
+        scheduler = BuildScheduler(stages, processes)
+        scheduler.checkpoint_file_path = os.sep.join([self.tmp_dir, 'checkpoints.yaml'])
+        scheduler.poll_interval = 0.05
+        return scheduler
+
+    def log(self):
+        with open(self.log_path) as log_file:
+            return log_file.read().split('\n')[:-1]
+
+    def test_dependencies(self):
+        stages = [
+            RecordedStage('proteins', self.log_path, outputs=['proteins']),
+            RecordedStage('links', self.log_path, ['proteins'], ['links']),
+            RecordedStage('ligands', self.log_path, ['proteins'], ['ligands']),
+            RecordedStage('release_notes', self.log_path, ['*']),
+        ]
+        self.scheduler(stages)
+        self.assertEqual(stages[0].requires, set())
+        self.assertEqual(stages[1].requires, set(['proteins']))
+        self.assertEqual(stages[2].requires, set(['proteins']))
+        self.assertEqual(stages[3].requires, set(['proteins', 'links', 'ligands']))
+
+    def test_run_order(self):
+        stages = [
+            RecordedStage('proteins', self.log_path, outputs=['proteins']),
+            RecordedStage('links', self.log_path, ['proteins'], ['links']),
+            RecordedStage('ligands', self.log_path, ['proteins'], ['ligands']),
+            RecordedStage('release_notes', self.log_path, ['*']),
+        ]
+        failed = self.scheduler(stages).run()
+        self.assertEqual(failed, [])
+
+        log = self.log()
+        self.assertEqual(len(log), 8)
+        for stage in stages:
+            for required in stage.requires:
+                self.assertLess(log.index('end {}'.format(required)), log.index('start {}'.format(stage.name)))
+        # independent stages run at the same time
+        self.assertLess(log.index('start links'), log.index('end ligands'))
+        self.assertLess(log.index('start ligands'), log.index('end links'))
+
+    def test_failed_stage(self):
+        stages = [
+            RecordedStage('proteins', self.log_path, outputs=['proteins'], fail=True),
+            RecordedStage('links', self.log_path, ['proteins'], ['links']),
+            RecordedStage('common', self.log_path, outputs=['common']),
+        ]
+        failed = self.scheduler(stages).run()
+        self.assertEqual(sorted(failed), ['links', 'proteins'])
+        self.assertNotIn('start links', self.log())
+        self.assertIn('end common', self.log())
+
+    def test_resume(self):
+        stages = [
+            RecordedStage('proteins', self.log_path, outputs=['proteins']),
+            RecordedStage('links', self.log_path, ['proteins'], ['links'], fail=True),
+        ]
+        self.assertEqual(self.scheduler(stages).run(), ['links'])
+
+        stages[1].fail = False
+        os.remove(self.log_path)
+        self.assertEqual(self.scheduler(stages).run(resume=True), [])
+        self.assertEqual(self.log(), ['start links', 'end links'])
+
+
+def square(item):
+    if item == 'error':
+        raise ValueError('Not a number')
+    if item == 'crash':
+        os._exit(1)
+    return item * item
+
+
+class JobQueueTest(SimpleTestCase):
+
+    def test_results(self):
+        items = list(range(50))
+        results = JobQueue(square, 3).run(items)
+        self.assertEqual([r.result for r in results], [i * i for i in items])
+        self.assertTrue(all([r.error is None for r in results]))
+
+    def test_errors(self):
+        results = JobQueue(square, 2).run([1, 'error', 3, 'crash', 5])
+        self.assertEqual([r.result for r in results], [1, None, 9, None, 25])
+        self.assertIn('ValueError', results[1].error)
+        self.assertIn('crashed', results[3].error)
+        self.assertTrue(all([r.error is None for i, r in enumerate(results) if i not in (1, 3)]))
+
+    def test_no_items(self):
+        self.assertEqual(JobQueue(square, 2).run([]), [])
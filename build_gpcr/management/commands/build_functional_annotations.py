@@ -0,0 +1,5 @@
+from build.management.commands.build_functional_annotations import Command as BuildFunctionalAnnotations
+
+
+class Command(BuildFunctionalAnnotations):
+    pass
\ No newline at end of file
@@ -0,0 +1,41 @@
+from build.management.commands.base_build import Command as BaseBuild
+from build_gpcr.management.commands.build_homology_models import GPCRDBParsingPDB
+
+from structure.models import Structure
+from structure.template_store import TemplateStore, structure_rotamers
+
+import logging
+
+
+class Command(BaseBuild):
+    help = 'Parse the annotated crystal structures once into the template store used by build_homology_models.'
+
+    logger = logging.getLogger('homology_modeling')
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser=parser)
+        parser.add_argument('-s', '--structure',
+            action='append',
+            dest='structure',
+            help='PDB code of structure to store. Can be used multiple times')
+        parser.add_argument('--update',
+            action='store_true',
+            dest='update',
+            default=False,
+            help='Overwrite structures that are already in the store')
+
+    def handle(self, *args, **options):
+        structures = Structure.objects.filter(refined=False, annotated=True).select_related(
+            'protein_conformation__protein', 'pdb_code', 'pdb_data').order_by('pdb_code__index')
+        if options['structure']:
+            structures = structures.filter(pdb_code__index__in=[pdb.upper() for pdb in options['structure']])
+
+        store = TemplateStore()
+        self.structures = [s for s in structures if options['update'] or options['structure'] or not store.exists(s)]
+        self.run_jobs(options['proc'], self.structures, self.store_structure, 'templates')
+        self.logger.info('Finished building the template store')
+
+    def store_structure(self, s):
+        self.logger.info('Storing template {}...'.format(s.pdb_code.index))
+        pdb_array = GPCRDBParsingPDB().pdb_array_creator(structure=s, use_store=False)
+        TemplateStore().save(s, pdb_array, structure_rotamers(s))
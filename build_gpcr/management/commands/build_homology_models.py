@@ -6,6 +6,7 @@ from residue.models import Residue
 from residue.functions import dgn, ggn
 from structure.models import *
 from structure.functions import HSExposureCB, PdbStateIdentifier
+from structure.template_store import TemplateStore
 from common.alignment import AlignedReferenceTemplate
 from common.models import WebLink
 import structure.structural_superposition as sp
@@ -164,7 +165,7 @@ class Command(BaseBuild):
             self.receptor_list_entry_names = self.receptor_list_entry_names[:5]
         print("receptors to do",len(self.receptor_list))
         self.processors = options['proc']
-        self.prepare_input(options['proc'], self.receptor_list)
+        self.run_jobs(options['proc'], self.receptor_list, self.build_model, 'models')
 
         missing_models = []
         with open('./structure/homology_models/done_models.txt') as f:
@@ -192,33 +193,26 @@ class Command(BaseBuild):
             shutil.rmtree('homology_models')
             shutil.rmtree('PIR')
 
-    def main_func(self, positions, iteration, count, lock):
-        processor_id = round(self.processors*positions[0]/len(self.receptor_list))+1
-        i = 0
-        while count.value<len(self.receptor_list):
-            i += 1
-            with lock:
-                receptor = self.receptor_list[count.value]
-                logger.info('Generating model for  \'{}\' ({})... ({} out of {}) (processor:{} count:{})'.format(receptor[0].entry_name, receptor[1],count.value, len(self.receptor_list),processor_id,i))
-                count.value +=1 
-
-            # TODO maybe make check make sense -- since homology_models are deleted, then it doesnt make sense now
-            # check
-            # sm = StructureModel.objects.filter(protein__entry_name=receptor[0].entry_name, state__name=receptor[1]).first()
-            # if sm:
-            #     print('receptor',receptor,'already done',sm)
-            #     main_structure = sm.main_structure.pdb_code.index
-            #     # class_name = 'Class'+class_tree[Protein.objects.get(entry_name=self.reference_entry_name).family.parent.slug[:3]]
-            #     # modelname = '{}_{}_{}_{}_GPCRdb'.format(self.class_name, self.reference_entry_name, self.state, 
-            #     #                          self.main_structure)
-            #     continue
-
-            # then check db
-
-            mod_startTime = datetime.now()
-            self.run_HomologyModeling(receptor[0].entry_name, receptor[1])
-            logger.info('Model finished for  \'{}\' ({})... (processor:{} count:{}) (Time: {})'.format(receptor[0].entry_name, receptor[1],processor_id,i,datetime.now() - mod_startTime))
-        
+    def build_model(self, receptor):
+        logger.info('Generating model for  \'{}\' ({})...'.format(receptor[0].entry_name, receptor[1]))
+
+        # TODO maybe make check make sense -- since homology_models are deleted, then it doesnt make sense now
+        # check
+        # sm = StructureModel.objects.filter(protein__entry_name=receptor[0].entry_name, state__name=receptor[1]).first()
+        # if sm:
+        #     print('receptor',receptor,'already done',sm)
+        #     main_structure = sm.main_structure.pdb_code.index
+        #     # class_name = 'Class'+class_tree[Protein.objects.get(entry_name=self.reference_entry_name).family.parent.slug[:3]]
+        #     # modelname = '{}_{}_{}_{}_GPCRdb'.format(self.class_name, self.reference_entry_name, self.state, 
+        #     #                          self.main_structure)
+        #     continue
+
+        # then check db
+
+        mod_startTime = datetime.now()
+        self.run_HomologyModeling(receptor[0].entry_name, receptor[1])
+        logger.info('Model finished for  \'{}\' ({})... (Time: {})'.format(receptor[0].entry_name, receptor[1],datetime.now() - mod_startTime))
+
     def run_HomologyModeling(self, receptor, state):
         try:
             seq_nums_overwrite_cutoff_dict = {'4PHU':2000, '4LDL':1000, '4LDO':1000, '4QKX':1000, '5JQH':1000, '5TZY':2000}
@@ -3992,8 +3986,30 @@ class GPCRDBParsingPDB(object):
         '''
         output = OrderedDict()
         atoms_list = []
+        store = TemplateStore()
+        use_store = store.exists(structure)
         for gn in generic_numbers:
             rotamer=None
+            if use_store:
+                # rotamers of parsed templates are read from the template store
+                if 'x' in str(gn):
+                    stored = store.rotamer(structure, label=dgn(gn,structure.protein_conformation))
+                else:
+                    stored = store.rotamer(structure, sequence_number=gn)
+                    if just_nums==False and stored and stored[0]:
+                        gn = ggn(stored[0])
+                if stored==None:
+                    raise IndexError('Rotamer {} not found for {}'.format(gn, structure))
+                atoms_list = stored[1]
+                if modify_bulges==True and len(gn)==5:
+                    output[gn.replace('x','.')[:-1]] = atoms_list
+                else:
+                    try:
+                        output[gn.replace('x','.')] = atoms_list
+                    except:
+                        output[str(gn)] = atoms_list
+                atoms_list = []
+                continue
             if 'x' in str(gn):      
                 rotamer = list(Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation, 
                         residue__display_generic_number__label=dgn(gn,structure.protein_conformation), 
@@ -4045,13 +4061,18 @@ class GPCRDBParsingPDB(object):
             output[i] = j
         return output
 
-    def pdb_array_creator(self, structure=None, filename=None):
+    def pdb_array_creator(self, structure=None, filename=None, use_store=True):
         ''' Creates an OrderedDict() from the pdb of a Structure object where residue numbers/generic numbers are 
             keys for the residues, and atom names are keys for the Bio.PDB.Residue objects.
             
             @param structure: Structure, Structure object of protein. When using structure, leave filename=None. \n
-            @param filename: str, filename of pdb to be parsed. When using filename, leave structure=None).
+            @param filename: str, filename of pdb to be parsed. When using filename, leave structure=None). \n
+            @param use_store: boolean, read the structure from the template store if it is there.
         '''
+        if use_store and structure!=None and filename==None:
+            store = TemplateStore()
+            if store.exists(structure):
+                return store.pdb_array(structure, self.segment_coding.values())
         seq_nums_overwrite_cutoff_dict = {'4PHU':2000, '4LDL':1000, '4LDO':1000, '4QKX':1000, '5JQH':1000, '5TZY':2000}
         if structure!=None and filename==None:
             io = StringIO(structure.pdb_data.pdb)
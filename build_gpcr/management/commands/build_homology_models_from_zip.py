@@ -57,7 +57,7 @@ class UploadHomologyModelsToDB():
 		except:
 			pass
 		self.homology_model, created = StructureModel.objects.update_or_create(protein=self.protein_obj, state=state_obj, main_template=main_temp_obj,
-																			   pdb=pdb, version=version)
+																			   defaults={'pdb': pdb, 'version': version})
 
 	def parse_template_stats(self):
 		''' Parse .templates.csv model file
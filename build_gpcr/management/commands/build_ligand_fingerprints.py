@@ -0,0 +1,5 @@
+from build.management.commands.build_ligand_fingerprints import Command as BuildLigandFingerprints
+
+
+class Command(BuildLigandFingerprints):
+    pass
\ No newline at end of file
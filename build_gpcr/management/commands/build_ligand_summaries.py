@@ -0,0 +1,5 @@
+from build.management.commands.build_ligand_summaries import Command as BuildLigandSummaries
+
+
+class Command(BuildLigandSummaries):
+    pass
\ No newline at end of file
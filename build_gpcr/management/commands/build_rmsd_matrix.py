@@ -0,0 +1,5 @@
+from build.management.commands.build_rmsd_matrix import Command as BuildRMSDMatrix
+
+
+class Command(BuildRMSDMatrix):
+    pass
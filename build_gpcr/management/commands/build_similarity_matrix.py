@@ -0,0 +1,5 @@
+from build.management.commands.build_similarity_matrix import Command as BuildSimilarityMatrix
+
+
+class Command(BuildSimilarityMatrix):
+    pass
\ No newline at end of file
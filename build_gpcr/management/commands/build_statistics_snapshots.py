@@ -0,0 +1,5 @@
+from build.management.commands.build_statistics_snapshots import Command as BuildStatisticsSnapshots
+
+
+class Command(BuildStatisticsSnapshots):
+    pass
@@ -1,4 +1,11 @@
 from django.conf import settings
+from django.core.cache import cache
+from django.core.cache import caches
+from django.utils.html import strip_tags
+try:
+    cache_alignment = caches['alignments']
+except:
+    cache_alignment = cache
 
 from common.selection import Selection
 from common.definitions import *
@@ -8,16 +15,49 @@ from residue.models import ResidueGenericNumber, ResidueGenericNumberEquivalent
 from residue.models import ResidueNumberingScheme
 from residue.functions import dgn, ggn
 from structure.models import Structure, Rotamer
+from common.similarity import similarity_store
+from common.models import ReleaseNotes
 
 from collections import OrderedDict
 from copy import deepcopy
 from operator import itemgetter
 from Bio.SubsMat import MatrixInfo
 import logging
+import hashlib
+import json
+import numpy as np
+
+
+# symbols of the array backend of the Alignment class. Code 0 is a gap, the last code collects residues that are not in
+# AMINO_ACIDS
+MATRIX_SYMBOLS = ['-'] + list(AMINO_ACIDS.keys()) + ['X']
+MATRIX_CODES = OrderedDict([(s, i) for i, s in enumerate(MATRIX_SYMBOLS)])
+MATRIX_UNKNOWN = len(MATRIX_SYMBOLS) - 1
+
+
+def substitution_array(matrix):
+    """Convert a Bio.SubsMat matrix to an array indexed by MATRIX_CODES (pairs missing from the matrix score 0)"""
+    scores = np.zeros((len(MATRIX_SYMBOLS), len(MATRIX_SYMBOLS)), dtype=np.float32)
+    for (aa1, aa2), score in matrix.items():
+        if aa1 in MATRIX_CODES and aa2 in MATRIX_CODES:
+            scores[MATRIX_CODES[aa1], MATRIX_CODES[aa2]] = score
+            scores[MATRIX_CODES[aa2], MATRIX_CODES[aa1]] = score
+    scores[0, :] = 0
+    scores[:, 0] = 0
+    return scores
+
+BLOSUM62_ARRAY = substitution_array(MatrixInfo.blosum62)
 
 
 class Alignment:
     """A class representing a protein sequence alignment, with or without a reference sequence"""
+
+    # attributes that are stored in the alignment cache, see load_from_cache
+    cache_attributes = ['segments', 'generic_numbers', 'generic_number_objs', 'positions', 'number_of_residues_total',
+        'matrix', 'matrix_sequence_numbers', 'matrix_display_numbers', 'matrix_columns', 'matrix_generic_number_objs']
+    statistics_cache_attributes = ['consensus', 'forced_consensus', 'full_consensus', 'amino_acids',
+        'amino_acid_stats', 'aa_count', 'aa_count_with_protein', 'features', 'feature_stats']
+
     def __init__(self):
         self.reference = False
         self.proteins = []
@@ -57,6 +97,28 @@ class Alignment:
         # when true, gaps at the beginning or end of a segment have a different symbol than other gaps
         self.show_padding = True
 
+        # maximum number of residues in an alignment
+        self.max_residues = 120000
+
+        # array backend. When true, the aligned sequences are stored as a matrix of amino acid codes (proteins x
+        # positions), and statistics and similarities are calculated from that matrix
+        self.use_matrix = False
+        self.max_matrix_residues = 500000
+        self.matrix = None # amino acid codes, see MATRIX_SYMBOLS
+        self.matrix_sequence_numbers = None
+        self.matrix_display_numbers = None # ids of display generic numbers, -1 for residues without generic numbers
+        self.matrix_columns = [] # (segment, position) of each column
+        self.matrix_generic_number_objs = {}
+
+        # use the precomputed similarity store (see build_similarity_matrix) for similarity calculations when it
+        # covers the selected proteins and segments
+        self.use_similarity_store = False
+
+        # cache the alignment data (not rendered output) under a key of the selection, see cache_key
+        self.use_cache = False
+        self.cache_timeout = 60*60*24*7
+        self.alignment_cache_key = None
+
     def __str__(self):
         return str(self.__dict__)
 
@@ -234,6 +296,20 @@ class Alignment:
 
     def build_alignment(self):
         """Fetch selected residues from DB and build an alignment"""
+        if self.use_cache and self.load_from_cache():
+            return
+
+        if self.use_matrix:
+            check = self.build_matrix()
+        else:
+            check = self.build_residue_alignment()
+
+        if self.use_cache and check != "Too large":
+            self.save_to_cache()
+        return check
+
+    def build_residue_alignment(self):
+        """Fetch selected residues from DB as model instances and build an alignment"""
         # fetch segment residues
         if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
             rs = Residue.objects.filter(
@@ -257,7 +333,7 @@ class Alignment:
                     'display_generic_number__scheme')
 
         self.number_of_residues_total = len(rs)
-        if len(rs)>120000: #300 receptors, 400 residues limit
+        if len(rs)>self.max_residues: #300 receptors, 400 residues limit
             return "Too large"
 
         # create a dict of proteins, segments and residues
@@ -527,15 +603,94 @@ class Alignment:
         self.merge_generic_numbers()
         self.clear_empty_positions()
 
+    def cache_key(self):
+        """Canonical key of the selection: conformations, segments, individually selected positions, numbering
+        schemes and options that change the alignment. The key includes the data release, so that cached alignments
+        are not used after a rebuild"""
+        if self.reference:
+            reference = self.proteins[0].pk
+            pconf_ids = sorted([pc.pk for pc in self.proteins[1:]])
+        else:
+            reference = None
+            pconf_ids = sorted([pc.pk for pc in self.proteins])
+
+        segments = []
+        for segment, positions in self.segments.items():
+            if segment == self.custom_segment_label or self.use_residue_groups:
+                segments.append([segment, sorted(positions)])
+            else:
+                segments.append([segment, []])
+
+        key = [self.__class__.__module__, self.__class__.__name__, ReleaseNotes.current_version(), reference,
+            pconf_ids, sorted(segments), [ns[0] for ns in self.numbering_schemes],
+            self.ignore_alternative_residue_numbering_schemes, self.use_residue_groups, self.use_matrix]
+
+        # rows of the array backend are generated from the matrix, so padding does not change the cached data
+        if not self.use_matrix:
+            key.append(self.show_padding)
+        return 'alignment_' + hashlib.md5(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def load_from_cache(self):
+        """Load a cached alignment built from the same selection, returns False if there is none"""
+        self.alignment_cache_key = self.cache_key()
+        data = cache_alignment.get(self.alignment_cache_key)
+        if data is None:
+            return False
+
+        for attribute in self.cache_attributes:
+            setattr(self, attribute, data[attribute])
+        if self.matrix is not None:
+            for pc in self.proteins:
+                pc.matrix_row = data['rows'][pc.pk]
+            self.update_rows_from_matrix()
+        else:
+            for pc in self.proteins:
+                pc.alignment = data['rows'][pc.pk]
+                pc.alignment_list = list(pc.alignment.values()) # FIXME redundant, remove when dependecies are removed
+        return True
+
+    def save_to_cache(self):
+        # the key is set by load_from_cache, before building changes the segments
+        if not self.alignment_cache_key:
+            return
+        data = {attribute: getattr(self, attribute, None) for attribute in self.cache_attributes}
+        if self.matrix is not None:
+            data['rows'] = {pc.pk: pc.matrix_row for pc in self.proteins}
+        else:
+            data['rows'] = {pc.pk: pc.alignment for pc in self.proteins}
+        cache_alignment.set(self.alignment_cache_key, data, self.cache_timeout)
+
+    def statistics_cache_key(self):
+        # statistics depend on the order of proteins (ties in the consensus) and on filtered proteins (site search)
+        order = ','.join([str(pc.pk) for pc in self.proteins])
+        return self.alignment_cache_key + '_statistics_' + hashlib.md5(order.encode('utf-8')).hexdigest()
+
+    def load_statistics_from_cache(self):
+        if not self.alignment_cache_key:
+            return False
+        data = cache_alignment.get(self.statistics_cache_key())
+        if data is None:
+            return False
+        for attribute in self.statistics_cache_attributes:
+            setattr(self, attribute, data[attribute])
+        return True
+
+    def save_statistics_to_cache(self):
+        if not self.alignment_cache_key:
+            return
+        data = {attribute: getattr(self, attribute) for attribute in self.statistics_cache_attributes}
+        cache_alignment.set(self.statistics_cache_key(), data, self.cache_timeout)
+
     def clear_empty_positions(self):
         """Remove empty columns from the segments and matrix"""
         # segments and  
         # deepcopy is required because the dictionary changes during the loop
         generic_numbers = deepcopy(self.generic_numbers)
+        filled_positions = set(self.positions)
         for ns, segments in generic_numbers.items():
             for segment, positions in segments.items():
                 for pos, dn in positions.items():
-                    if pos not in self.positions:
+                    if pos not in filled_positions:
                         # remove position from generic numbers dict
                         del self.generic_numbers[ns][segment][pos]
                         
@@ -543,14 +698,401 @@ class Alignment:
                         if pos in self.segments[segment]:
                             self.segments[segment].remove(pos)
 
-        # proteins
+        # proteins (rows of the array backend are generated from the matrix, where empty columns are already removed)
+        if self.matrix is not None:
+            return
         proteins = deepcopy(self.proteins) # deepcopy is required because the list changes during the loop
         for i, protein in enumerate(proteins):
             for j, s in protein.alignment.items():
                 for p in s:
-                    if p[0] not in self.positions:
+                    if p[0] not in filled_positions:
                         self.proteins[i].alignment[j].remove(p)
 
+    def build_matrix(self):
+        """Fetch selected residues from DB as plain values and build an alignment matrix (proteins x positions). This
+        is the array backend of build_alignment, the rows of each protein are generated from the matrix"""
+        pconf_ids = [pc.pk for pc in self.proteins]
+        fields = ('protein_conformation_id', 'protein_segment__slug', 'protein_segment__category',
+            'generic_number__label', 'display_generic_number_id', 'amino_acid', 'sequence_number')
+        rs = list(Residue.objects.filter(protein_segment__slug__in=self.segments,
+            protein_conformation__in=pconf_ids).values_list(*fields))
+
+        # fetch individually selected residues (Custom segment)
+        crs = {}
+        for segment in self.segments:
+            if segment == self.custom_segment_label or self.use_residue_groups:
+                crs[segment] = Residue.objects.filter(generic_number__label__in=self.segments[segment],
+                    protein_conformation__in=pconf_ids).values_list(*fields)
+
+        self.number_of_residues_total = len(rs)
+        if len(rs) > self.max_matrix_residues:
+            return "Too large"
+
+        # assign position labels to residues, this follows the same rules as build_alignment
+        proteins = {}
+        segment_counters = {}
+        aligned_residue_encountered = {}
+        for r in rs:
+            pcid, ps, generic_number = r[0], r[1], r[3]
+            if pcid not in proteins:
+                proteins[pcid] = {}
+                segment_counters[pcid] = {}
+                aligned_residue_encountered[pcid] = {}
+            if ps not in proteins[pcid]:
+                proteins[pcid][ps] = {}
+                aligned_residue_encountered[pcid][ps] = False
+
+            if generic_number:
+                proteins[pcid][ps][generic_number] = r
+                aligned_residue_encountered[pcid][ps] = True
+                part_ps = ps
+            else:
+                if ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered[pcid][ps]:
+                    prefix = '00-'
+                    part_ps = ps
+                elif ps in settings.REFERENCE_POSITIONS:
+                    prefix = 'zz-'
+                    part_ps = ps + '_after'
+                else:
+                    prefix = '01-'
+                    part_ps = ps
+            segment_counters[pcid][part_ps] = segment_counters[pcid].get(part_ps, 0) + 1
+            if not generic_number:
+                pos_label = prefix + ps + "-" + str("%04d" % (segment_counters[pcid][part_ps],))
+                proteins[pcid][ps][pos_label] = r
+
+        # correct alignment of split segments
+        for pcid, segments in proteins.items():
+            for ps, positions in segments.items():
+                pos_num = 1
+                pos_num_after = 1
+                for pos_label in sorted(positions):
+                    r = positions[pos_label]
+                    right_align = False
+                    if (pos_label.startswith('01-') and r[2] != 'terminus'
+                        and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)):
+                        right_align = True
+                    elif (pos_label.startswith('00-')
+                        and not aligned_residue_encountered[pcid][ps]
+                        and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)
+                        or r[1] == 'N-term'):
+                        right_align = True
+                    elif pos_label.startswith('01-') and r[1] == 'N-term':
+                        right_align = True
+
+                    if right_align:
+                        updated_index = 'zz' + pos_label[2:]
+                        positions[updated_index] = positions.pop(pos_label)
+                        pos_label = updated_index
+
+                    if pos_label.startswith('zz-'):
+                        segment_label_after = ps + '_after'
+                        if segment_label_after in segment_counters[pcid]:
+                            segment_length = segment_counters[pcid][segment_label_after]
+                            counter = pos_num_after
+                        else:
+                            segment_length = segment_counters[pcid][ps]
+                            counter = pos_num
+                        updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
+                        positions[updated_index] = positions.pop(pos_label)
+                        pos_label = updated_index
+                        pos_num_after += 1
+                    if pos_label not in self.segments[ps]:
+                        self.segments[ps].append(pos_label)
+                    pos_num += 1
+
+        # individually selected residues (Custom segment)
+        for segment, segment_residues in crs.items():
+            for r in segment_residues:
+                proteins.setdefault(r[0], {}).setdefault(segment, {})[r[3]] = r
+
+        # remove split segments from segment list and order segment positions
+        for segment in list(self.segments):
+            if len(segment.split("_")) > 1:
+                del self.segments[segment]
+            else:
+                self.segments[segment] = sorted(self.segments[segment], key=lambda x: x.split('x'))
+
+        # display generic number objects, fetched in one query
+        display_number_ids = set([r[4] for r in rs if r[3] and r[4]])
+        for residues in crs.values():
+            display_number_ids.update([r[4] for r in residues if r[4]])
+        self.matrix_generic_number_objs = {gn.pk: gn for gn in ResidueGenericNumber.objects.filter(
+            pk__in=display_number_ids).select_related('scheme')}
+
+        # display numbers in other numbering schemes of the selected proteins
+        alternative_numbers = {}
+        if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
+            ars = Residue.objects.filter(protein_conformation__in=pconf_ids, generic_number__isnull=False,
+                alternative_generic_numbers__isnull=False).values_list('protein_conformation_id',
+                'generic_number__label', 'alternative_generic_numbers__scheme__slug',
+                'alternative_generic_numbers__label')
+            for pcid, generic_number, scheme_slug, label in ars:
+                alternative_numbers.setdefault((pcid, generic_number), []).append((scheme_slug, label))
+
+        # fill the matrix
+        self.matrix_columns = [(segment, pos) for segment, positions in self.segments.items() for pos in positions]
+        column_index = {c: i for i, c in enumerate(self.matrix_columns)}
+        shape = (len(self.proteins), len(self.matrix_columns))
+        self.matrix = np.zeros(shape, dtype=np.uint8)
+        self.matrix_sequence_numbers = np.zeros(shape, dtype=np.int32)
+        self.matrix_display_numbers = np.full(shape, -1, dtype=np.int32)
+        rows, columns, codes, sequence_numbers, display_numbers = [], [], [], [], []
+        for i, pc in enumerate(self.proteins):
+            pc.matrix_row = i
+            ns_slug = pc.protein.residue_numbering_scheme.slug
+            if pc.pk not in proteins:
+                continue
+            for segment, positions in proteins[pc.pk].items():
+                if segment not in self.segments:
+                    continue
+                for pos, r in positions.items():
+                    rows.append(i)
+                    columns.append(column_index[(segment, pos)])
+                    codes.append(MATRIX_CODES.get(r[5], MATRIX_UNKNOWN))
+                    sequence_numbers.append(r[6])
+                    display_numbers.append(r[4] if r[3] and r[4] else -1)
+
+                    # add display number to list of display numbers for this position
+                    segment_numbers = self.generic_numbers[ns_slug][segment]
+                    if pos not in segment_numbers:
+                        segment_numbers[pos] = []
+                    if r[3] and r[4] in self.matrix_generic_number_objs:
+                        display_number = self.matrix_generic_number_objs[r[4]]
+                        if display_number.label not in segment_numbers[pos]:
+                            segment_numbers[pos].append(display_number.label)
+                        if pos not in self.generic_number_objs:
+                            self.generic_number_objs[pos] = display_number
+
+                    # add display numbers for other numbering schemes of selected proteins
+                    if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
+                        for ns in self.numbering_schemes:
+                            if ns[0] != ns_slug and pos not in self.generic_numbers[ns[0]][segment]:
+                                self.generic_numbers[ns[0]][segment][pos] = []
+                        for scheme_slug, label in alternative_numbers.get((pc.pk, r[3]), []):
+                            if (scheme_slug != ns_slug and scheme_slug in self.generic_numbers
+                                and label not in self.generic_numbers[scheme_slug][segment][pos]):
+                                self.generic_numbers[scheme_slug][segment][pos].append(label)
+        self.matrix[rows, columns] = codes
+        self.matrix_sequence_numbers[rows, columns] = sequence_numbers
+        self.matrix_display_numbers[rows, columns] = display_numbers
+
+        # remove empty columns
+        filled = (self.matrix != 0).any(axis=0)
+        self.matrix = self.matrix[:, filled]
+        self.matrix_sequence_numbers = self.matrix_sequence_numbers[:, filled]
+        self.matrix_display_numbers = self.matrix_display_numbers[:, filled]
+        self.matrix_columns = [c for c, f in zip(self.matrix_columns, filled.tolist()) if f]
+        self.positions = [c[1] for c in self.matrix_columns]
+
+        self.sort_generic_numbers()
+        self.merge_generic_numbers()
+        self.clear_empty_positions()
+        self.update_rows_from_matrix()
+
+    def update_rows_from_matrix(self):
+        """Generate the alignment rows of each protein (as used by templates) from the alignment matrix"""
+        if self.show_padding:
+            padding_symbol = '_'
+        else:
+            padding_symbol = '-'
+
+        # column ranges of each segment
+        segment_ranges = OrderedDict()
+        for k, (segment, pos) in enumerate(self.matrix_columns):
+            if segment not in segment_ranges:
+                segment_ranges[segment] = [k, k + 1]
+            else:
+                segment_ranges[segment][1] = k + 1
+        for segment in self.segments:
+            if segment not in segment_ranges:
+                segment_ranges[segment] = [0, 0]
+
+        for pc in self.proteins:
+            codes = self.matrix[pc.matrix_row].tolist()
+            sequence_numbers = self.matrix_sequence_numbers[pc.matrix_row].tolist()
+            display_numbers = self.matrix_display_numbers[pc.matrix_row].tolist()
+            row = OrderedDict()
+            for segment in self.segments:
+                start, end = segment_ranges[segment]
+                filled = [k for k in range(start, end) if codes[k]]
+                if filled:
+                    first, last = filled[0], filled[-1]
+                else:
+                    first, last = end, end
+                s = []
+                for k in range(start, end):
+                    pos = self.matrix_columns[k][1]
+                    if codes[k]:
+                        if display_numbers[k] in self.matrix_generic_number_objs:
+                            display_number = self.matrix_generic_number_objs[display_numbers[k]]
+                            s.append([pos, display_number.label, MATRIX_SYMBOLS[codes[k]],
+                                display_number.scheme.short_name, sequence_numbers[k], pos])
+                        else:
+                            s.append([pos, "", MATRIX_SYMBOLS[codes[k]], "", sequence_numbers[k]])
+                    elif first < k < last:
+                        s.append([pos, False, '-', 0])
+                    else:
+                        s.append([pos, False, padding_symbol, 0])
+                row[segment] = s
+            pc.alignment = row
+            pc.alignment_list = list(row.values()) # FIXME redundant, remove when dependecies are removed
+
+    def matrix_rows(self):
+        """Matrix row indices of the proteins, in the current order of the protein list"""
+        return np.array([pc.matrix_row for pc in self.proteins], dtype=np.intp)
+
+    def matrix_similarity(self, rows_1, rows_2, block_size=200):
+        """Calculate identity, similarity, similarity score and number of compared columns for every pair of matrix
+        rows in rows_1 x rows_2. Returns four arrays of shape (len(rows_1), len(rows_2))"""
+        num_symbols = len(MATRIX_SYMBOLS)
+        num_columns = self.matrix.shape[1]
+        positive = (BLOSUM62_ARRAY > 0).astype(np.float32)
+
+        # one-hot encoding of the second set of rows, gaps are all zero
+        m2 = self.matrix[rows_2]
+        one_hot_2 = np.eye(num_symbols, dtype=np.float32)[m2]
+        one_hot_2[:, :, 0] = 0
+        one_hot_2 = one_hot_2.reshape(len(rows_2), -1).T
+        gaps_2 = (m2 == 0).astype(np.float32)
+
+        shape = (len(rows_1), len(rows_2))
+        identities = np.zeros(shape, dtype=np.int64)
+        similarities = np.zeros(shape, dtype=np.int64)
+        scores = np.zeros(shape, dtype=np.int64)
+        lengths = np.zeros(shape, dtype=np.int64)
+        for start in range(0, len(rows_1), block_size):
+            m1 = self.matrix[rows_1[start:start + block_size]]
+            one_hot_1 = np.eye(num_symbols, dtype=np.float32)[m1]
+            one_hot_1[:, :, 0] = 0
+            block = slice(start, start + len(m1))
+            identities[block] = np.rint(one_hot_1.reshape(len(m1), -1) @ one_hot_2)
+            similarities[block] = np.rint((one_hot_1 @ positive).reshape(len(m1), -1) @ one_hot_2)
+            scores[block] = np.rint((one_hot_1 @ BLOSUM62_ARRAY).reshape(len(m1), -1) @ one_hot_2)
+            # columns where at least one of the two is not gapped
+            lengths[block] = num_columns - np.rint((m1 == 0).astype(np.float32) @ gaps_2.T)
+        return identities, similarities, scores, lengths
+
+    def calculate_statistics_from_matrix(self):
+        """Calculate consesus sequence and amino acid and feature frequency from the alignment matrix"""
+        self.amino_acids = list(AMINO_ACIDS.keys())
+        self.features = list(AMINO_ACID_GROUP_NAMES.values())
+        num_proteins = len(self.proteins)
+        if not num_proteins:
+            return
+        m = self.matrix[self.matrix_rows()]
+        num_symbols = len(MATRIX_SYMBOLS)
+        num_columns = m.shape[1]
+
+        # amino acid counts per column (columns x amino acids), gaps and unknown residues are not counted
+        flat = m.astype(np.int64) + np.arange(num_columns, dtype=np.int64) * num_symbols
+        counts = np.bincount(flat.ravel(), minlength=num_columns * num_symbols).reshape(num_columns, num_symbols)
+        counts = counts[:, 1:len(AMINO_ACIDS) + 1]
+
+        # feature counts per column (columns x features)
+        feature_members = np.array([[aa in members for members in AMINO_ACID_GROUPS.values()] for aa in AMINO_ACIDS],
+            dtype=np.int64)
+        feature_counts = counts @ feature_members
+
+        # most frequent amino acids. Ties are ordered by the protein where each amino acid reached the top count
+        max_counts = counts.max(axis=1)
+        tied = counts == max_counts[:, None]
+        first_rows = np.argmax(m != 0, axis=0)
+
+        entry_names = np.array([pc.protein.entry_name for pc in self.proteins], dtype=object)
+        amino_acid_list = list(AMINO_ACIDS.keys())
+        feature_list = list(AMINO_ACID_GROUPS.keys())
+        counts_list = counts.tolist()
+        feature_counts_list = feature_counts.tolist()
+
+        feature_count = OrderedDict()
+        most_freq_aa = OrderedDict()
+        segment_columns = OrderedDict([(segment, []) for segment in self.segments])
+        for k, (segment, pos) in enumerate(self.matrix_columns):
+            if max_counts[k]:
+                segment_columns[segment].append(k)
+        for segment, columns in segment_columns.items():
+            self.aa_count[segment] = OrderedDict()
+            feature_count[segment] = OrderedDict()
+            most_freq_aa[segment] = OrderedDict()
+            for k in sorted(columns, key=lambda x: (first_rows[x], x)):
+                pos = self.matrix_columns[k][1]
+                self.aa_count[segment][pos] = OrderedDict(zip(amino_acid_list, counts_list[k]))
+                feature_count[segment][pos] = OrderedDict(zip(feature_list, feature_counts_list[k]))
+
+                top = [amino_acid_list[a] for a in np.nonzero(tied[k])[0]]
+                if len(top) > 1:
+                    top.sort(key=lambda aa: np.nonzero(m[:, k] == MATRIX_CODES[aa])[0][max_counts[k] - 1])
+                most_freq_aa[segment][pos] = [top, int(max_counts[k])]
+
+                if pos in self.generic_number_objs:
+                    self.aa_count_with_protein[pos] = OrderedDict()
+                    column = m[:, k]
+                    codes, first_index = np.unique(column, return_index=True)
+                    for code in codes[np.argsort(first_index)]:
+                        if code and code != MATRIX_UNKNOWN:
+                            names = OrderedDict.fromkeys(entry_names[column == code].tolist())
+                            self.aa_count_with_protein[pos][MATRIX_SYMBOLS[code]] = list(names)
+
+        self.update_statistics(most_freq_aa, feature_count)
+
+    def update_statistics(self, most_freq_aa, feature_count):
+        """Merge the amino acid counts into a consensus sequence, and format amino acid and feature frequencies"""
+        num_proteins = len(self.proteins)
+        sequence_counter = 1
+        for i, s in most_freq_aa.items():
+            self.consensus[i] = OrderedDict()
+            self.forced_consensus[i] = OrderedDict()
+            for p in self.sort_positions(i, s):
+                r = s[p]
+                conservation = str(round(r[1]/num_proteins*100))
+                cons_interval = self.frequency_interval(conservation)
+
+                # forced consensus sequence uses the first residue to break ties
+                self.forced_consensus[i][p] = r[0][0]
+
+                # consensus sequence displays + in tie situations
+                if len(r[0]) == 1:
+                    self.consensus[i][p] = [r[0][0], cons_interval, r[0][0] + ' ' + conservation + '%']
+                else:
+                    self.consensus[i][p] = ['+', cons_interval, '/'.join(r[0]) + ' ' + conservation + '%']
+
+                # create a residue object full consensus
+                res = Residue()
+                res.sequence_number = sequence_counter
+                if p in self.generic_number_objs:
+                    res.display_generic_number = self.generic_number_objs[p]
+                res.family_generic_number = p
+                res.segment_slug = i
+                res.amino_acid = r[0][0]
+                res.frequency = self.consensus[i][p][2]
+                self.full_consensus.append(res)
+                sequence_counter += 1
+
+        # process amino acid and feature frequency
+        for stats, keys, counts in [(self.amino_acid_stats, AMINO_ACIDS, self.aa_count),
+            (self.feature_stats, AMINO_ACID_GROUPS, feature_count)]:
+            for key in keys:
+                key_stats = []
+                for segment, segment_num in counts.items():
+                    segment_stats = []
+                    for gn in self.sort_positions(segment, segment_num):
+                        frequency = str(round(segment_num[gn][key]/num_proteins*100))
+                        segment_stats.append([frequency, self.frequency_interval(frequency)])
+                    key_stats.append(segment_stats)
+                stats.append(key_stats)
+
+    def sort_positions(self, segment, positions):
+        if segment == self.custom_segment_label:
+            return sorted(positions, key=lambda x: (x.split("x")[0], x.split("x")[1]))
+        return sorted(positions)
+
+    def frequency_interval(self, frequency):
+        """The intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors."""
+        if len(frequency) == 1:
+            return '0'
+        return frequency[:-1]
+
     def merge_generic_numbers(self):
         """Check whether there are many display numbers for each position, and merge them if there are"""
         # deepcopy is required because the dictionary changes during the loop
@@ -584,6 +1126,19 @@ class Alignment:
 
     def calculate_statistics(self):
         """Calculate consesus sequence and amino acid and feature frequency"""
+        if self.use_cache and self.load_statistics_from_cache():
+            return
+
+        if self.matrix is not None:
+            self.calculate_statistics_from_matrix()
+        else:
+            self.calculate_residue_statistics()
+
+        if self.use_cache:
+            self.save_statistics_to_cache()
+
+    def calculate_residue_statistics(self):
+        """Calculate consesus sequence and amino acid and feature frequency from the alignment rows"""
         feature_count = OrderedDict()
         most_freq_aa = OrderedDict()
         amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
@@ -635,103 +1190,8 @@ class Alignment:
                         if amino_acid not in most_freq_aa[j][generic_number][0]:
                             most_freq_aa[j][generic_number][0].append(amino_acid)
 
-        # merge the amino acid counts into a consensus sequence
-        num_proteins = len(self.proteins)
-        sequence_counter = 1
-        for i, s in most_freq_aa.items():
-            self.consensus[i] = OrderedDict()
-            self.forced_consensus[i] = OrderedDict()
-            if i=='Custom':
-                sorted_res = sorted(s, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-            else:
-                sorted_res = sorted(s)
-            for p in sorted_res:
-                r = s[p]
-                conservation = str(round(r[1]/num_proteins*100))
-                if len(conservation) == 1:
-                    cons_interval = '0'
-                else:
-                    # the intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc. Used for colors.
-                    cons_interval = conservation[:-1]
-                
-
-                # forced consensus sequence uses the first residue to break ties
-                self.forced_consensus[i][p] = r[0][0]
-
-                # consensus sequence displays + in tie situations
-                num_freq_aa = len(r[0])
-                if num_freq_aa == 1:
-                    self.consensus[i][p] = [r[0][0], cons_interval,
-                    r[0][0] + ' ' + str(round(r[1]/num_proteins*100)) + '%']
-                elif num_freq_aa > 1:
-                    self.consensus[i][p] = ['+', cons_interval,
-                    '/'.join(r[0]) + ' ' + str(round(r[1]/num_proteins*100)) + '%']
-
-                # create a residue object full consensus
-                res = Residue()
-                res.sequence_number = sequence_counter
-                if p in self.generic_number_objs:
-                    res.display_generic_number = self.generic_number_objs[p]
-                res.family_generic_number = p
-                res.segment_slug = i
-                res.amino_acid = r[0][0]
-                res.frequency = self.consensus[i][p][2]
-                self.full_consensus.append(res)
-
-                # update sequence counter
-                sequence_counter += 1
-
-        # process amino acid frequency
-        for i, amino_acid in enumerate(AMINO_ACIDS):
-            self.amino_acid_stats.append([])
-            j = 0
-            for segment, segment_num in self.aa_count.items():
-                self.amino_acid_stats[i].append([])
-                k = 0
-                if segment=='Custom':
-                    sorted_res = sorted(segment_num, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                else:
-                    sorted_res = sorted(segment_num)
-                for gn in sorted_res:
-                    aas = segment_num[gn]
-                    self.amino_acid_stats[i][j].append([])
-                    for aa, freq in aas.items():
-                        if aa == amino_acid:
-                            frequency = str(round(freq/num_proteins*100))
-                            if len(frequency) == 1:
-                                freq_interval = '0'
-                            else:
-                                # intervals defined in the same way as for the consensus sequence
-                                freq_interval = frequency[:-1]
-                            self.amino_acid_stats[i][j][k] = [frequency, freq_interval]
-                    k += 1
-                j += 1
-
-        # process feature frequency
-        for i, feature in enumerate(AMINO_ACID_GROUPS):
-            self.feature_stats.append([])
-            j = 0
-            for segment, segment_num in feature_count.items():
-                self.feature_stats[i].append([])
-                k = 0
-                if segment=='Custom':
-                    sorted_res = sorted(segment_num, key=lambda x: (x.split("x")[0], x.split("x")[1]))
-                else:
-                    sorted_res = sorted(segment_num)
-                for gn in sorted_res:
-                    fs = segment_num[gn]
-                    self.feature_stats[i][j].append([])
-                    for f, freq in fs.items():
-                        if f == feature:
-                            frequency = str(round(freq/num_proteins*100))
-                            if len(frequency) == 1:
-                                freq_interval = '0'
-                            else:
-                                # intervals defined in the same way as for the consensus sequence
-                                freq_interval = frequency[:-1]
-                            self.feature_stats[i][j][k] = [frequency, freq_interval]
-                    k += 1
-                j += 1
+        # merge the amino acid counts into a consensus sequence and format frequencies
+        self.update_statistics(most_freq_aa, feature_count)
 
     def calculate_aa_count_per_generic_number(self):
         ''' Small function to return a dictionary of display_generic_number and the frequency of each AA '''
@@ -750,13 +1210,18 @@ class Alignment:
 
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference"""
+        if self.use_similarity_store and self.similarity_store_covers():
+            return self.calculate_similarity_from_store(normalized)
+
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
             if i == 0:
                 continue
 
             # calculate identity, similarity and similarity score to the reference
-            if not normalized:
+            if not normalized and self.matrix is not None:
+                continue
+            elif not normalized:
                 calc_values = self.pairwise_similarity(self.proteins[0], self.proteins[i])
                 # update the protein
                 if calc_values:
@@ -766,6 +1231,16 @@ class Alignment:
             else:
                 self.pairwise_similarity_normalized(self.proteins[0], self.proteins[i])
 
+        # with the array backend, all proteins are compared to the reference at once
+        if not normalized and self.matrix is not None and len(self.proteins) > 1:
+            rows = self.matrix_rows()
+            identities, similarities, scores, lengths = [v[0] for v in self.matrix_similarity(rows[:1], rows[1:])]
+            for i, protein in enumerate(self.proteins[1:]):
+                if lengths[i]:
+                    protein.identity = "{:10.0f}".format(identities[i] / lengths[i] * 100)
+                    protein.similarity = "{:10.0f}".format(similarities[i] / lengths[i] * 100)
+                    protein.similarity_score = int(scores[i])
+
         # calculate normalized identity, similarity and similarity score, removes columns where reference is gapped, gaps in templates are removed from the specific pairwise alignment
         if normalized:
             i = 1
@@ -785,7 +1260,10 @@ class Alignment:
                 self.proteins[i].similarity_score = similarity_score
                 i+=1
             
-        # order protein list by similarity score
+        self.order_proteins_by_similarity()
+
+    def order_proteins_by_similarity(self):
+        """Order protein list by similarity score, the reference stays first"""
         ref = self.proteins.pop(0)
         order_by_value = int(getattr(self.proteins[0], self.order_by))
         if order_by_value:
@@ -795,6 +1273,13 @@ class Alignment:
     def calculate_similarity_matrix(self):
         """Calculate a matrix of sequence identity/similarity for every selected protein"""
         self.similarity_matrix = OrderedDict()
+        if self.use_similarity_store and self.similarity_store_covers():
+            rows = [pc.protein_id for pc in self.proteins]
+            identities, similarities, scores = similarity_store.similarity(rows, rows, self.similarity_store_segments())
+            return self.update_similarity_matrix(np.nan_to_num(identities), np.nan_to_num(similarities))
+        elif self.matrix is not None:
+            return self.calculate_similarity_matrix_from_matrix()
+
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
@@ -818,6 +1303,58 @@ class Alignment:
                         color_class = str(value)[:-1]
                 self.similarity_matrix[protein_key]['values'].append([value, color_class])
 
+    def calculate_similarity_matrix_from_matrix(self):
+        """Calculate the similarity matrix from the alignment matrix. Identities are shown above the diagonal,
+        similarities below it"""
+        rows = self.matrix_rows()
+        identities, similarities, scores, lengths = self.matrix_similarity(rows, rows)
+        lengths[lengths == 0] = 1
+        self.update_similarity_matrix(identities / lengths * 100, similarities / lengths * 100)
+
+    def update_similarity_matrix(self, identities, similarities):
+        """Format matrices of identity and similarity percentages (in protein list order) as the similarity matrix"""
+        identities = identities.tolist()
+        similarities = similarities.tolist()
+        for i, protein in enumerate(self.proteins):
+            protein_key = protein.protein.entry_name
+            protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
+            self.similarity_matrix[protein_key] = {'name': protein_name, 'values': []}
+            for k in range(len(self.proteins)):
+                if k == i:
+                    self.similarity_matrix[protein_key]['values'].append(['-', '-'])
+                    continue
+                elif k < i:
+                    value = "{:10.0f}".format(similarities[i][k]).strip()
+                else:
+                    value = "{:10.0f}".format(identities[i][k]).strip()
+                if int(value) < 10:
+                    color_class = 0
+                else:
+                    color_class = str(value)[:-1]
+                self.similarity_matrix[protein_key]['values'].append([value, color_class])
+
+    def similarity_store_segments(self):
+        # split segments (e.g. ECL2_before) are not part of alignments, see build_alignment
+        return [s for s in self.segments if len(s.split("_")) == 1]
+
+    def similarity_store_covers(self):
+        """Check whether the precomputed similarity store has all selected proteins and segments"""
+        if self.use_residue_groups or self.custom_segment_label in self.segments or not self.proteins:
+            return False
+        return similarity_store.covers([pc.protein_id for pc in self.proteins], self.similarity_store_segments())
+
+    def calculate_similarity_from_store(self, normalized=False):
+        """Set identity, similarity and similarity score to the reference from the precomputed similarity store"""
+        identities, similarities, scores = [v[0] for v in similarity_store.similarity(
+            [self.proteins[0].protein_id], [pc.protein_id for pc in self.proteins[1:]],
+            self.similarity_store_segments(), normalized)]
+        for i, protein in enumerate(self.proteins[1:]):
+            if not np.isnan(identities[i]):
+                protein.identity = "{:10.0f}".format(identities[i])
+                protein.similarity = "{:10.0f}".format(similarities[i])
+                protein.similarity_score = int(scores[i])
+        self.order_proteins_by_similarity()
+
     def evaluate_sites(self, request):
         """Evaluate which user selected site definitions match each protein sequence"""
         # get simple selection from session
@@ -878,6 +1415,15 @@ class Alignment:
 
     def pairwise_similarity(self, protein_1, protein_2):
         """Calculate the identity, similarity and similarity score between a pair of proteins"""
+        if self.matrix is not None and hasattr(protein_1, 'matrix_row') and hasattr(protein_2, 'matrix_row'):
+            identities, similarities, scores, lengths = [v[0][0] for v in self.matrix_similarity(
+                [protein_1.matrix_row], [protein_2.matrix_row])]
+            if not lengths:
+                return False
+            identity = "{:10.0f}".format(identities / lengths * 100)
+            similarity = "{:10.0f}".format(similarities / lengths * 100)
+            return identity, similarity, int(scores)
+
         identities = []
         similarities = []
         similarity_scores = []
@@ -960,6 +1506,23 @@ class Alignment:
         else:
             return matrix[pair]
 
+    def csv_rows(self):
+        """Rows of the alignment as CSV (see common.export): segments, generic numbers, one row per protein (with
+        identity and similarity to the reference, if any) and the consensus sequence"""
+        reference_columns = ['', '', ''] if self.reference else []
+        yield [''] + reference_columns + [s if i == 0 else '' for s, num in self.segments.items()
+            for i, n in enumerate(num)]
+        yield [''] + reference_columns + [strip_tags(dn) for ns, segments in self.generic_numbers.items()
+            for s, num in segments.items() for n, dn in num.items()]
+        for i, p in enumerate(self.proteins):
+            row = ['[{}] {}'.format(p.protein.species.common_name, strip_tags(p.protein.name))]
+            if self.reference:
+                row += ['%I', '%S', 'S'] if i == 0 else [p.identity, p.similarity, p.similarity_score]
+            yield row + [r[2] for segment, s in p.alignment.items() for r in s]
+        if self.consensus:
+            yield ['CONSENSUS'] + reference_columns + [r[0] for segment, s in self.consensus.items()
+                for p, r in s.items()]
+
 
 class AlignedReferenceTemplate(Alignment):
     ''' Creates a structure based alignment between reference protein and target proteins that are made up from the 
@@ -981,6 +1544,7 @@ class AlignedReferenceTemplate(Alignment):
         self.loop_partial_except_list = {'ICL1':[],'ECL1':[],'ICL2':[],'ECL2':[],'ECL2_1':['3UZA','3UZC','3RFM'],
                                          'ECL2_mid':[],'ECL2_2':[],'ICL3':['3VW7'],'ECL3':[],'ICL4':[]}
         self.seq_nums_overwrite_cutoff_dict = {'4PHU':2000, '4LDL':1000, '4LDO':1000, '4QKX':1000, '5JQH':1000, '5TZY':2000}
+        self.use_similarity_store = True
         
     def run_hommod_alignment(self, reference_protein, segments, query_states, order_by, provide_main_template_structure=None,
                              provide_similarity_table=None, main_pdb_array=None, provide_alignment=None, only_output_alignment=None, complex_model=False):
@@ -1466,11 +2030,13 @@ class ClosestReceptorHomolog():
         else:
             structures = Structure.objects.filter(protein_conformation__protein__parent__family__slug__istartswith=self.family_mapping[p.family.slug[:3]]).exclude(
                                                   annotated=False).exclude(refined=True).exclude(protein_conformation__protein__parent__entry_name__in=exclusion_list)
+        a.use_similarity_store = True
         a.load_reference_protein(p)
         structure_proteins = [i.protein_conformation.protein.parent for i in list(structures)]
         a.load_proteins(structure_proteins)
         a.load_segments(ProteinSegment.objects.filter(slug__in=self.protein_segments))
-        a.build_alignment()
+        if not a.similarity_store_covers():
+            a.build_alignment()
         a.calculate_similarity(normalized=self.normalized)
         self.all_proteins = a.proteins
         max_sim, max_id, max_i = 0, 0, 1
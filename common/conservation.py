@@ -0,0 +1,164 @@
+from django.conf import settings
+
+from common.alignment import MATRIX_SYMBOLS, MATRIX_CODES, MATRIX_UNKNOWN
+from common.definitions import AMINO_ACIDS
+from protein.models import Protein, ProteinSegment
+from residue.models import Residue
+
+from collections import OrderedDict
+import os
+import json
+import numpy as np
+
+
+class ConservationStore:
+    """Residues of all wt receptors at the generic number positions of the reference segments, used to calculate the
+    amino acid conservation of any family or set of receptors. Built by build_consensus_sequences.
+
+    The store is a matrix of shape (proteins x generic numbers) of amino acid codes (see MATRIX_SYMBOLS, 0 is a gap).
+    The amino acid counts of a family are the sums of the one-hot rows of its receptors, so no alignments have to be
+    built or stored."""
+
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'conservation'])
+    index_file = 'index.json'
+
+    def __init__(self, store_dir=None):
+        if store_dir:
+            self.store_dir = store_dir
+        self.index_path = os.sep.join([self.store_dir, self.index_file])
+        self.loaded_mtime = None
+        self.protein_rows = {}
+        self.families = []
+        self.reference = None
+        self.generic_numbers = []
+        self.residues = None
+
+    def load(self):
+        """Read the store, reloading it if the store has been rebuilt. Returns False if there is no store"""
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            self.loaded_mtime = None
+            return False
+        if mtime == self.loaded_mtime:
+            return True
+
+        with open(self.index_path) as index_file:
+            index = json.load(index_file)
+        self.protein_rows = {protein_id: i for i, protein_id in enumerate(index['proteins'])}
+        self.families = index['families']
+        self.reference = np.array(index['reference'], dtype=bool)
+        self.generic_numbers = index['generic_numbers']
+        self.residues = np.load(self.residues_path(index['build']), mmap_mode='r')
+        self.loaded_mtime = mtime
+        return True
+
+    def residues_path(self, build):
+        return os.sep.join([self.store_dir, 'residues.{}.npy'.format(build)])
+
+    def covers(self, protein_ids):
+        """Check whether all proteins are in the store"""
+        if not self.load():
+            return False
+        return all([protein_id in self.protein_rows for protein_id in protein_ids])
+
+    def family_rows(self, slug):
+        """Rows of the human SWISSPROT receptors of a family (or class, or receptor family)"""
+        return [i for i, family in enumerate(self.families) if family.startswith(slug) and self.reference[i]]
+
+    def conservation(self, protein_ids=None, slug=None):
+        """Conservation of the receptors of a family (by slug) or a list of receptors, see calculate_conservation"""
+        self.load()
+        if slug is not None:
+            rows = self.family_rows(slug)
+        else:
+            rows = sorted(set([self.protein_rows[p] for p in protein_ids]))
+        return calculate_conservation(self.residues[rows], self.generic_numbers)
+
+    def save(self, protein_ids, families, reference, generic_numbers, residues, build):
+        """Write the residues and the index, and remove files of older builds"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        np.save(self.residues_path(build), residues)
+
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_index_path, 'w') as index_file:
+            json.dump({'build': build, 'proteins': [int(p) for p in protein_ids], 'families': families,
+                'reference': [bool(r) for r in reference], 'generic_numbers': generic_numbers}, index_file)
+        os.replace(tmp_index_path, self.index_path)
+
+        current_file = os.path.basename(self.residues_path(build))
+        for file_name in os.listdir(self.store_dir):
+            if file_name.endswith('.npy') and file_name != current_file:
+                os.remove(os.sep.join([self.store_dir, file_name]))
+
+
+def conservation_generic_numbers():
+    """Generic numbers of the reference segments (TM1-7, loops and H8), in segment order"""
+    segments = list(ProteinSegment.objects.filter(slug__in=list(settings.REFERENCE_POSITIONS.keys())).values_list(
+        'slug', flat=True))
+    labels = {segment: set() for segment in segments}
+    for segment, label in Residue.objects.filter(protein_segment__slug__in=segments,
+        generic_number__isnull=False).values_list('protein_segment__slug', 'generic_number__label').distinct():
+        if 'x' in label:
+            labels[segment].add(label)
+    return [label for segment in segments for label in sorted(labels[segment])]
+
+
+def residue_codes(protein_ids, generic_numbers):
+    """Matrix of amino acid codes (proteins x generic numbers) of proteins, read from the database"""
+    protein_rows = {protein_id: i for i, protein_id in enumerate(protein_ids)}
+    columns = {label: i for i, label in enumerate(generic_numbers)}
+    residues = np.zeros((len(protein_rows), len(columns)), dtype=np.uint8)
+    for protein_id, label, amino_acid in Residue.objects.filter(
+        protein_conformation__protein__in=list(protein_rows), generic_number__label__in=list(columns)).values_list(
+        'protein_conformation__protein', 'generic_number__label', 'amino_acid').iterator():
+        residues[protein_rows[protein_id], columns[label]] = MATRIX_CODES.get(amino_acid, MATRIX_UNKNOWN)
+    return residues
+
+
+def calculate_conservation(residues, generic_numbers):
+    """Dictionary of generic number: [consensus amino acid (+ for ties), conservation interval (0-10), {amino acid:
+    (count, fraction)}] of a matrix of amino acid codes. Positions without residues are left out"""
+    num_proteins, num_columns = residues.shape
+    consensus = OrderedDict()
+    if not num_proteins:
+        return consensus
+
+    # amino acid counts per column (columns x amino acids), gaps and unknown residues are not counted
+    num_symbols = len(MATRIX_SYMBOLS)
+    flat = residues.astype(np.int64) + np.arange(num_columns, dtype=np.int64) * num_symbols
+    counts = np.bincount(flat.ravel(), minlength=num_columns * num_symbols).reshape(num_columns, num_symbols)
+    counts = counts[:, 1:len(AMINO_ACIDS) + 1]
+    max_counts = counts.max(axis=1)
+
+    amino_acids = list(AMINO_ACIDS.keys())
+    for k in np.nonzero(max_counts)[0]:
+        present = np.nonzero(counts[k])[0]
+        top = [amino_acids[a] for a in present if counts[k, a] == max_counts[k]]
+        consensus_aa = top[0] if len(top) == 1 else '+'
+        interval = str(int(round(max_counts[k] / num_proteins * 100)) // 10)
+        aa_count = OrderedDict([(amino_acids[a], (int(counts[k, a]), round(float(counts[k, a]) / num_proteins, 3)))
+            for a in present])
+        consensus[generic_numbers[k]] = [consensus_aa, interval, aa_count]
+    return consensus
+
+
+def get_conservation(proteins=None, slug=None):
+    """Conservation of the human SWISSPROT receptors of a family (by slug), or of a list of proteins. Uses the
+    conservation store, and falls back to the residues in the database for proteins that are not in the store"""
+    store = conservation_store
+    if slug is not None:
+        if store.load():
+            return store.conservation(slug=slug)
+        proteins = Protein.objects.filter(family__slug__startswith=slug, source__name='SWISSPROT',
+            species__common_name='Human')
+
+    protein_ids = list(OrderedDict.fromkeys([p.pk for p in proteins]))
+    if store.covers(protein_ids):
+        return store.conservation(protein_ids=protein_ids)
+    generic_numbers = conservation_generic_numbers()
+    return calculate_conservation(residue_codes(protein_ids, generic_numbers), generic_numbers)
+
+
+# shared store instance, the index is reloaded when the store is rebuilt
+conservation_store = ConservationStore()
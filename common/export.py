@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+import csv
+import datetime
+import json
+import os
+import tempfile
+import time
+import xlsxwriter
+
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# content type and file extension of each export format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'json': ('application/x-ndjson', 'json'),
+    'xlsx': (XLSX_CONTENT_TYPE, 'xlsx'),
+}
+
+# size of the chunks a file is streamed in (in bytes)
+CHUNK_SIZE = 64 * 1024
+
+# exported workbooks that are kept for a later download are removed after this time (in seconds)
+EXPORT_FILE_LIFETIME = 3600
+
+
+class Echo:
+    """File-like object that returns what is written to it, used to get the lines of a csv writer one by one"""
+    def write(self, value):
+        return value
+
+
+def csv_lines(headers, rows):
+    """Lines of a CSV file with the headers (if any) and the rows"""
+    writer = csv.writer(Echo())
+    if headers:
+        yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def ndjson_lines(headers, rows):
+    """Lines of a newline delimited JSON file, with an object of header: value for each row"""
+    for row in rows:
+        yield json.dumps(dict(zip(headers, row)), default=json_default) + '\n'
+
+
+def write_xlsx(path, sheets):
+    """Write sheets, a list of (name, headers, rows), to an XLSX file. The constant memory mode of xlsxwriter writes
+    each row to disk when the next row is started, so the rows can be a generator of any length. Empty values (None)
+    are left out"""
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'tmpdir': os.path.dirname(path)})
+    for name, headers, rows in sheets:
+        worksheet = workbook.add_worksheet(name)
+        row_number = 0
+        if headers:
+            worksheet.write_row(0, 0, headers)
+            row_number = 1
+        for row in rows:
+            for col, value in enumerate(row):
+                if value is not None:
+                    worksheet.write(row_number, col, value)
+            row_number += 1
+    workbook.close()
+
+
+def export_dir():
+    path = os.sep.join([tempfile.gettempdir(), settings.SITE_NAME + '_exports'])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def save_xlsx(sheets):
+    """Write sheets to an XLSX file in the export directory, to be downloaded by a later request, and remove old
+    exports. Returns the path of the file"""
+    directory = export_dir()
+    now = time.time()
+    for file_name in os.listdir(directory):
+        file_path = os.sep.join([directory, file_name])
+        try:
+            if now - os.path.getmtime(file_path) > EXPORT_FILE_LIFETIME:
+                os.remove(file_path)
+        except OSError:
+            pass
+
+    handle, path = tempfile.mkstemp(suffix='.xlsx', dir=directory)
+    os.close(handle)
+    write_xlsx(path, sheets)
+    return path
+
+
+def file_chunks(path, delete=False):
+    """Contents of a file in chunks, optionally removing the file once it has been read"""
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if delete and os.path.exists(path):
+            os.remove(path)
+
+
+def xlsx_chunks(sheets):
+    """Chunks of an XLSX file of sheets. An XLSX file is a zip archive, so it is written to a temporary file first,
+    which is removed once it has been streamed"""
+    handle, path = tempfile.mkstemp(suffix='.xlsx', dir=export_dir())
+    os.close(handle)
+    try:
+        write_xlsx(path, sheets)
+    except Exception:
+        os.remove(path)
+        raise
+    yield from file_chunks(path, delete=True)
+
+
+def attachment_response(chunks, content_type, file_name):
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=' + file_name
+    return response
+
+
+def export_response(file_name, headers, rows, export_format='xlsx', sheet_name=None):
+    """Streaming download of rows (sequences of values in the order of the headers) as CSV, newline delimited JSON or
+    XLSX. The rows are only produced while the response is sent, so rows of querysets should be read with
+    .iterator(). The file extension is added to the file name"""
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'xlsx'
+    content_type, extension = EXPORT_FORMATS[export_format]
+    if export_format == 'csv':
+        chunks = csv_lines(headers, rows)
+    elif export_format == 'json':
+        chunks = ndjson_lines(headers, rows)
+    else:
+        chunks = xlsx_chunks([(sheet_name, headers, rows)])
+    return attachment_response(chunks, content_type, '{}.{}'.format(file_name, extension))
+
+
+def xlsx_response(file_name, sheets):
+    """Streaming download of an XLSX file with several sheets, a list of (name, headers, rows)"""
+    return attachment_response(xlsx_chunks(sheets), XLSX_CONTENT_TYPE, file_name + '.xlsx')
@@ -172,6 +172,15 @@ class ReleaseNotes(models.Model):
     def __str__(self):
         return str(self.date)
 
+    @classmethod
+    def current_version(cls):
+        """Identifier of the current data release. Release notes are recreated by every build, so the identifier
+        changes with each rebuild, and can be used to invalidate cached data"""
+        latest = cls.objects.values_list('pk', 'date').first()
+        if latest:
+            return '{}-{}'.format(latest[1], latest[0])
+        return 'none'
+
     class Meta():
         ordering = ('-date', )
         db_table = 'release_notes'
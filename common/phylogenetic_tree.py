@@ -5,7 +5,7 @@ Annotates crystalized targets and number of ligands/target available in ChEMBL.
 from django.db.models import Count
 
 from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
-from ligand.models import AssayExperiment
+from ligand.models import AssayExperimentSummary
 from protein.models import Protein, ProteinFamily
 from structure.models import Structure
 
@@ -228,10 +228,11 @@ class PhylogeneticTreeGenerator(object):
                                                  ('protein_conformation__protein__parent')
                                                  ]
         
-        ligand_data = AssayExperiment.objects.values(
+        # one summary per ligand and target
+        ligand_data = AssayExperimentSummary.objects.values(
             'protein',
             'protein__entry_name'
-            ).annotate(num_ligands=Count('ligand', distinct=True))
+            ).annotate(num_ligands=Count('ligand'))
 
         self.aux_data['ligands'] = {
             100 : [x['protein'] for x in ligand_data if x['num_ligands'] <= 100],
@@ -1,12 +1,40 @@
-﻿from django.conf import settings
+﻿from django.apps import apps
+from django.conf import settings
+from django.db import models
 
 from protein.models import Species
 from protein.models import ProteinSource
 from residue.models import ResidueNumberingScheme
 
+from collections import defaultdict
+
+
+# attributes of a selection that are stored in the session
+SELECTION_FIELDS = ['reference', 'targets', 'segments', 'species', 'pref_g_proteins', 'g_proteins', 'annotation',
+    'numbering_schemes', 'tree_settings', 'site_residue_groups', 'active_site_residue_group']
+
+# lists of selection items among the selection attributes
+SELECTION_ITEM_FIELDS = ['reference', 'targets', 'segments', 'species', 'pref_g_proteins', 'g_proteins',
+    'annotation', 'numbering_schemes']
+
+# related objects that are loaded with selected objects, by model (these are used by the views and templates that show
+# the selection), and fields that are not loaded
+SELECTION_ITEM_RELATED = {
+    'protein.protein': ['family', 'species', 'source', 'residue_numbering_scheme', 'sequence_type'],
+    'residue.residuegenericnumberequivalent': ['scheme', 'default_generic_number'],
+    'structure.structure': ['pdb_code', 'protein_conformation__protein__parent'],
+    'structure.structuremodel': ['protein', 'state', 'main_template__pdb_code'],
+}
+SELECTION_ITEM_DEFERRED = {
+    'structure.structuremodel': ['compressed_pdb', 'pdb_index'],
+}
+
 
 class SimpleSelection:
-    """A class representing the proteins and segments a user has selected. Can be serialized and stored in session"""
+    """A class representing the proteins and segments a user has selected. Can be serialized and stored in session.
+
+    The selection is stored as a dictionary of selection item types, model names and ids (see to_dict), which can be
+    serialized as JSON. The selected objects are loaded when they are first used, in one query per model"""
     def __init__(self):
         self.reference = []
         self.targets = []
@@ -39,38 +67,52 @@ class SimpleSelection:
     def __str__(self):
         return str(self.__dict__)
 
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        # selections stored before the compact format have model instances in the selection items
+        if 'format' not in state:
+            self.__dict__.update(state)
+            return
+        loader = SelectionItemLoader()
+        for field in SELECTION_FIELDS:
+            if field in SELECTION_ITEM_FIELDS:
+                setattr(self, field, [SelectionItem.from_dict(item, loader) for item in state[field]])
+            else:
+                setattr(self, field, state[field])
+
+    def to_dict(self):
+        """The selection as a dictionary of lists and values that can be serialized as JSON"""
+        data = {'format': 1}
+        for field in SELECTION_FIELDS:
+            if field in SELECTION_ITEM_FIELDS:
+                data[field] = [item.to_dict() for item in getattr(self, field)]
+            else:
+                data[field] = getattr(self, field)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """A selection from a dictionary made by to_dict, the selected objects are loaded when they are used"""
+        selection = cls.__new__(cls)
+        selection.__setstate__(data)
+        return selection
+
 
 class Selection(SimpleSelection):
     """A class that extends SimpleSelection, and adds methods to process the selection (these methods can not be
         serialized"""
     def importer(self, simple_selection):
         """Imports a SimpleSelection object into Selection"""
-        self.reference = simple_selection.reference
-        self.targets = simple_selection.targets
-        self.segments = simple_selection.segments
-        self.species = simple_selection.species
-        self.pref_g_proteins = simple_selection.pref_g_proteins
-        self.g_proteins = simple_selection.g_proteins
-        self.annotation = simple_selection.annotation
-        self.numbering_schemes = simple_selection.numbering_schemes
-        self.tree_settings=simple_selection.tree_settings
-        self.site_residue_groups = simple_selection.site_residue_groups
-        self.active_site_residue_group = simple_selection.active_site_residue_group
+        for field in SELECTION_FIELDS:
+            setattr(self, field, getattr(simple_selection, field))
 
     def exporter(self):
         """Exports the attributes of Selection to a SimpleSelection object, and returns it"""
-        ss = SimpleSelection()
-        ss.reference = self.reference
-        ss.targets = self.targets
-        ss.segments = self.segments
-        ss.species = self.species
-        ss.pref_g_proteins = self.pref_g_proteins
-        ss.g_proteins = self.g_proteins
-        ss.annotation = self.annotation
-        ss.numbering_schemes = self.numbering_schemes
-        ss.tree_settings=self.tree_settings
-        ss.site_residue_groups = self.site_residue_groups
-        ss.active_site_residue_group = self.active_site_residue_group
+        ss = SimpleSelection.__new__(SimpleSelection)
+        for field in SELECTION_FIELDS:
+            setattr(ss, field, getattr(self, field))
 
         return ss
 
@@ -112,7 +154,7 @@ class Selection(SimpleSelection):
         group_id = False
         delete_group = False
         for selection_object in selection:
-            if (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id) and 
+            if (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id) and 
                 'site_residue_group' in selection_object.properties and
                 selection_object.properties['site_residue_group']):
                 group_id = selection_object.properties['site_residue_group']
@@ -120,7 +162,7 @@ class Selection(SimpleSelection):
 
         # loop through selected objects and remove the one that matches the subtype and ID
         for selection_object in selection:
-            if not (selection_object.type == selection_subtype and selection_object.item.id == int(selection_id)):
+            if not (selection_object.type == selection_subtype and selection_object.item_id == int(selection_id)):
                 updated_selection.append(selection_object)
                 
                 # check group ID
@@ -176,8 +218,88 @@ class SelectionItem:
         self.item = selection_object
         self.properties = properties
 
+    @property
+    def item(self):
+        """The selected object, loaded with the other selected objects of the same model when first used (None if it
+        has been deleted)"""
+        if self._item is None and self.model:
+            self._item = self.loader.get(self.model, self.item_id)
+        return self._item
+
+    @item.setter
+    def item(self, selection_object):
+        self._item = selection_object
+        self.loader = None
+        if isinstance(selection_object, models.Model):
+            self.model = selection_object._meta.label_lower
+            self.item_id = selection_object.pk
+        else:
+            self.model = None
+            self.item_id = getattr(selection_object, 'id', None)
+
+    def key(self):
+        if self.model:
+            return (self.type, self.model, self.item_id, self.properties)
+        return (self.type, self._item, self.properties)
+
+    def to_dict(self):
+        """The selection item as a dictionary of its type, the model and id of the object, and its properties. Objects
+        that are not model instances are kept as they are"""
+        if self.model:
+            return {'type': self.type, 'model': self.model, 'id': self.item_id, 'properties': self.properties}
+        return {'type': self.type, 'object': self._item, 'properties': self.properties}
+
+    @classmethod
+    def from_dict(cls, data, loader=None):
+        """A selection item from a dictionary made by to_dict. The object is loaded by the loader when it is used"""
+        if 'model' not in data:
+            return cls(data['type'], data['object'], dict(data['properties']))
+        selection_item = cls.__new__(cls)
+        selection_item.type = data['type']
+        selection_item.type_title = data['type'].replace('_', ' ').capitalize()
+        selection_item.properties = dict(data['properties'])
+        selection_item._item = None
+        selection_item.model = data['model']
+        selection_item.item_id = data['id']
+        selection_item.loader = loader or SelectionItemLoader()
+        selection_item.loader.add(data['model'], data['id'])
+        return selection_item
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        # selection items stored before the compact format have the model instance in the state
+        if 'item' in state:
+            self.__init__(state['type'], state['item'], state['properties'])
+        else:
+            self.__dict__.update(SelectionItem.from_dict(state).__dict__)
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
 
     def __eq__(self, other): 
-        return self.__dict__ == other.__dict__
\ No newline at end of file
+        return self.key() == other.key()
+
+
+class SelectionItemLoader:
+    """Loads the objects of the selection items of a selection (read from the session in a request) in one query per
+    model, when the first object of a model is used"""
+    def __init__(self):
+        self.pending = defaultdict(set)
+        self.objects = defaultdict(dict)
+
+    def add(self, model, item_id):
+        self.pending[model].add(item_id)
+
+    def get(self, model, item_id):
+        if item_id not in self.objects[model]:
+            item_ids = self.pending.pop(model, set()) | set([item_id])
+            queryset = apps.get_model(model).objects.all()
+            if model in SELECTION_ITEM_RELATED:
+                queryset = queryset.select_related(*SELECTION_ITEM_RELATED[model])
+            if model in SELECTION_ITEM_DEFERRED:
+                queryset = queryset.defer(*SELECTION_ITEM_DEFERRED[model])
+            objects = queryset.in_bulk(list(item_ids))
+            self.objects[model].update({i: objects.get(i) for i in item_ids})
+        return self.objects[model].get(item_id)
@@ -0,0 +1,108 @@
+from django.conf import settings
+
+import os
+import json
+import numpy as np
+
+
+class SimilarityStore:
+    """Precomputed pairwise sequence similarity of all wt receptors, per segment. Built by build_similarity_matrix.
+
+    For every segment, a matrix of shape (proteins x proteins x fields) holds the counts of identical and similar
+    residues, the BLOSUM62 score and the number of compared positions of each protein pair. Counts are stored instead
+    of percentages, so that the values for any combination of segments can be calculated by summing them."""
+
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'similarity_matrix'])
+    index_file = 'index.json'
+
+    # identities, similarities (BLOSUM62 > 0), BLOSUM62 score, positions where at least one protein has a residue, and
+    # positions where both proteins have a residue (used for normalized values, where gaps are not counted)
+    fields = ['identities', 'similarities', 'scores', 'lengths', 'paired_lengths']
+
+    def __init__(self, store_dir=None):
+        if store_dir:
+            self.store_dir = store_dir
+        self.index_path = os.sep.join([self.store_dir, self.index_file])
+        self.loaded_mtime = None
+        self.protein_rows = {}
+        self.segments = {}
+
+    def load(self):
+        """Read the store index, reloading it if the store has been rebuilt. Returns False if there is no store"""
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            self.loaded_mtime = None
+            return False
+        if mtime == self.loaded_mtime:
+            return True
+
+        with open(self.index_path) as index_file:
+            index = json.load(index_file)
+        self.protein_rows = {protein_id: i for i, protein_id in enumerate(index['proteins'])}
+        self.segments = {}
+        for segment in index['segments']:
+            self.segments[segment] = np.load(self.segment_path(segment, index['build']), mmap_mode='r')
+        self.loaded_mtime = mtime
+        return True
+
+    def segment_path(self, segment, build):
+        return os.sep.join([self.store_dir, '{}.{}.npy'.format(segment, build)])
+
+    def covers(self, protein_ids, segments):
+        """Check whether all proteins and segments are in the store"""
+        if not self.load():
+            return False
+        return (all([s in self.segments for s in segments])
+            and all([protein_id in self.protein_rows for protein_id in protein_ids]))
+
+    def counts(self, protein_ids_1, protein_ids_2, segments):
+        """Sum of the stored counts for the given segments, shape (len(protein_ids_1), len(protein_ids_2), fields)"""
+        rows_1 = np.array([self.protein_rows[p] for p in protein_ids_1], dtype=np.intp)
+        rows_2 = np.array([self.protein_rows[p] for p in protein_ids_2], dtype=np.intp)
+        counts = np.zeros((len(rows_1), len(rows_2), len(self.fields)), dtype=np.int64)
+        if not len(rows_1) or not len(rows_2):
+            return counts
+
+        # read whole rows from the memory mapped files (sorted to keep reads sequential), then select the columns
+        order = np.argsort(rows_1)
+        for segment in segments:
+            segment_rows = self.segments[segment][rows_1[order]]
+            counts[order] += segment_rows[:, rows_2]
+        return counts
+
+    def similarity(self, protein_ids_1, protein_ids_2, segments, normalized=False):
+        """Identity and similarity (in %) and similarity score of every protein pair. Normalized values only count
+        positions where both proteins have a residue. Percentages are NaN for pairs without compared positions"""
+        counts = self.counts(protein_ids_1, protein_ids_2, segments)
+        if normalized:
+            lengths = counts[:, :, 4].astype(np.float64)
+        else:
+            lengths = counts[:, :, 3].astype(np.float64)
+        lengths[lengths == 0] = np.nan
+        identities = counts[:, :, 0] / lengths * 100
+        similarities = counts[:, :, 1] / lengths * 100
+        return identities, similarities, counts[:, :, 2]
+
+    def save_segment(self, segment, counts, build):
+        """Write the counts of one segment. Files are named by build, so that readers of the previous build are not
+        affected until the new index is saved"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        np.save(self.segment_path(segment, build), counts)
+
+    def save_index(self, protein_ids, segments, build):
+        """Write the index when all segments of a build are saved, and remove files of older builds"""
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_index_path, 'w') as index_file:
+            json.dump({'build': build, 'proteins': [int(p) for p in protein_ids], 'segments': segments,
+                'fields': self.fields}, index_file)
+        os.replace(tmp_index_path, self.index_path)
+
+        current_files = [os.path.basename(self.segment_path(segment, build)) for segment in segments]
+        for file_name in os.listdir(self.store_dir):
+            if file_name.endswith('.npy') and file_name not in current_files:
+                os.remove(os.sep.join([self.store_dir, file_name]))
+
+
+# shared store instance, the index is reloaded when the store is rebuilt
+similarity_store = SimilarityStore()
@@ -0,0 +1,103 @@
+from django.conf import settings
+
+from common.models import ReleaseNotes
+
+from collections import OrderedDict
+from importlib import import_module
+import hashlib
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# statistics pages that are served from snapshots, by snapshot name. Each source is a function that returns the
+# context of the page, or a view class with a get_statistics method
+STATISTICS_SNAPSHOTS = OrderedDict([
+    ('structure_statistics', 'structure.views.StructureStatistics'),
+    ('ligand_statistics', 'ligand.views.LigandStatistics'),
+    ('mutation_coverage', 'mutation.views.coverage_statistics'),
+    ('variation_statistics', 'mutational_landscape.views.variation_statistics'),
+])
+
+
+def calculate_snapshot(name):
+    """Calculate the context of a statistics page from the database"""
+    module_name, attribute = STATISTICS_SNAPSHOTS[name].rsplit('.', 1)
+    source = getattr(import_module(module_name), attribute)
+    if isinstance(source, type):
+        return source().get_statistics()
+    return source()
+
+
+def snapshot_checksum(data):
+    """SHA-256 of the JSON of a snapshot, used to find snapshots that did not change in a rebuild"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SnapshotStore:
+    """Contexts of the statistics pages, calculated by build_statistics_snapshots and stored as JSON files. A
+    snapshot is only used for the data release it was built for (see ReleaseNotes.current_version). Snapshots are kept
+    in memory, and read again when the file is rebuilt"""
+
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'statistics_snapshots'])
+
+    def __init__(self, store_dir=None):
+        if store_dir:
+            self.store_dir = store_dir
+        # name: (file mtime, snapshot)
+        self.snapshots = {}
+
+    def snapshot_path(self, name):
+        return os.sep.join([self.store_dir, '{}.json'.format(name)])
+
+    def load(self, name):
+        """The snapshot (release, checksum and data), or None if there is no snapshot"""
+        try:
+            mtime = os.path.getmtime(self.snapshot_path(name))
+        except OSError:
+            self.snapshots.pop(name, None)
+            return None
+        if name in self.snapshots and self.snapshots[name][0] == mtime:
+            return self.snapshots[name][1]
+
+        with open(self.snapshot_path(name)) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        self.snapshots[name] = (mtime, snapshot)
+        return snapshot
+
+    def get(self, name, release):
+        """Data of a snapshot if it was built for the release, otherwise None"""
+        snapshot = self.load(name)
+        if snapshot is None or snapshot['release'] != release:
+            return None
+        return snapshot['data']
+
+    def save(self, name, data, release):
+        """Write a snapshot. Returns False if the data did not change since the previous snapshot"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        checksum = snapshot_checksum(data)
+        previous = self.load(name)
+        changed = previous is None or previous['checksum'] != checksum
+
+        tmp_snapshot_path = self.snapshot_path(name) + '.tmp'
+        with open(tmp_snapshot_path, 'w') as snapshot_file:
+            json.dump({'release': release, 'checksum': checksum, 'data': data}, snapshot_file)
+        os.replace(tmp_snapshot_path, self.snapshot_path(name))
+        return changed
+
+
+def statistics_snapshot(name):
+    """Context of a statistics page from its snapshot of the current data release, or calculated from the database if
+    there is no such snapshot"""
+    data = snapshot_store.get(name, ReleaseNotes.current_version())
+    if data is None:
+        logger.warning('No statistics snapshot {} for the current release, run build_statistics_snapshots'.format(
+            name))
+        data = calculate_snapshot(name)
+    return data
+
+
+# shared store instance, snapshots are read again when they are rebuilt
+snapshot_store = SnapshotStore()
@@ -1,3 +1,184 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, override_settings
 
-# Create your tests here.
+from common.alignment import MATRIX_CODES
+from common.conservation import ConservationStore, calculate_conservation
+from common.export import csv_lines, ndjson_lines, export_response, file_chunks, write_xlsx
+from common.similarity import SimilarityStore
+from common.tools import web_store_get, web_store_put, fetch_from_web_api
+
+import numpy as np
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+
+class SimilarityStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def build_store(self, build):
+        # counts of 3 proteins, field values encode the segment, the protein pair and the field
+        store = SimilarityStore(self.store_dir)
+        for s, segment in enumerate(['TM1', 'TM2']):
+            counts = np.zeros((3, 3, len(store.fields)), dtype=np.int64)
+            for i in range(3):
+                for j in range(3):
+                    counts[i, j] = [(s + 1) * (i + j), s + 1, (s + 1) * 10, 10, 5 * (s + 1)]
+            store.save_segment(segment, counts, build)
+        store.save_index([11, 12, 13], ['TM1', 'TM2'], build)
+        return store
+
+    def test_counts(self):
+        store = self.build_store(1)
+        self.assertTrue(store.covers([11, 13], ['TM1', 'TM2']))
+        self.assertFalse(store.covers([11, 14], ['TM1']))
+        self.assertFalse(store.covers([11], ['TM3']))
+
+        # rows are given out of order, counts of both segments are summed
+        counts = store.counts([13, 11], [12], ['TM1', 'TM2'])
+        self.assertEqual(counts.shape, (2, 1, len(store.fields)))
+        self.assertEqual(counts[0, 0].tolist(), [9, 3, 30, 20, 15])
+        self.assertEqual(counts[1, 0].tolist(), [3, 3, 30, 20, 15])
+        self.assertEqual(store.counts([], [12], ['TM1']).shape, (0, 1, len(store.fields)))
+
+    def test_similarity(self):
+        store = self.build_store(1)
+        self.assertTrue(store.covers([12, 13], ['TM1']))
+        identities, similarities, scores = store.similarity([13], [12], ['TM1'])
+        self.assertEqual(identities[0, 0], 30)
+        self.assertEqual(similarities[0, 0], 10)
+        self.assertEqual(scores[0, 0], 10)
+        identities, similarities, scores = store.similarity([13], [12], ['TM1'], normalized=True)
+        self.assertEqual(identities[0, 0], 60)
+
+    def test_rebuild(self):
+        self.assertFalse(SimilarityStore(self.store_dir).covers([11], ['TM1']))
+        self.build_store(1)
+        self.build_store(2)
+        # files of the previous build are removed
+        self.assertEqual(sorted(os.listdir(self.store_dir)), ['TM1.2.npy', 'TM2.2.npy', 'index.json'])
+        self.assertTrue(SimilarityStore(self.store_dir).covers([11], ['TM1']))
+
+
+class WebStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_round_trip(self):
+        url = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/2244/JSON'
+        self.assertIsNone(web_store_get(url, self.store_dir))
+        web_store_put(url, 200, b'{"cid": 2244}', self.store_dir)
+        self.assertEqual(web_store_get(url, self.store_dir), (200, b'{"cid": 2244}'))
+
+        # responses with the same content share one object
+        web_store_put(url + '?copy', 200, b'{"cid": 2244}', self.store_dir)
+        objects = [f for path, dirs, files in os.walk(os.sep.join([self.store_dir, 'objects'])) for f in files]
+        self.assertEqual(len(objects), 1)
+
+        web_store_put(url + '?missing', 404, store_dir=self.store_dir)
+        self.assertEqual(web_store_get(url + '?missing', self.store_dir), (404, None))
+
+    def test_offline(self):
+        url = 'https://www.ebi.ac.uk/chembl/api/data/molecule/$index.json'
+        web_store_put(url.replace('$index', 'CHEMBL25'), 200, json.dumps({'name': 'aspirin'}).encode('utf-8'),
+            self.store_dir)
+        web_store_put(url.replace('$index', 'CHEMBL0'), 404, store_dir=self.store_dir)
+        with override_settings(WEB_STORE_DIR=self.store_dir, WEB_API_OFFLINE=True):
+            self.assertEqual(fetch_from_web_api(url, 'CHEMBL25', cache_dir=True), {'name': 'aspirin'})
+            # stored failures and missing entries are not requested offline
+            self.assertFalse(fetch_from_web_api(url, 'CHEMBL0', cache_dir=True))
+            self.assertFalse(fetch_from_web_api(url, 'CHEMBL1', cache_dir=True))
+
+
+class ExportTest(SimpleTestCase):
+
+    headers = ['Ligand', 'Value', 'Date']
+    rows = [['aspirin', 1.5, datetime.date(2020, 1, 31)], ['caffeine, anhydrous', None, None]]
+
+    def test_csv(self):
+        lines = list(csv_lines(self.headers, iter(self.rows)))
+        self.assertEqual(lines, ['Ligand,Value,Date\r\n', 'aspirin,1.5,2020-01-31\r\n', '"caffeine, anhydrous",,\r\n'])
+
+    def test_ndjson(self):
+        lines = list(ndjson_lines(self.headers, iter(self.rows)))
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'Ligand': 'aspirin', 'Value': 1.5, 'Date': '2020-01-31'},
+            {'Ligand': 'caffeine, anhydrous', 'Value': None, 'Date': None},
+        ])
+
+    def test_streaming(self):
+        # rows are only read while the response is sent
+        read = []
+        def rows():
+            for row in self.rows:
+                read.append(row)
+                yield row
+        response = export_response('ligands', self.headers, rows(), 'csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=ligands.csv')
+        self.assertEqual(read, [])
+        self.assertEqual(len(list(response.streaming_content)), 3)
+        self.assertEqual(read, self.rows)
+
+    def test_xlsx(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.sep.join([tmp_dir, 'export.xlsx'])
+            write_xlsx(path, [('Ligands', self.headers, iter(self.rows)), ('Empty', [], [])])
+            with zipfile.ZipFile(path) as workbook:
+                self.assertIn('xl/worksheets/sheet2.xml', workbook.namelist())
+                self.assertIn(b'caffeine, anhydrous', workbook.read('xl/worksheets/sheet1.xml'))
+
+            chunks = list(file_chunks(path, delete=True))
+            self.assertTrue(b''.join(chunks).startswith(b'PK'))
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class ConservationStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.generic_numbers = ['1x50', '2x50', '3x50']
+        sequences = ['NDR', 'NDW', 'NA-', 'LDR']
+        residues = np.array([[MATRIX_CODES[aa] for aa in sequence] for sequence in sequences], dtype=np.uint8)
+        self.store = ConservationStore(self.store_dir)
+        self.store.save([11, 12, 13, 14], ['001_001_001', '001_001_002', '001_002_001', '002_001_001'],
+            [True, True, True, False], self.generic_numbers, residues, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_conservation(self):
+        self.assertTrue(self.store.covers([11, 14]))
+        self.assertFalse(self.store.covers([11, 15]))
+
+        conservation = self.store.conservation(protein_ids=[11, 12, 13])
+        self.assertEqual(list(conservation), self.generic_numbers)
+        self.assertEqual(conservation['1x50'], ['N', '10', {'N': (3, 1.0)}])
+        self.assertEqual(conservation['2x50'], ['D', '6', {'A': (1, 0.333), 'D': (2, 0.667)}])
+        # ties have + as consensus, gaps are not counted
+        self.assertEqual(conservation['3x50'][:2], ['+', '3'])
+
+    def test_family(self):
+        self.store.load()
+        self.assertEqual(self.store.family_rows('001_001'), [0, 1])
+        # receptors that are not human SWISSPROT entries are left out
+        self.assertEqual(self.store.family_rows('002'), [])
+        self.assertEqual(list(self.store.conservation(slug='002')), [])
+        self.assertEqual(self.store.conservation(slug='001_001')['3x50'][0], '+')
+
+    def test_no_residues(self):
+        residues = np.zeros((2, 3), dtype=np.uint8)
+        self.assertEqual(list(calculate_conservation(residues, self.generic_numbers)), [])
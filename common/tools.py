@@ -1,13 +1,17 @@
 from django.conf import settings
 from django.utils.text import slugify
-from django.core.cache import cache
 
 import os
+import fcntl
 import yaml
 import time
 import logging
+import hashlib
+import threading
 import urllib
-from urllib.parse import quote
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from urllib.parse import quote, urlparse
 from urllib.request import urlopen
 from urllib.error import HTTPError
 import json
@@ -43,74 +47,199 @@ def create_cache_dirs(path):
         intermediate_path = os.sep.join([intermediate_path, directory])
         os.chmod(intermediate_path, 0o777)
 
-def fetch_from_web_api(url, index, cache_dir=False, xml=False):
+class RateLimiter(object):
+    """Limits the number of requests per second to each host, for all threads and processes (e.g. the workers of
+    BaseBuild.run_jobs). The time of the next request to each host is kept in a file, which is locked while a request
+    time is reserved"""
+
+    def __init__(self, rate_limits, default_rate_limit, lock_dir=None):
+        self.rate_limits = rate_limits
+        self.default_rate_limit = default_rate_limit
+        self.lock_dir = lock_dir
+        self.lock = threading.Lock()
+
+    def host_path(self, host):
+        lock_dir = self.lock_dir or os.sep.join([settings.BUILD_CACHE_DIR, 'web_rate_limits'])
+        os.makedirs(lock_dir, exist_ok=True)
+        return os.sep.join([lock_dir, slugify(host) + '.next'])
+
+    def reserve(self, host, interval):
+        """Time of the next request to a host, the following request is reserved interval seconds later"""
+        with self.lock, open(self.host_path(host), 'a+') as host_file:
+            fcntl.flock(host_file, fcntl.LOCK_EX)
+            host_file.seek(0)
+            try:
+                next_request = float(host_file.read())
+            except ValueError:
+                next_request = 0
+            request_time = max(time.time(), next_request)
+            host_file.seek(0)
+            host_file.truncate()
+            host_file.write(repr(request_time + interval))
+            host_file.flush()
+            fcntl.flock(host_file, fcntl.LOCK_UN)
+        return request_time
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        interval = 1.0 / self.rate_limits.get(host, self.default_rate_limit)
+        request_time = self.reserve(host, interval)
+        now = time.time()
+        if request_time > now:
+            time.sleep(request_time - now)
+
+# requests per second by host (for all build processes together), can be changed with the WEB_API_RATE_LIMITS setting
+rate_limiter = RateLimiter(getattr(settings, 'WEB_API_RATE_LIMITS', {'pubchem.ncbi.nlm.nih.gov': 5}),
+    getattr(settings, 'WEB_API_DEFAULT_RATE_LIMIT', 10))
+
+def web_store_dir():
+    return getattr(settings, 'WEB_STORE_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'web_store']))
+
+def write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def web_store_get(url, store_dir=None):
+    """Response of a URL from the web store, as (status, content). Returns None if the URL has not been stored.
+    Responses are stored by the hash of the URL, their contents by the hash of the content"""
+    store_dir = store_dir or web_store_dir()
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    request_path = os.sep.join([store_dir, 'requests', key[:2], key + '.json'])
+    if not os.path.isfile(request_path):
+        return None
+    with open(request_path) as request_file:
+        record = json.load(request_file)
+    if not record.get('sha256'):
+        return record['status'], None
+    content_path = os.sep.join([store_dir, 'objects', record['sha256'][:2], record['sha256'] + '.gz'])
+    with gzip.open(content_path) as content_file:
+        return record['status'], content_file.read()
+
+def web_store_put(url, status, content=None, store_dir=None):
+    store_dir = store_dir or web_store_dir()
+    record = {'url': url, 'status': status, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if content is not None:
+        content_key = hashlib.sha256(content).hexdigest()
+        content_path = os.sep.join([store_dir, 'objects', content_key[:2], content_key + '.gz'])
+        if not os.path.isfile(content_path):
+            write_file_atomic(content_path, gzip.compress(content))
+        record['sha256'] = content_key
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    request_path = os.sep.join([store_dir, 'requests', key[:2], key + '.json'])
+    write_file_atomic(request_path, json.dumps(record).encode('utf-8'))
+
+def fetch_url(full_url):
+    """Fetch a URL, with retries. Returns (status, content), where status is None if all tries failed. With the
+    WEB_API_STUB_URL setting, the URL is requested from a stub server instead (see serve_web_store)"""
     logger = logging.getLogger('build')
+    stub_url = getattr(settings, 'WEB_API_STUB_URL', None)
+    request_url = stub_url.rstrip('/') + '/' + full_url if stub_url else full_url
 
-    # slugify the index for the cache filename (some indices have symbols not allowed in file names (e.g. /))
-    index_slug= slugify(index)
-    cache_file_path = '{}/{}'.format('/'.join(cache_dir), index_slug)
-    
-    # try fetching from cache
-    if cache_dir:
-        d = cache.get(cache_file_path)
-        # d = fetch_from_cache(cache_dir, index_slug)
-        if not d is None:
-            logger.info('Fetched {} from cache'.format(cache_file_path))
-            return d
-    
-    # if nothing is found in the cache, use the web API
-    full_url = Template(url).substitute(index=quote(str(index), safe=''))
-    logger.info('Fetching {}'.format(full_url))
     tries = 0
     max_tries = 5
     while tries < max_tries:
         if tries > 0:
             logger.warning('Failed fetching {}, retrying'.format(full_url))
-        
+
+        rate_limiter.wait(request_url)
         try:
-            req = urlopen(full_url)
-            if full_url[-2:]=='gz' and xml:
-                try:
-                    buf = BytesIO( req.read())
-                    f = gzip.GzipFile(fileobj=buf)
-                    data = f.read()
-                    d = etree.fromstring(data)
-                except:
-                    return False
-            elif xml:
-                try:
-                    d = etree.fromstring(req.read().decode('UTF-8'))
-                except:
-                    return False
-            else:
-                d = json.loads(req.read().decode('UTF-8'))
+            req = urlopen(request_url)
+            return 200, req.read()
         except HTTPError as e:
             tries += 1
             if e.code == 404:
                 logger.warning('Failed fetching {}, 404 - does not exist'.format(full_url))
-                tries = max_tries #skip more tries
-                return False
+                return 404, None
             elif e.code == 400:
                 logger.warning('Failed fetching {}, 400 - does not exist'.format(full_url))
-                tries = max_tries #skip more tries
-                return False
+                return 400, None
             else:
                 time.sleep(2)
         except urllib.error.URLError as e:
             # Catches 101 network is unreachable -- I think it's auto limiting feature
             tries +=1 
             time.sleep(2)
-        else:
-            # save to cache
-            if cache_dir:
-                # save_to_cache(cache_dir, index_slug, d)
-                cache.set(cache_file_path, d, 60*60*24*7) #7 days
-                logger.info('Saved entry for {} in cache'.format(cache_file_path))
-            return d
-    
+
     # give up if the lookup fails 5 times
     logger.error('Failed fetching {} {} times, giving up'.format(full_url, max_tries))
-    return False
+    return None, None
+
+def parse_web_api_response(full_url, content, xml=False):
+    if full_url[-2:]=='gz' and xml:
+        try:
+            buf = BytesIO(content)
+            f = gzip.GzipFile(fileobj=buf)
+            data = f.read()
+            return etree.fromstring(data)
+        except:
+            return False
+    elif xml:
+        try:
+            return etree.fromstring(content.decode('UTF-8'))
+        except:
+            return False
+    else:
+        return json.loads(content.decode('UTF-8'))
+
+def fetch_from_web_api(url, index, cache_dir=False, xml=False):
+    """Fetch the JSON (or XML) data of an index from a web API. If cache_dir is set, responses are kept in the
+    permanent web store, which is all that is used when the WEB_API_OFFLINE setting is on. Failed requests (404 and
+    400) are stored as well, but only used offline"""
+    logger = logging.getLogger('build')
+    full_url = Template(url).substitute(index=quote(str(index), safe=''))
+
+    # try fetching from the store
+    if cache_dir:
+        offline = getattr(settings, 'WEB_API_OFFLINE', False)
+        stored = web_store_get(full_url)
+        if stored and stored[0] == 200:
+            try:
+                data = parse_web_api_response(full_url, stored[1], xml)
+            except ValueError:
+                data = False
+            if data is not False:
+                logger.info('Fetched {} from web store'.format(full_url))
+                return data
+            logger.warning('Stored entry for {} could not be parsed'.format(full_url))
+        elif stored and offline:
+            # failed requests are tried again when online
+            return False
+        if offline:
+            logger.warning('{} is not in the web store, skipping (offline)'.format(full_url))
+            return False
+
+    # if nothing is found in the store, use the web API
+    logger.info('Fetching {}'.format(full_url))
+    status, content = fetch_url(full_url)
+    if not status:
+        return False
+
+    # save to the store, including missing entries, but only responses that could be parsed
+    if status != 200:
+        if cache_dir:
+            web_store_put(full_url, status)
+            logger.info('Saved missing entry for {} in web store'.format(full_url))
+        return False
+    data = parse_web_api_response(full_url, content, xml)
+    if cache_dir and data is not False:
+        web_store_put(full_url, status, content)
+        logger.info('Saved entry for {} in web store'.format(full_url))
+    return data
+
+def fetch_many_from_web_api(url, indices, cache_dir=False, xml=False, threads=8):
+    """fetch_from_web_api for many indices at once, in a pool of threads (limited per host by the rate limiter).
+    Returns a dictionary of data by index"""
+    indices = list(OrderedDict.fromkeys(indices))
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(lambda index: fetch_from_web_api(url, index, cache_dir, xml), indices)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(indices, results))
 
 def fetch_from_entrez(index, cache_dir=False):
     logger = logging.getLogger('build')
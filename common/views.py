@@ -8,6 +8,7 @@ from django.core.cache import cache
 
 from common.selection import SimpleSelection, Selection, SelectionItem
 from common import definitions
+from common.export import save_xlsx, file_chunks, attachment_response, XLSX_CONTENT_TYPE
 from structure.models import Structure, StructureModel
 from protein.models import Protein, ProteinFamily, ProteinSegment, Species, ProteinSource, ProteinSet, ProteinGProtein, ProteinGProteinPair
 from residue.models import ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent, ResiduePositionSet
@@ -20,6 +21,7 @@ from io import BytesIO
 import xlsxwriter, xlrd
 import time
 import json
+import os
 
 
 class AbsTargetSelection(TemplateView):
@@ -323,14 +325,14 @@ def AddToSelection(request):
                     o.append(Structure.objects.get(pdb_code__index=pdb_code.upper()))
 
         elif selection_subtype == 'structure_model':
-            o.append(StructureModel.objects.defer('pdb').filter(protein__entry_name=selection_id)[0])
+            o.append(StructureModel.objects.defer('compressed_pdb', 'pdb_index').filter(protein__entry_name=selection_id)[0])
 
         elif selection_subtype == 'structure_models_many':
             selection_subtype = 'structure_model'
             for model in selection_id.split(","):
                 state = model.split('_')[-1]
                 entry_name = '_'.join(model.split('_')[:-1])
-                o.append(StructureModel.objects.defer('pdb').get(protein__entry_name=entry_name, state__name=state))
+                o.append(StructureModel.objects.defer('compressed_pdb', 'pdb_index').get(protein__entry_name=entry_name, state__name=state))
 
 
     elif selection_type == 'segments':
@@ -1358,40 +1360,17 @@ def ExportExcelSuggestions(request):
     data = request.POST['d']
     data = json.loads(data)
 
-    #EXCEL SOLUTION
-    output = BytesIO()
-    workbook = xlsxwriter.Workbook(output)
-
-    for name in sheets:
-        values = data[name]
-        if len(values)==0:
-            continue
-        worksheet = workbook.add_worksheet(name)
-        col = 0
-        for h in headers[name]:
-            worksheet.write(0, col, h)
-            col += 1
-        row = 1
+    def rows(values):
         for d in values:
-            col = 0
-            #print(d)
-            # for h in headers:
-            #     worksheet.write(row, col, d[h])
-            #     col += 1
-            for c in d:
-                #print(c)
-                if isinstance(c, list):
-                    c = ",".join(c)
-                worksheet.write(row, col, c)
-                col += 1
-            row += 1
-    workbook.close()
-    output.seek(0)
-    xlsx_data = output.read()
+            yield [",".join(c) if isinstance(c, list) else c for c in d]
+
+    #EXCEL SOLUTION
+    path = save_xlsx([(name, headers[name], rows(data[name])) for name in sheets if len(data[name])])
 
     ts = time.time()
 
-    cache.set(ts,xlsx_data,30)
+    # only the path of the workbook is cached, the file is streamed by ExportExcelDownload
+    cache.set(ts,path,30)
     response = HttpResponse(ts)
     return response
 
@@ -1399,122 +1378,72 @@ def ExportExcelSuggestions(request):
 def ExportExcelModifications(request):
     """Convert json file to excel file"""
     headers = ['#','type', 'method', 'range', 'info','insert_location','order','from','to','sequence','fixed','extra']
+    index = {h: col for col, h in enumerate(headers)}
+
+    def modification_row(number, mod):
+        row = [str(number)] + [None]*(len(headers)-1)
+        for m,v in mod.items():
+            if isinstance(v, list) and m=='range' and len(v)>1:
+                #v = ",".join(str(x) for x in v)
+                v = str(v[0])+"-"+str(v[-1]) #first and last
+            elif isinstance(v, list):
+                v = ",".join(str(x) for x in v)
+            if m in index:
+                row[index[m]] = str(v)
+            else:
+                print('No column for '+m)
+        return row
 
-    #EXCEL SOLUTION
-    output = BytesIO()
-    workbook = xlsxwriter.Workbook(output)
+    def modifications(data):
+        for number, mod in enumerate(data):
+            yield modification_row(number, mod)
 
-    if 'd' in request.POST:
-        data = request.POST['d']
-        data = json.loads(data)
-
-        worksheet = workbook.add_worksheet("modifications")
-        row = 1
-        index = {}
-        col = 0
-        for h in headers:
-            worksheet.write(0, col, h)
-            index[h] = col
-            col += 1
-        number = 0
-        for mod in data:
-            worksheet.write(row, 0, str(number))
-            number += 1
-            for m,v in mod.items():
-                if isinstance(v, list) and m=='range' and len(v)>1:
-                    #v = ",".join(str(x) for x in v)
-                    v = str(v[0])+"-"+str(v[-1]) #first and last
-                elif isinstance(v, list):
-                    v = ",".join(str(x) for x in v)
-                if m in index:
-                    worksheet.write(row, index[m], str(v))
-                else:
-                    print('No column for '+m)
-            row += 1
-    elif 'm' in request.POST:
-        datas = request.POST['m']
-        datas = json.loads(datas)
-        worksheet = workbook.add_worksheet("modifications")
-        row = 0
+    def construct_modifications(datas):
         for i, data in enumerate(datas):
-
-            worksheet.write(row, 0, "Construct Number #"+str(i+1))
-            row += 1
-            index = {}
-            col = 0
-            for h in headers:
-                worksheet.write(row, col, h)
-                index[h] = col
-                col += 1
+            yield ["Construct Number #"+str(i+1)]
+            yield headers
             number = 0
-            row += 1
             for mod in data:
                 if len(mod)>0:
-                    worksheet.write(row, 0, str(number))
+                    yield modification_row(number, mod)
                     number += 1
-                    for m,v in mod.items():
-                        if isinstance(v, list) and m=='range' and len(v)>1:
-                            #v = ",".join(str(x) for x in v)
-                            v = str(v[0])+"-"+str(v[-1]) #first and last
-                        elif isinstance(v, list):
-                            v = ",".join(str(x) for x in v)
-                        if m in index:
-                            worksheet.write(row, index[m], str(v))
-                        else:
-                            print('No column for '+m)
-                row += 1
-            row += 1
-
-
-    worksheet2 = workbook.add_worksheet("FASTA SEQUENCES")
-    # worksheet2.write(0, 0, "sequences")
-    row = 0
+                else:
+                    yield []
+            yield []
 
     sequences = request.POST['s']
     sequences = json.loads(sequences)
-    for s in sequences:
-        # worksheet2.write(row, 0, "Modifications # used")
-        # worksheet2.write(row, 1, ' '.join(s[0]))
-        # row += 1
-        worksheet2.write(row, 0, ">" + s[1] + "[Modifications:" + ' '.join(s[0]) +"]")
-        row += 1
-        #worksheet2.write(row, 0, "Sequence")
-        worksheet2.write(row, 0, s[2])
-        row += 1
-
-    worksheet3 = workbook.add_worksheet("FASTA SEQUENCES BLOCK")
-    # worksheet2.write(0, 0, "sequences")
-    row = 0
 
-    sequences = request.POST['s']
-    sequences = json.loads(sequences)
-    for s in sequences:
-        # worksheet2.write(row, 0, "Modifications # used")
-        # worksheet2.write(row, 1, ' '.join(s[0]))
-        # row += 1
-        worksheet3.write(row, 0, ">" + s[1] + "[Modifications:" + ' '.join(s[0]) +"]")
-        row += 1
-        #worksheet2.write(row, 0, "Sequence")
-        worksheet3.write(row, 0, s[3])
-        row += 1
-
-    workbook.close()
-    output.seek(0)
-    xlsx_data = output.read()
+    def fasta(column):
+        for s in sequences:
+            yield [">" + s[1] + "[Modifications:" + ' '.join(s[0]) +"]"]
+            yield [s[column]]
+
+    #EXCEL SOLUTION
+    sheets = []
+    if 'd' in request.POST:
+        sheets.append(("modifications", headers, modifications(json.loads(request.POST['d']))))
+    elif 'm' in request.POST:
+        sheets.append(("modifications", None, construct_modifications(json.loads(request.POST['m']))))
+    sheets.append(("FASTA SEQUENCES", None, fasta(2)))
+    sheets.append(("FASTA SEQUENCES BLOCK", None, fasta(3)))
+    path = save_xlsx(sheets)
 
     ts = time.time()
 
-    cache.set(ts,xlsx_data,30)
+    # only the path of the workbook is cached, the file is streamed by ExportExcelDownload
+    cache.set(ts,path,30)
     response = HttpResponse(ts)
     return response
 
 def ExportExcelDownload(request, ts, entry_name):
     """Convert json file to excel file"""
 
-    response = HttpResponse(cache.get(ts),content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response['Content-Disposition'] = 'attachment; filename='+entry_name+'.xlsx' #% 'mutations'
+    path = cache.get(ts)
+    if not path or not os.path.isfile(path):
+        return HttpResponse('The export has expired, please export again', status=404)
 
-    return response
+    return attachment_response(file_chunks(path, delete=True), XLSX_CONTENT_TYPE, entry_name+'.xlsx')
 
 @csrf_exempt
 def ImportExcel(request, **response_kwargs):
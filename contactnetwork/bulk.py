@@ -0,0 +1,99 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+from contactnetwork.models import *
+from residue.models import Residue
+
+import contactnetwork.interaction as ci
+
+import logging
+
+
+logger = logging.getLogger('build')
+
+# Model and attributes to store for each interaction type found by contactnetwork.interaction
+INTERACTION_MODELS = {
+    ci.VanDerWaalsInteraction: (VanDerWaalsInteraction, {}),
+    ci.HydrophobicInteraction: (HydrophobicInteraction, {}),
+    ci.PolarSidechainSidechainInteraction: (PolarSidechainSidechainInteraction, {}),
+    ci.PolarBackboneSidechainInteraction: (PolarBackboneSidechainInteraction, {'res1_is_sidechain': False}),
+    ci.PolarSideChainBackboneInteraction: (PolarBackboneSidechainInteraction, {'res1_is_sidechain': True}),
+    ci.FaceToFaceInteraction: (FaceToFaceInteraction, {}),
+    ci.FaceToEdgeInteraction: (FaceToEdgeInteraction, {'res1_has_face': True}),
+    ci.EdgeToFaceInteraction: (FaceToEdgeInteraction, {'res1_has_face': False}),
+    ci.PiCationInteraction: (PiCationInteraction, {'res1_has_pi': True}),
+    ci.CationPiInteraction: (PiCationInteraction, {'res1_has_pi': False}),
+}
+
+
+def bulk_create_polymorphic(model, objs):
+    """Bulk insert objects of a multi-table inherited polymorphic model, which Django's bulk_create does not support.
+    The rows of the base table are created with bulk_create, the rows of each child table with one executemany"""
+    if not objs:
+        return objs
+
+    # tables from the base model down to the model itself
+    models = list(reversed(model._meta.get_parent_list())) + [model]
+    base_model = models[0]
+    ctype = ContentType.objects.get_for_model(model, for_concrete_model=False)
+
+    base_fields = [f for f in base_model._meta.local_concrete_fields if not f.primary_key]
+    base_objs = []
+    for obj in objs:
+        obj.polymorphic_ctype = ctype
+        base_objs.append(base_model(**{f.attname: getattr(obj, f.attname) for f in base_fields}))
+    base_objs = base_model.objects.bulk_create(base_objs)
+
+    cursor = connection.cursor()
+    for child_model in models[1:]:
+        fields = [child_model._meta.pk] + [f for f in child_model._meta.local_concrete_fields if not f.primary_key]
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(connection.ops.quote_name(child_model._meta.db_table),
+            ', '.join([connection.ops.quote_name(f.column) for f in fields]), ', '.join(['%s'] * len(fields)))
+        rows = [[base_obj.pk] + [getattr(obj, f.attname) for f in fields[1:]] for obj, base_obj in zip(objs, base_objs)]
+        cursor.executemany(sql, rows)
+
+    for obj, base_obj in zip(objs, base_objs):
+        for m in models:
+            setattr(obj, m._meta.pk.attname, base_obj.pk)
+    return objs
+
+
+def save_interactions(structure, interacting_pairs):
+    """Store the interacting pairs of a structure (computed by contactnetwork.cube.compute_interactions) with one query
+    per table"""
+    conformation = structure.protein_conformation
+    residues = dict(Residue.objects.filter(protein_conformation=conformation).values_list('sequence_number', 'pk'))
+    ctype = ContentType.objects.get_for_model(InteractingResiduePair, for_concrete_model=False)
+
+    pairs = []
+    found_pairs = []
+    for p in interacting_pairs:
+        res1_seq_num = p.get_residue_1().id[1]
+        res2_seq_num = p.get_residue_2().id[1]
+        if res1_seq_num not in residues or res2_seq_num not in residues:
+            logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num, res2_seq_num, conformation))
+            continue
+
+        pairs.append(InteractingResiduePair(res1_id=residues[res1_seq_num], res2_id=residues[res2_seq_num],
+            referenced_structure=structure, polymorphic_ctype=ctype))
+        found_pairs.append(p)
+
+    with transaction.atomic():
+        pairs = InteractingResiduePair.objects.bulk_create(pairs)
+
+        interactions = {}
+        for pair, p in zip(pairs, found_pairs):
+            for i in p.get_interactions():
+                if type(i) not in INTERACTION_MODELS:
+                    continue
+                model, attributes = INTERACTION_MODELS[type(i)]
+                ni = model(interacting_pair_id=pair.pk, **attributes)
+                if issubclass(model, PolarInteraction):
+                    ni.is_charged_res1 = i.is_charged_res1
+                    ni.is_charged_res2 = i.is_charged_res2
+                interactions.setdefault(model, []).append(ni)
+
+        for model, objs in interactions.items():
+            bulk_create_polymorphic(model, objs)
+
+    return pairs
@@ -3,6 +3,7 @@ from Bio.PDB.NeighborSearch import NeighborSearch
 
 from contactnetwork.interaction import *
 from contactnetwork.pdb import *
+from contactnetwork.vectorized import get_structure_interactions
 
 from structure.models import Structure
 
@@ -10,21 +11,44 @@ from structure.models import Structure
 NUM_SKIP_RESIDUES = 4
 
 
-def compute_interactions(pdb_name):
+def get_preferred_chain(pdb_name, structure=None):
     # Ensure that the PDB name is lowercase
     pdb_name = pdb_name.lower()
 
     # Get the pdb structure
-    s = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
+    if structure is None:
+        structure = Structure.objects.select_related('pdb_data').get(protein_conformation__protein__entry_name=pdb_name)
 
     # Get the preferred chain
-    preferred_chain = s.preferred_chain.split(',')[0]
+    preferred_chain = structure.preferred_chain.split(',')[0]
 
-    # Get the Biopython structure for the PDB
-    s = pdb_get_structure(pdb_name)
+    # Get the Biopython structure for the PDB, from the stored PDB data if available
+    if structure.pdb_data:
+        s = pdb_get_structure_from_data(pdb_name, structure.pdb_data.pdb, preferred_chain)
+    else:
+        s = pdb_get_structure(pdb_name)
 
+    return s[0][preferred_chain]
+
+
+def compute_interactions(pdb_name, structure=None, vectorized=True):
+    chain = get_preferred_chain(pdb_name, structure)
+
+    if vectorized:
+        # Classify all contacts of the chain at once
+        interactions = get_structure_interactions(chain, NUM_SKIP_RESIDUES)
+    else:
+        interactions = compute_pair_interactions(chain)
+
+    # Split unto classified and unclassified.
+    classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
+
+    return classified
+
+
+def compute_pair_interactions(chain):
     # Get all atoms
-    atom_list = Selection.unfold_entities(s[0][preferred_chain], 'A')
+    atom_list = Selection.unfold_entities(chain, 'A')
 
     # Search for all neighbouring residues
     ns = NeighborSearch(atom_list)
@@ -37,9 +61,4 @@ def compute_interactions(pdb_name):
     all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(pair[0].id[1] - pair[1].id[1]) > NUM_SKIP_RESIDUES]
 
     # For each pair of interacting residues, determine the type of interaction
-    interactions = [InteractingPair(res_pair[0], res_pair[1], get_interactions(res_pair[0], res_pair[1])) for res_pair in all_aa_neighbors]
-
-    # Split unto classified and unclassified.
-    classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
-
-    return classified
+    return [InteractingPair(res_pair[0], res_pair[1], get_interactions(res_pair[0], res_pair[1])) for res_pair in all_aa_neighbors]
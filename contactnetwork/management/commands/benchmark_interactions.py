@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+
+from structure.models import Structure
+from contactnetwork.cube import get_preferred_chain, compute_pair_interactions, NUM_SKIP_RESIDUES
+from contactnetwork.vectorized import get_structure_interactions
+
+import logging
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare run time and results of the vectorized and the per residue pair interaction classifiers.'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--structure',
+            action='append',
+            dest='structure',
+            help='PDB code of structure to benchmark. Can be used multiple times')
+        parser.add_argument('-n', '--number',
+            type=int,
+            action='store',
+            dest='number',
+            default=10,
+            help='Number of structures to benchmark, if no structures are specified')
+
+    def handle(self, *args, **options):
+        structures = Structure.objects.exclude(refined=True).exclude(pdb_data=None).select_related(
+            'protein_conformation__protein', 'pdb_data').order_by('pk')
+        if options['structure']:
+            structures = structures.filter(pdb_code__index__in=[pdb.upper() for pdb in options['structure']])
+        else:
+            structures = structures[:options['number']]
+
+        total_pair_time = 0
+        total_vectorized_time = 0
+        for s in structures:
+            pdb_code = s.protein_conformation.protein.entry_name
+            try:
+                chain = get_preferred_chain(pdb_code, s)
+            except Exception as msg:
+                self.logger.error('Error with parsing {}: {}'.format(pdb_code, msg))
+                continue
+
+            start = time.time()
+            pair_interactions = compute_pair_interactions(chain)
+            pair_time = time.time() - start
+
+            start = time.time()
+            vectorized_interactions = get_structure_interactions(chain, NUM_SKIP_RESIDUES)
+            vectorized_time = time.time() - start
+
+            total_pair_time += pair_time
+            total_vectorized_time += vectorized_time
+            identical = self.summarize(pair_interactions) == self.summarize(vectorized_interactions)
+            print('{}\t{} pairs\tper pair {:.2f}s\tvectorized {:.2f}s\t{}'.format(pdb_code, len(pair_interactions),
+                pair_time, vectorized_time, 'identical' if identical else 'DIFFERENT'))
+            if not identical:
+                self.logger.warning('Vectorized interactions differ for {}'.format(pdb_code))
+
+        if total_vectorized_time:
+            print('Total: per pair {:.2f}s, vectorized {:.2f}s ({:.1f}x)'.format(total_pair_time,
+                total_vectorized_time, total_pair_time / total_vectorized_time))
+
+    def summarize(self, interacting_pairs):
+        """Residue pairs and interaction names, independent of the order of the pairs"""
+        summary = set()
+        for p in interacting_pairs:
+            interactions = tuple([(i.get_name(), getattr(i, 'is_charged_res1', None), getattr(i, 'is_charged_res2',
+                None)) for i in p.get_interactions()])
+            summary.add((p.get_residue_1().get_full_id(), p.get_residue_2().get_full_id(), interactions))
+        return summary
@@ -1,11 +1,20 @@
+from django.conf import settings
+
 import urllib.request
 import os
+import hashlib
+import pickle
 
 from Bio.PDB import *
 from Bio.PDB.PDBExceptions import PDBException
 
 from io import StringIO
 
+from common.tools import create_cache_dirs
+
+# Location of parsed structures in the build cache
+STRUCTURE_CACHE_PATH = ['contactnetwork', 'structures']
+
 # Download the specified PDB file from RCSB.
 def pdb_get_structure(pdb_name):
     # Download the PDB
@@ -27,3 +36,33 @@ def pdb_get_structure(pdb_name):
     # Return the structure
     p = PDBParser(QUIET=True)
     return p.get_structure(pdb_name, f)
+
+# Parse the chain of a structure from the PDB data stored in the database.
+def pdb_get_structure_from_data(pdb_name, pdb_data, chain):
+    # Only keep the atoms of the requested chain (and model records, to keep models apart)
+    lines = [line for line in pdb_data.split('\n') if line.startswith(('MODEL', 'ENDMDL'))
+        or (line.startswith(('ATOM', 'HETATM')) and line[21:22] == chain)]
+    contents = '\n'.join(lines)
+
+    # Parsed structures are cached by the contents, so that updated PDB data is parsed again
+    file_id = '{}_{}_{}'.format(pdb_name, chain, hashlib.md5(contents.encode('utf-8')).hexdigest())
+    cache_dir_path = os.sep.join([settings.BUILD_CACHE_DIR] + STRUCTURE_CACHE_PATH)
+    cache_file_path = os.sep.join([cache_dir_path, file_id + '.pkl'])
+    if os.path.isfile(cache_file_path):
+        try:
+            with open(cache_file_path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except (pickle.UnpicklingError, EOFError):
+            pass
+
+    p = PDBParser(QUIET=True)
+    s = p.get_structure(pdb_name, StringIO(contents))
+
+    # Write to a temporary file first, parallel builds may read the same file
+    create_cache_dirs(STRUCTURE_CACHE_PATH)
+    tmp_file_path = '{}.{}.tmp'.format(cache_file_path, os.getpid())
+    with open(tmp_file_path, 'wb') as cache_file:
+        pickle.dump(s, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file_path, cache_file_path)
+
+    return s
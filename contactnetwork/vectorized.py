@@ -0,0 +1,241 @@
+from contactnetwork.interaction import *
+
+from itertools import product
+import numpy
+
+# Distance cutoff for interacting residues
+NEIGHBOR_DISTANCE = 4.5
+
+
+class StructureAtoms:
+    """Coordinates and annotations of all atoms of a list of Biopython residues, as NumPy arrays. Contacts of a
+    whole structure are classified from these arrays in a few vectorized passes, with the same results as
+    contactnetwork.interaction.get_interactions"""
+
+    def __init__(self, residues):
+        self.residues = residues
+
+        coords = []
+        atom_residues = []
+        elements = []
+        names = []
+        for i, res in enumerate(residues):
+            for atom in res.child_list:
+                coords.append(atom.coord)
+                atom_residues.append(i)
+                elements.append(atom.element)
+                names.append(atom.name)
+        self.coords = numpy.array(coords, dtype=numpy.float64).reshape(-1, 3)
+        self.atom_residues = numpy.array(atom_residues, dtype=numpy.intp)
+        elements = numpy.array(elements, dtype=object)
+        names = numpy.array(names, dtype=object)
+
+        # atom annotations
+        self.is_carbon = elements == 'C'
+        self.is_backbone_polar = (names == 'N') | (names == 'O')
+        self.is_sidechain_polar = (((elements == 'N') & (names != 'N')) | ((elements == 'O') & (names != 'O'))
+            | (elements == 'S'))
+        self.vdw_radii = numpy.array([VDW_RADII.get(e, numpy.nan) for e in elements], dtype=numpy.float64)
+
+        # residue annotations
+        resnames = [res.get_resname() for res in residues]
+        self.sequence_numbers = numpy.array([res.id[1] for res in residues], dtype=numpy.int64)
+        self.is_aromatic = numpy.array([r in AROMATIC_AA for r in resnames], dtype=bool)
+        self.is_pos_charged = numpy.array([r in POS_CHARGED_AA for r in resnames], dtype=bool)
+        self.is_charged = self.is_pos_charged | numpy.array([r in NEG_CHARGED_AA for r in resnames], dtype=bool)
+        self.has_backbone_polar = numpy.array([('N' in res.child_dict and 'O' in res.child_dict) for res in residues],
+            dtype=bool)
+        self.has_sidechain_polar = numpy.zeros(len(residues), dtype=bool)
+        self.has_sidechain_polar[self.atom_residues[self.is_sidechain_polar]] = True
+
+        # position of the atom used for pi-cation interactions (NaN if missing)
+        self.cation_coords = numpy.full((len(residues), 3), numpy.nan)
+        for i, res in enumerate(residues):
+            if self.is_pos_charged[i]:
+                atom_name = get_pos_charged_atom_names(res)[0]
+                if atom_name in res.child_dict:
+                    self.cation_coords[i] = res.child_dict[atom_name].coord
+
+        self.get_rings()
+
+    def get_rings(self):
+        """Ring centers and unit normals of all aromatic residues, stored consecutively per residue"""
+        centers = []
+        normals = []
+        self.ring_counts = numpy.zeros(len(self.residues), dtype=numpy.intp)
+        for i, res in enumerate(self.residues):
+            if not self.is_aromatic[i]:
+                continue
+            for ring_atoms in get_ring_atom_name_lists(res):
+                ring_coords = numpy.array([a.coord for a in ring_atoms], dtype=numpy.float64)
+                centers.append(ring_coords.mean(axis=0))
+                normals.append(numpy.cross(ring_coords[0] - ring_coords[1], ring_coords[0] - ring_coords[2]))
+                self.ring_counts[i] += 1
+
+        self.ring_centers = numpy.array(centers, dtype=numpy.float64).reshape(-1, 3)
+        normals = numpy.array(normals, dtype=numpy.float64).reshape(-1, 3)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            self.ring_normals = normals / numpy.linalg.norm(normals, axis=1)[:, None]
+        self.ring_starts = numpy.cumsum(self.ring_counts) - self.ring_counts
+
+    def atom_neighbors(self, cutoff=NEIGHBOR_DISTANCE):
+        """All pairs of atoms (i < j) within the cutoff distance, found with a grid of cutoff sized cells"""
+        n = len(self.coords)
+        if not n:
+            empty = numpy.zeros(0, dtype=numpy.intp)
+            return empty, empty, numpy.zeros(0)
+
+        # cell of each atom, with an empty border so that neighbouring cells never wrap around
+        cells = numpy.floor((self.coords - self.coords.min(axis=0)) / cutoff).astype(numpy.int64) + 1
+        dims = cells.max(axis=0) + 2
+        keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+        order = numpy.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+
+        atoms_1 = []
+        atoms_2 = []
+        for dx, dy, dz in product((-1, 0, 1), repeat=3):
+            neighbor_keys = keys + (dx * dims[1] + dy) * dims[2] + dz
+            starts = numpy.searchsorted(sorted_keys, neighbor_keys, side='left')
+            counts = numpy.searchsorted(sorted_keys, neighbor_keys, side='right') - starts
+            total = counts.sum()
+            if not total:
+                continue
+            i = numpy.repeat(numpy.arange(n), counts)
+            offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            j = order[numpy.repeat(starts, counts) + offsets]
+            keep = i < j
+            atoms_1.append(i[keep])
+            atoms_2.append(j[keep])
+
+        atoms_1 = numpy.concatenate(atoms_1)
+        atoms_2 = numpy.concatenate(atoms_2)
+        distances = numpy.linalg.norm(self.coords[atoms_1] - self.coords[atoms_2], axis=1)
+        close = distances <= cutoff
+        return atoms_1[close], atoms_2[close], distances[close]
+
+    def residue_pairs(self, num_skip_residues):
+        """Residue pairs in contact, ordered by residue index, with the atom pairs of each residue pair. Pairs of
+        residues up to num_skip_residues apart in sequence are skipped"""
+        atoms_1, atoms_2, distances = self.atom_neighbors()
+
+        # orient every atom pair so that the first atom belongs to the first residue of the pair
+        swap = self.atom_residues[atoms_1] > self.atom_residues[atoms_2]
+        atoms_1, atoms_2 = numpy.where(swap, atoms_2, atoms_1), numpy.where(swap, atoms_1, atoms_2)
+        residues_1 = self.atom_residues[atoms_1]
+        residues_2 = self.atom_residues[atoms_2]
+
+        keep = ((residues_1 != residues_2)
+            & (numpy.abs(self.sequence_numbers[residues_1] - self.sequence_numbers[residues_2]) > num_skip_residues))
+        atoms_1, atoms_2, distances = atoms_1[keep], atoms_2[keep], distances[keep]
+        residues_1, residues_2 = residues_1[keep], residues_2[keep]
+
+        pair_keys, pair_index = numpy.unique(residues_1 * len(self.residues) + residues_2, return_inverse=True)
+        pairs = numpy.stack([pair_keys // len(self.residues), pair_keys % len(self.residues)], axis=1)
+        return pairs, pair_index.reshape(-1), atoms_1, atoms_2, distances
+
+    def expand_rings(self, residues, first_only):
+        """Ring indices of the given residues, as (index into residues, ring index) for the first or all rings"""
+        counts = numpy.minimum(self.ring_counts[residues], 1) if first_only else self.ring_counts[residues]
+        index = numpy.repeat(numpy.arange(len(residues)), counts)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return index, self.ring_starts[residues][index] + offsets
+
+    def ring_contacts(self, residues_a, residues_b, max_distance, angle_test):
+        """For each residue pair, whether the first ring of residue a and any ring of residue b are closer than
+        max_distance, with an acute angle between the ring planes that passes angle_test"""
+        result = numpy.zeros(len(residues_a), dtype=bool)
+        index_a, rings_a = self.expand_rings(residues_a, True)
+        index_b, rings_b = self.expand_rings(residues_b[index_a], False)
+        index = index_a[index_b]
+        rings_a = rings_a[index_b]
+
+        cos = numpy.abs(numpy.einsum('ij,ij->i', self.ring_normals[rings_a], self.ring_normals[rings_b]))
+        with numpy.errstate(invalid='ignore'):
+            angles = numpy.arccos(numpy.clip(cos, -1.0, 1.0))
+            distances = numpy.linalg.norm(self.ring_centers[rings_a] - self.ring_centers[rings_b], axis=1)
+            hit = angle_test(angles) & (distances < max_distance)
+        result[index[hit]] = True
+        return result
+
+    def pi_cation_contacts(self, aromatic_residues, charged_residues):
+        """For each residue pair, whether the charged atom of the second residue is close to any ring of the first"""
+        result = numpy.zeros(len(aromatic_residues), dtype=bool)
+        index, rings = self.expand_rings(aromatic_residues, False)
+        with numpy.errstate(invalid='ignore'):
+            distances = numpy.linalg.norm(self.cation_coords[charged_residues[index]] - self.ring_centers[rings], axis=1)
+            hit = distances < 4.2
+        result[index[hit]] = True
+        return result
+
+    def get_interacting_pairs(self, num_skip_residues):
+        """InteractingPair objects for all residue pairs in contact, in the same format as
+        contactnetwork.cube.compute_interactions"""
+        pairs, pair_index, atoms_1, atoms_2, distances = self.residue_pairs(num_skip_residues)
+        res_1 = pairs[:, 0]
+        res_2 = pairs[:, 1]
+
+        def any_per_pair(atom_pair_mask):
+            result = numpy.zeros(len(pairs), dtype=bool)
+            result[pair_index[atom_pair_mask]] = True
+            return result
+
+        # aromatic interactions
+        both_aromatic = self.is_aromatic[res_1] & self.is_aromatic[res_2]
+        parallel = lambda angles: angles < 0.34906585
+        perpendicular = lambda angles: numpy.abs(angles - 1.5707963267) < 0.523598776
+        face_to_face = both_aromatic & self.ring_contacts(res_1, res_2, 5.0, parallel)
+        edge_to_face = both_aromatic & self.ring_contacts(res_1, res_2, 5.2, perpendicular)
+        face_to_edge = both_aromatic & self.ring_contacts(res_2, res_1, 5.2, perpendicular)
+        pi_cation = self.is_aromatic[res_1] & self.is_pos_charged[res_2] & self.pi_cation_contacts(res_1, res_2)
+        cation_pi = self.is_pos_charged[res_1] & self.is_aromatic[res_2] & self.pi_cation_contacts(res_2, res_1)
+
+        # hydrophobic interactions
+        close = distances < NEIGHBOR_DISTANCE
+        hydrophobic = any_per_pair(close & self.is_carbon[atoms_1] & self.is_carbon[atoms_2])
+
+        # polar interactions (sidechain-sidechain is decided per residue, like
+        # get_polar_sidechain_sidechain_interactions, which compares the sidechain of residue 1 with itself)
+        backbone_sidechain = self.has_backbone_polar[res_1] & any_per_pair(close & self.is_backbone_polar[atoms_1]
+            & self.is_sidechain_polar[atoms_2])
+        sidechain_backbone = self.has_backbone_polar[res_2] & any_per_pair(close & self.is_sidechain_polar[atoms_1]
+            & self.is_backbone_polar[atoms_2])
+        sidechain_sidechain = self.has_sidechain_polar[res_1]
+
+        # van der Waals interactions
+        with numpy.errstate(invalid='ignore'):
+            van_der_waals = any_per_pair(distances < (self.vdw_radii[atoms_1] + self.vdw_radii[atoms_2])
+                * VDW_TRESHOLD_FACTOR)
+
+        interacting_pairs = []
+        for p, (r1, r2) in enumerate(pairs):
+            charged = (bool(self.is_charged[r1]), bool(self.is_charged[r2]))
+            interactions = []
+            if face_to_face[p]:
+                interactions.append(FaceToFaceInteraction())
+            if edge_to_face[p]:
+                interactions.append(EdgeToFaceInteraction())
+            if face_to_edge[p]:
+                interactions.append(FaceToEdgeInteraction())
+            if pi_cation[p]:
+                interactions.append(PiCationInteraction())
+            if cation_pi[p]:
+                interactions.append(CationPiInteraction())
+            if hydrophobic[p]:
+                interactions.append(HydrophobicInteraction())
+            if backbone_sidechain[p]:
+                interactions.append(PolarBackboneSidechainInteraction(*charged))
+            if sidechain_backbone[p]:
+                interactions.append(PolarSideChainBackboneInteraction(*charged))
+            if sidechain_sidechain[p]:
+                interactions.append(PolarSidechainSidechainInteraction(*charged))
+            if van_der_waals[p]:
+                interactions.append(VanDerWaalsInteraction())
+            interacting_pairs.append(InteractingPair(self.residues[r1], self.residues[r2], interactions))
+
+        return interacting_pairs
+
+
+def get_structure_interactions(residues, num_skip_residues):
+    """Classify the contacts between all amino acid residues of a structure (e.g. a Biopython chain)"""
+    return StructureAtoms([res for res in residues if is_aa(res)]).get_interacting_pairs(num_skip_residues)
@@ -168,6 +168,8 @@ def InteractionData(request):
     proteins =  Protein.objects.filter(protein__entry_name__in=pdbs).all()
 
     a = Alignment()
+    a.use_matrix = True
+    a.use_cache = True
     a.load_proteins(proteins)
     a.load_segments(segments) #get all segments to make correct diagrams
     # build the alignment data matrix
@@ -20,6 +20,8 @@ from residue.models import Residue, ResidueGenericNumber, ResidueGenericNumberEq
 from common.models import WebResource
 from common.models import WebLink
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
+from common.export import export_response
+from residue.residue_index import get_residue_index
 from common.selection import SimpleSelection, Selection, SelectionItem
 from common import definitions
 from common.views import AbsTargetSelection
@@ -431,12 +433,11 @@ def extract_fragment_rotamer(f, residue, structure, ligand):
                 rotamer_pdb += line
         f_in.close()
 
-        rotamer_data, created = PdbData.objects.get_or_create(pdb=rotamer_pdb)
+        rotamer_data, created = PdbData.objects.get_or_create_pdb(rotamer_pdb)
         rotamer, created = Rotamer.objects.get_or_create(
             residue=residue, structure=structure, pdbdata=rotamer_data)
 
-        fragment_data, created = PdbData.objects.get_or_create(
-            pdb=fragment_pdb)
+        fragment_data, created = PdbData.objects.get_or_create_pdb(fragment_pdb)
         fragment, created = Fragment.objects.get_or_create(
             ligand=ligand, structure=structure, pdbdata=fragment_data, residue=residue)
     else:
@@ -466,8 +467,8 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
         if structure.pdb_data is None:
             f = module_dir + "/pdbs/" + pdbname + ".pdb"
             if os.path.isfile(f):
-                pdbdata, created = PdbData.objects.get_or_create(
-                    pdb=open(f, 'r').read())  # does this close the file?
+                pdbdata, created = PdbData.objects.get_or_create_pdb(
+                    open(f, 'r').read())  # does this close the file?
             else:
                 print('quitting due to no pdb in filesystem')
                 quit()
@@ -497,8 +498,8 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
                 f = module_dir + "/results/" + pdbname + "/interaction" + \
                     "/" + pdbname + "_" + temp[1] + ".pdb"
                 if os.path.isfile(f):
-                    pdbdata, created = PdbData.objects.get_or_create(
-                        pdb=open(f, 'r').read())  # does this close the file?
+                    pdbdata, created = PdbData.objects.get_or_create_pdb(
+                        open(f, 'r').read())  # does this close the file?
                     if debug:
                         print("Found file" + f)
                 else:
@@ -1028,6 +1029,8 @@ def download(request):
     return response
 
 def excel(request, slug, **response_kwargs):
+    headers = ['Ligand','Amino Acid','Sequence Number','Generic Number','Segment','Interaction','Interaction Slug']
+
     if ('session' in response_kwargs):
         session = request.session.session_key
 
@@ -1038,85 +1041,42 @@ def excel(request, slug, **response_kwargs):
         structure_residues = generic_numbering.residues
         results = parseusercalculation(slug,session)
 
-        data = []
-        for interaction in results[0][2][0]['interactions']:
-            aa, pos, chain = regexaa(interaction[0])
-            if int(pos) in structure_residues[chain]:
-                r = structure_residues[chain][int(pos)]
-                display = r.display
-                segment = r.segment
-                generic = r.gpcrdb
-            else:
-                display = ''
-                segment = ''
-            row = {}
-            row['Sequence Number'] = pos
-            row['Amino Acid'] = aa
-            row['Generic Number'] = display
-            row['Segment'] = segment
-            row['Interaction'] = interaction[3]
-            row['Interaction Slug'] = interaction[2]
-            row['Ligand'] = results[0][2][0]['prettyname']
-
-            data.append(row)
+        def rows():
+            for interaction in results[0][2][0]['interactions']:
+                aa, pos, chain = regexaa(interaction[0])
+                if int(pos) in structure_residues[chain]:
+                    r = structure_residues[chain][int(pos)]
+                    display = r.display
+                    segment = r.segment
+                    generic = r.gpcrdb
+                else:
+                    display = ''
+                    segment = ''
+                yield [results[0][2][0]['prettyname'], aa, pos, display, segment, interaction[3], interaction[2]]
 
     else:
 
         interactions = ResidueFragmentInteraction.objects.filter(
-            structure_ligand_pair__structure__pdb_code__index=slug, structure_ligand_pair__annotated=True).order_by('rotamer__residue__sequence_number')
-        # return HttpResponse("Hello, world. You're at the polls index. "+slug)
-        data = []
-        for interaction in interactions:
-
-            row = {}
-            row['Sequence Number'] = interaction.rotamer.residue.sequence_number
-            row['Amino Acid'] = interaction.rotamer.residue.amino_acid
-            if interaction.rotamer.residue.display_generic_number:
-                row['Generic Number'] = interaction.rotamer.residue.display_generic_number.label
-            else:
-                row['Generic Number'] = 'N/A'
-
-            row['Segment'] = interaction.rotamer.residue.protein_segment.slug
-            row['Interaction'] = interaction.interaction_type.name
-            row['Interaction Slug'] = interaction.interaction_type.slug
-            row['Ligand'] = interaction.structure_ligand_pair.ligand.name
-
-            data.append(row)
-
-    headers = ['Ligand','Amino Acid','Sequence Number','Generic Number','Segment','Interaction','Interaction Slug']
+            structure_ligand_pair__structure__pdb_code__index=slug, structure_ligand_pair__annotated=True).order_by(
+            'rotamer__residue__sequence_number').select_related('rotamer__residue__display_generic_number',
+            'rotamer__residue__protein_segment', 'interaction_type', 'structure_ligand_pair__ligand')
+
+        def rows():
+            for interaction in interactions.iterator():
+                residue = interaction.rotamer.residue
+                if residue.display_generic_number:
+                    generic_number = residue.display_generic_number.label
+                else:
+                    generic_number = 'N/A'
+                yield [interaction.structure_ligand_pair.ligand.name, residue.amino_acid, residue.sequence_number,
+                    generic_number, residue.protein_segment.slug, interaction.interaction_type.name,
+                    interaction.interaction_type.slug]
 
-    #EXCEL SOLUTION
-    output = BytesIO()
-    workbook = xlsxwriter.Workbook(output)
-    worksheet = workbook.add_worksheet()
-
-    col = 0
-    for h in headers:
-        worksheet.write(0, col, h)
-        col += 1
-    row = 1
-    for d in data:
-        col = 0
-        for h in headers:
-            worksheet.write(row, col, d[h])
-            col += 1
-        row += 1
-    workbook.close()
-    output.seek(0)
-    xlsx_data = output.read()
-
-    response = HttpResponse(xlsx_data,content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response['Content-Disposition'] = 'attachment; filename=Interaction_data_%s.xlsx' % slug
-    return response
+    return export_response('Interaction_data_%s' % slug, headers, rows(), request.GET.get('format', 'xlsx'))
 
 def ajax(request, slug, **response_kwargs):
 
-    residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('protein_segment','display_generic_number','generic_number')
-    lookup = {}
-
-    for r in residuelist:
-        if r.generic_number:
-            lookup[r.generic_number.label] = r.sequence_number
+    lookup = get_residue_index(slug).generic_number_lookup()
 
     interactions = ResidueFragmentInteraction.objects.filter(
         structure_ligand_pair__structure__protein_conformation__protein__parent__entry_name=slug, structure_ligand_pair__annotated=True).exclude(interaction_type__type ='hidden').order_by('rotamer__residue__sequence_number')
@@ -1140,12 +1100,7 @@ def ajax(request, slug, **response_kwargs):
 
 def ajaxLigand(request, slug, ligand, **response_kwargs):
     print(ligand)
-    residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('protein_segment','display_generic_number','generic_number')
-    lookup = {}
-
-    for r in residuelist:
-        if r.generic_number:
-            lookup[r.generic_number.label] = r.sequence_number
+    lookup = get_residue_index(slug).generic_number_lookup()
 
 
     interactions = ResidueFragmentInteraction.objects.filter(
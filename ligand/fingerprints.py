@@ -0,0 +1,173 @@
+from django.conf import settings
+
+from ligand.models import Ligand, AssayExperiment
+
+from collections import OrderedDict
+import os
+import json
+import numpy as np
+
+
+FINGERPRINT_BITS = 2048
+MORGAN_RADIUS = 2
+
+# number of set bits of every 16 bit integer
+POPCOUNT_16 = np.array([bin(i).count('1') for i in range(2**16)], dtype=np.uint8)
+
+
+def pack_fingerprint(fp):
+    """RDKit bit vector as packed bytes"""
+    bits = np.frombuffer(fp.ToBitString().encode('ascii'), dtype=np.uint8) - ord('0')
+    return np.packbits(bits)
+
+
+def smiles_fingerprints(smiles):
+    """Packed Morgan (similarity) and pattern (substructure screening) fingerprints of a SMILES, or None if RDKit can
+    not parse it. RDKit is only needed when fingerprints are calculated"""
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem import AllChem
+    RDLogger.DisableLog('rdApp.*')
+
+    mol = Chem.MolFromSmiles(smiles) if smiles else None
+    if mol is None:
+        return None
+    morgan = AllChem.GetMorganFingerprintAsBitVect(mol, MORGAN_RADIUS, nBits=FINGERPRINT_BITS)
+    pattern = Chem.PatternFingerprint(mol, fpSize=FINGERPRINT_BITS)
+    return pack_fingerprint(morgan), pack_fingerprint(pattern)
+
+
+def popcount(fingerprints):
+    """Number of set bits of each row of a packed fingerprint matrix"""
+    fingerprints = np.ascontiguousarray(fingerprints)
+    return POPCOUNT_16[fingerprints.view(np.uint16)].sum(axis=1, dtype=np.int32)
+
+
+class FingerprintStore:
+    """Precomputed fingerprints of all LigandProperities with a SMILES, built by build_ligand_fingerprints. The
+    fingerprints are stored as packed bit matrices (ligands x bytes), and compared to a query with vectorized
+    popcounts, in chunks of rows"""
+
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'ligand_fingerprints'])
+    index_file = 'index.json'
+    arrays = ['ids', 'morgan', 'morgan_counts', 'pattern']
+    chunk_size = 100000
+
+    def __init__(self, store_dir=None):
+        if store_dir:
+            self.store_dir = store_dir
+        self.index_path = os.sep.join([self.store_dir, self.index_file])
+        self.loaded_mtime = None
+        self.data = {}
+
+    def load(self):
+        """Read the store, reloading it if the store has been rebuilt. Returns False if there is no store"""
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            self.loaded_mtime = None
+            return False
+        if mtime == self.loaded_mtime:
+            return True
+
+        with open(self.index_path) as index_file:
+            index = json.load(index_file)
+        self.data = {name: np.load(self.array_path(name, index['build']), mmap_mode='r') for name in self.arrays}
+        self.loaded_mtime = mtime
+        return True
+
+    def array_path(self, name, build):
+        return os.sep.join([self.store_dir, '{}.{}.npy'.format(name, build)])
+
+    def save(self, ids, morgan, pattern, build):
+        """Write the fingerprints of a build, then the index, and remove files of older builds"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        arrays = {'ids': np.asarray(ids, dtype=np.int64), 'morgan': morgan, 'morgan_counts': popcount(morgan),
+            'pattern': pattern}
+        for name in self.arrays:
+            np.save(self.array_path(name, build), arrays[name])
+
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_index_path, 'w') as index_file:
+            json.dump({'build': build, 'ligands': len(ids), 'bits': FINGERPRINT_BITS}, index_file)
+        os.replace(tmp_index_path, self.index_path)
+
+        current_files = [os.path.basename(self.array_path(name, build)) for name in self.arrays]
+        for file_name in os.listdir(self.store_dir):
+            if file_name.endswith('.npy') and file_name not in current_files:
+                os.remove(os.sep.join([self.store_dir, file_name]))
+
+    def similar(self, query_fingerprint, top=50, min_similarity=0):
+        """LigandProperities ids and Tanimoto similarities of the most similar ligands to a packed Morgan fingerprint"""
+        query_count = popcount(query_fingerprint[None, :])[0]
+        similarities = np.zeros(len(self.data['ids']), dtype=np.float32)
+        for start in range(0, len(similarities), self.chunk_size):
+            end = start + self.chunk_size
+            common = popcount(self.data['morgan'][start:end] & query_fingerprint)
+            union = self.data['morgan_counts'][start:end] + query_count - common
+            similarities[start:end] = common / np.maximum(union, 1)
+
+        top = max(0, min(top, len(similarities)))
+        best = np.argpartition(-similarities, top - 1)[:top] if top else np.zeros(0, dtype=np.intp)
+        best = best[np.argsort(-similarities[best], kind='mergesort')]
+        best = best[similarities[best] >= min_similarity]
+        return [(int(self.data['ids'][i]), float(similarities[i])) for i in best]
+
+    def substructure_candidates(self, query_pattern):
+        """LigandProperities ids of ligands whose pattern fingerprint contains all bits of the query, a superset of
+        the ligands containing the query as a substructure"""
+        candidates = []
+        for start in range(0, len(self.data['ids']), self.chunk_size):
+            end = start + self.chunk_size
+            matches = ((self.data['pattern'][start:end] & query_pattern) == query_pattern).all(axis=1)
+            candidates.append(self.data['ids'][start:end][matches])
+        return np.concatenate(candidates).tolist() if candidates else []
+
+
+# shared store instance, reloaded when the store is rebuilt
+fingerprint_store = FingerprintStore()
+
+
+def search_ligands(smiles, search_type='similarity', top=50, min_similarity=0, max_candidates=5000):
+    """Ligands similar to a SMILES (Tanimoto similarity of Morgan fingerprints), or containing it as a substructure,
+    with the targets of their assay experiments. Returns None if the SMILES can not be parsed, or if there is no
+    fingerprint store"""
+    fingerprints = smiles_fingerprints(smiles)
+    if not fingerprints or not fingerprint_store.load():
+        return None
+
+    if search_type == 'substructure':
+        from rdkit import Chem
+        query = Chem.MolFromSmiles(smiles)
+        candidates = fingerprint_store.substructure_candidates(fingerprints[1])[:max_candidates]
+        candidate_smiles = dict(Ligand.objects.filter(properities_id__in=candidates).values_list('properities_id',
+            'properities__smiles'))
+        hits = []
+        for lp_id in candidates:
+            mol = Chem.MolFromSmiles(candidate_smiles.get(lp_id) or '')
+            if mol is not None and mol.HasSubstructMatch(query):
+                hits.append((lp_id, None))
+                if len(hits) == top:
+                    break
+    else:
+        hits = fingerprint_store.similar(fingerprints[0], top, min_similarity)
+
+    # ligand names, preferring the canonical name, and targets
+    lp_ids = [lp_id for lp_id, similarity in hits]
+    results = OrderedDict([(lp_id, {'similarity': similarity, 'names': [], 'targets': set()})
+        for lp_id, similarity in hits])
+    for lp_id, name, canonical, smiles, inchikey in Ligand.objects.filter(properities_id__in=lp_ids).values_list(
+        'properities_id', 'name', 'canonical', 'properities__smiles', 'properities__inchikey').order_by('-canonical'):
+        results[lp_id]['names'].append(name)
+        results[lp_id]['smiles'] = smiles
+        results[lp_id]['inchikey'] = inchikey
+    for lp_id, entry_name in AssayExperiment.objects.filter(ligand__properities_id__in=lp_ids).values_list(
+        'ligand__properities_id', 'protein__entry_name').distinct():
+        results[lp_id]['targets'].add(entry_name)
+
+    output = []
+    for lp_id, result in results.items():
+        if not result['names']:
+            continue
+        output.append({'name': result['names'][0], 'similarity': result['similarity'], 'smiles': result['smiles'],
+            'inchikey': result['inchikey'], 'targets': sorted(result['targets'])})
+    return output
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0001_initial'),
+        ('ligand', '0002_auto_20170908_0758'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssayExperimentSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('record_count', models.IntegerField()),
+                ('assay_types', models.CharField(max_length=100)),
+                ('value_types', models.TextField()),
+                ('standard_units', models.TextField()),
+                ('min_standard_value', models.DecimalField(decimal_places=3, max_digits=9, null=True)),
+                ('avg_standard_value', models.DecimalField(decimal_places=3, max_digits=9, null=True)),
+                ('min_pchembl_value', models.DecimalField(decimal_places=3, max_digits=9, null=True)),
+                ('avg_pchembl_value', models.DecimalField(decimal_places=3, max_digits=9, null=True)),
+                ('max_pchembl_value', models.DecimalField(decimal_places=3, max_digits=9, null=True)),
+                ('purchasable', models.BooleanField(default=False)),
+                ('ligand', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ligand.Ligand')),
+                ('protein', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.Protein')),
+            ],
+            options={
+                'db_table': 'ligand_assay_summary',
+            },
+        ),
+        migrations.CreateModel(
+            name='LigandFamilyStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_ligands', models.IntegerField()),
+                ('num_targets', models.IntegerField()),
+                ('num_receptors', models.IntegerField()),
+                ('family', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ligand_statistics', to='protein.ProteinFamily')),
+            ],
+            options={
+                'db_table': 'ligand_family_statistics',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='assayexperimentsummary',
+            unique_together=set([('ligand', 'protein')]),
+        ),
+    ]
@@ -347,3 +347,41 @@ class LigandVendorLink(models.Model):
     vendor_external_id = models.CharField(max_length=300) #RegistryID
     sid = models.CharField(max_length=200, unique=True) #SID
     
+
+
+# sources that are listed as vendors, but do not sell ligands (ligands with links to other vendors are purchasable)
+NON_VENDOR_SOURCES = ['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem']
+
+# sources that are not listed as vendors of purchasable ligands
+NON_VENDOR_LINK_SOURCES = NON_VENDOR_SOURCES + ['IUPHAR/BPS Guide to PHARMACOLOGY']
+
+
+class AssayExperimentSummary(models.Model):
+    """Aggregated assay experiments of a ligand on a target, built by build_ligand_summaries"""
+    ligand = models.ForeignKey('Ligand')
+    protein = models.ForeignKey('protein.Protein')
+    record_count = models.IntegerField()
+    assay_types = models.CharField(max_length=100)
+    value_types = models.TextField()
+    standard_units = models.TextField()
+    min_standard_value = models.DecimalField(max_digits=9, decimal_places=3, null=True)
+    avg_standard_value = models.DecimalField(max_digits=9, decimal_places=3, null=True)
+    min_pchembl_value = models.DecimalField(max_digits=9, decimal_places=3, null=True)
+    avg_pchembl_value = models.DecimalField(max_digits=9, decimal_places=3, null=True)
+    max_pchembl_value = models.DecimalField(max_digits=9, decimal_places=3, null=True)
+    purchasable = models.BooleanField(default=False)
+
+    class Meta():
+        db_table = 'ligand_assay_summary'
+        unique_together = ('ligand', 'protein')
+
+
+class LigandFamilyStatistics(models.Model):
+    """Number of ligands and targets with assay experiments of a protein family, built by build_ligand_summaries"""
+    family = models.OneToOneField('protein.ProteinFamily', related_name='ligand_statistics')
+    num_ligands = models.IntegerField()
+    num_targets = models.IntegerField()
+    num_receptors = models.IntegerField()
+
+    class Meta():
+        db_table = 'ligand_family_statistics'
@@ -1,3 +1,63 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from ligand.fingerprints import FingerprintStore, FINGERPRINT_BITS
+
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+def fingerprint(bits):
+    """Packed fingerprint with the given bits set"""
+    unpacked = np.zeros(FINGERPRINT_BITS, dtype=np.uint8)
+    unpacked[list(bits)] = 1
+    return np.packbits(unpacked)
+
+
+class FingerprintStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        # Tanimoto similarities to the query (bits 0-9): 1, 0.5, 0, 0.8, 0.25
+        morgan = np.array([
+            fingerprint(range(10)),
+            fingerprint(range(5)),
+            fingerprint(range(100, 110)),
+            fingerprint(range(8)),
+            fingerprint(list(range(5)) + list(range(200, 210))),
+        ])
+        pattern = np.array([
+            fingerprint([1, 2, 3]),
+            fingerprint([1, 2]),
+            fingerprint([2, 3, 4]),
+            fingerprint([1, 2, 3, 4]),
+            fingerprint([5]),
+        ])
+        self.store = FingerprintStore(self.store_dir)
+        # small chunks, to compare in more than one chunk
+        self.store.chunk_size = 2
+        self.store.save([11, 12, 13, 14, 15], morgan, pattern, 1)
+        self.assertTrue(self.store.load())
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_similar(self):
+        query = fingerprint(range(10))
+        hits = self.store.similar(query, top=3)
+        self.assertEqual([lp_id for lp_id, similarity in hits], [11, 14, 12])
+        self.assertEqual([round(similarity, 2) for lp_id, similarity in hits], [1, 0.8, 0.5])
+
+        self.assertEqual([lp_id for lp_id, similarity in self.store.similar(query, top=1000)], [11, 14, 12, 15, 13])
+        self.assertEqual([lp_id for lp_id, similarity in self.store.similar(query, min_similarity=0.5)], [11, 14, 12])
+        self.assertEqual(self.store.similar(query, top=0), [])
+
+    def test_substructure_candidates(self):
+        self.assertEqual(self.store.substructure_candidates(fingerprint([2, 3])), [11, 13, 14])
+        self.assertEqual(self.store.substructure_candidates(fingerprint([6])), [])
+
+    def test_rebuild(self):
+        self.store.save([11], np.array([fingerprint([1])]), np.array([fingerprint([1])]), 2)
+        self.assertEqual(sorted(os.listdir(self.store_dir)),
+            ['ids.2.npy', 'index.json', 'morgan.2.npy', 'morgan_counts.2.npy', 'pattern.2.npy'])
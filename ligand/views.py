@@ -6,8 +6,11 @@ from django.views.generic import TemplateView, View
 
 from common.models import ReleaseNotes
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
+from common.snapshots import statistics_snapshot
 from common.selection import Selection, SelectionItem
-from ligand.models import Ligand, AssayExperiment, LigandProperities, LigandVendorLink
+from ligand.models import (Ligand, AssayExperiment, AssayExperimentSummary, LigandFamilyStatistics, LigandProperities,
+    LigandVendorLink, NON_VENDOR_LINK_SOURCES)
+from ligand.fingerprints import search_ligands
 from protein.models import Protein, Species, ProteinFamily
 
 from copy import deepcopy
@@ -41,51 +44,27 @@ class LigandBrowser(TemplateView):
 
 def LigandDetails(request, ligand_id):
     """
-    The details of a ligand record. Lists all the assay experiments for a given ligand.
+    The details of a ligand record. Lists the summarized assay experiments for each target of a given ligand.
     """
-    ligand_records = AssayExperiment.objects.filter(
+    summaries = AssayExperimentSummary.objects.filter(
         ligand__properities__web_links__index=ligand_id
-        ).order_by('protein__entry_name')
+        ).select_related('protein__family__parent__parent__parent__parent').order_by('protein__entry_name')
 
-    record_count = ligand_records.values(
-        'protein',
-        ).annotate(num_records = Count('protein__entry_name')
-                   ).order_by('protein__entry_name')
-    
-    
     ligand_data = []
 
-    for record in record_count:
-        per_target_data = ligand_records.filter(protein=record['protein'])
-        protein_details = Protein.objects.get(pk=record['protein'])
-
-        """
-        A dictionary of dictionaries with a list of values.
-        Assay_type
-        |
-        ->  Standard_type [list of values]
-        """
-        tmp = defaultdict(lambda: defaultdict(list))
-        tmp_count = 0
-        for data_line in per_target_data:
-            tmp[data_line.assay_type][data_line.standard_type].append(data_line.standard_value)
-            tmp_count += 1
-
-        #Flattened list of lists of dict values
-        values = list(itertools.chain(*[itertools.chain(*tmp[x].values()) for x in tmp.keys()]))
-        
+    for summary in summaries:
+        protein_details = summary.protein
         ligand_data.append({
             'protein_name': protein_details.entry_name,
             'receptor_family': protein_details.family.parent.name,
             'ligand_type': protein_details.get_protein_family(),
             'class': protein_details.get_protein_class(),
-            'record_count': tmp_count,
-            'assay_type': ', '.join(tmp.keys()),
-            #Flattened list of lists of dict keys:
-            'value_types': ', '.join(itertools.chain(*(list(tmp[x]) for x in tmp.keys()))),
-            'low_value': min(values),
-            'average_value': sum(values)/len(values),
-            'standard_units': ', '.join(list(set([x.standard_units for x in per_target_data])))
+            'record_count': summary.record_count,
+            'assay_type': summary.assay_types,
+            'value_types': summary.value_types,
+            'low_value': summary.min_standard_value,
+            'average_value': summary.avg_standard_value,
+            'standard_units': summary.standard_units
             })
 
     context = {'ligand_data': ligand_data, 'ligand':ligand_id}
@@ -93,124 +72,114 @@ def LigandDetails(request, ligand_id):
     return render(request, 'ligand_details.html', context)
 
 
-def TargetDetailsCompact(request, **kwargs):
+def LigandSimilaritySearch(request):
+    """
+    Ligands similar to a SMILES, or containing it as a substructure, with their targets. Uses the fingerprint index
+    built by build_ligand_fingerprints.
+    """
+    smiles = request.GET.get('smiles', '').strip()
+    search_type = request.GET.get('search_type', 'similarity')
+    context = {'smiles': smiles, 'search_type': search_type}
+    if smiles:
+        results = search_ligands(smiles, search_type)
+        if results is None:
+            context['error'] = 'The SMILES could not be parsed, or the ligand fingerprint index is not available.'
+        else:
+            context['results'] = results
+
+    return render(request, 'ligand_search.html', context)
 
+
+def get_target_filter(request, **kwargs):
+    """
+    Filter of the targets of a family slug, or of the targets in the selection, and the target to show in the page.
+    """
     if 'slug' in kwargs:
         slug = kwargs['slug']
         if slug.count('_') == 0 :
-            ps = AssayExperiment.objects.filter(protein__family__parent__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+            target_filter = {'protein__family__parent__parent__parent__slug': slug}
         elif slug.count('_') == 1 and len(slug) == 7:
-            ps = AssayExperiment.objects.filter(protein__family__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+            target_filter = {'protein__family__parent__parent__slug': slug}
         elif slug.count('_') == 2:
-            ps = AssayExperiment.objects.filter(protein__family__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
+            target_filter = {'protein__family__parent__slug': slug}
         #elif slug.count('_') == 3:
         elif slug.count('_') == 1 and len(slug) != 7:
-            ps = AssayExperiment.objects.filter(protein__entry_name = slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-    
+            target_filter = {'protein__entry_name': slug}
+
         if slug.count('_') == 1 and len(slug) == 7:
             f = ProteinFamily.objects.get(slug=slug)      
         else:
             f = slug
+        return target_filter, f
 
-        context = {
-            'target':f
-            }
-    else:
-        simple_selection = request.session.get('selection', False)
-        selection = Selection()
-        if simple_selection:
-            selection.importer(simple_selection)
-        if selection.targets != []:
-            prot_ids = [x.item.id for x in selection.targets]
-            ps = AssayExperiment.objects.filter(protein__in=prot_ids, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-            context = {
-                'target': ', '.join([x.item.entry_name for x in selection.targets])
-                }
-
-    ligands = [x.ligand for x in ps.distinct('ligand')]
-    record_count = ps.values(
-        'protein',
-        ).annotate(num_records = Count('protein__entry_name')
-                   ).order_by('protein__entry_name')
+    simple_selection = request.session.get('selection', False)
+    selection = Selection()
+    if simple_selection:
+        selection.importer(simple_selection)
+    prot_ids = [x.item.id for x in selection.targets]
+    return {'protein__in': prot_ids}, ', '.join([x.item.entry_name for x in selection.targets])
+
+
+def TargetDetailsCompact(request, **kwargs):
+
+    target_filter, target = get_target_filter(request, **kwargs)
+    context = {
+        'target': target
+        }
+
+    summaries = AssayExperimentSummary.objects.filter(
+        ligand__properities__web_links__web_resource__slug = 'chembl_ligand', **target_filter
+        ).values(
+            'ligand__properities__web_links__index',
+            'protein__entry_name',
+            'protein__species__common_name',
+            'record_count',
+            'assay_types',
+            'purchasable',
+            'min_pchembl_value',
+            'avg_pchembl_value',
+            'max_pchembl_value',
+            'standard_units',
+            'ligand__properities__smiles',
+            'ligand__properities__mw',
+            'ligand__properities__rotatable_bonds',
+            'ligand__properities__hdon',
+            'ligand__properities__hacc',
+            'ligand__properities__logp',
+            ).order_by('ligand', 'protein__entry_name')
     ligand_data = []
-    for lig in ligands:
-        ligand_records = ps.filter(
-            ligand=lig
-            ).order_by('protein__entry_name')
-        for record in record_count:
-            per_target_data = ligand_records.filter(protein=record['protein'])
-            if list(per_target_data) == []:
-                continue
-            protein_details = Protein.objects.get(pk=record['protein'])
-
-            """
-            A dictionary of dictionaries with a list of values.
-            Assay_type
-            |
-            ->  Standard_type [list of values]
-            """
-            tmp = defaultdict(list)
-            tmp_count = 0
-            for data_line in per_target_data:
-                tmp["Bind" if data_line.assay_type == 'b' else "Funct"].append(data_line.pchembl_value)
-                tmp_count += 1
-            values = list(itertools.chain(*tmp.values()))
-            ligand_data.append({
-                'ligand_id': lig.properities.web_links.filter(web_resource__slug = 'chembl_ligand')[0].index,
-                'protein_name': protein_details.entry_name,
-                'species': protein_details.species.common_name,
-                'record_count': tmp_count,
-                'assay_type': ', '.join(tmp.keys()),
-                'purchasability': 'Yes' if len(LigandVendorLink.objects.filter(lp=lig.properities).exclude(vendor__name__in=['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem'])) > 0 else 'No',
-                #Flattened list of lists of dict keys:
-                'low_value': min(values),
-                'average_value': sum(values)/len(values),
-                'high_value': max(values),
-                'standard_units': ', '.join(list(set([x.standard_units for x in per_target_data]))),
-                'smiles': lig.properities.smiles,
-                'mw': lig.properities.mw,
-                'rotatable_bonds': lig.properities.rotatable_bonds,
-                'hdon': lig.properities.hdon,
-                'hacc': lig.properities.hacc,
-                'logp': lig.properities.logp,
-                })
+    for summary in summaries:
+        ligand_data.append({
+            'ligand_id': summary['ligand__properities__web_links__index'],
+            'protein_name': summary['protein__entry_name'],
+            'species': summary['protein__species__common_name'],
+            'record_count': summary['record_count'],
+            'assay_type': ', '.join(sorted(set(["Bind" if x == 'b' else "Funct" for x in
+                summary['assay_types'].split(', ')]))),
+            'purchasability': 'Yes' if summary['purchasable'] else 'No',
+            'low_value': summary['min_pchembl_value'],
+            'average_value': summary['avg_pchembl_value'],
+            'high_value': summary['max_pchembl_value'],
+            'standard_units': summary['standard_units'],
+            'smiles': summary['ligand__properities__smiles'],
+            'mw': summary['ligand__properities__mw'],
+            'rotatable_bonds': summary['ligand__properities__rotatable_bonds'],
+            'hdon': summary['ligand__properities__hdon'],
+            'hacc': summary['ligand__properities__hacc'],
+            'logp': summary['ligand__properities__logp'],
+            })
     context['ligand_data'] = ligand_data
     
     return render(request, 'target_details_compact.html', context)
 
 def TargetDetails(request, **kwargs):
 
-    if 'slug' in kwargs:
-        slug = kwargs['slug']
-        if slug.count('_') == 0 :
-            ps = AssayExperiment.objects.filter(protein__family__parent__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        elif slug.count('_') == 1 and len(slug) == 7:
-            ps = AssayExperiment.objects.filter(protein__family__parent__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        elif slug.count('_') == 2:
-            ps = AssayExperiment.objects.filter(protein__family__parent__slug=slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        #elif slug.count('_') == 3:
-        elif slug.count('_') == 1 and len(slug) != 7:
-            ps = AssayExperiment.objects.filter(protein__entry_name = slug, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-    
-        if slug.count('_') == 1 and len(slug) == 7:
-            f = ProteinFamily.objects.get(slug=slug)      
-        else:
-            f = slug
-
-        context = {
-            'target':f
-            }
-    else:
-        simple_selection = request.session.get('selection', False)
-        selection = Selection()
-        if simple_selection:
-            selection.importer(simple_selection)
-        if selection.targets != []:
-            prot_ids = [x.item.id for x in selection.targets]
-            ps = AssayExperiment.objects.filter(protein__in=prot_ids, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-            context = {
-                'target': ', '.join([x.item.entry_name for x in selection.targets])
-                }
+    target_filter, target = get_target_filter(request, **kwargs)
+    context = {
+        'target': target
+        }
+    ps = AssayExperiment.objects.filter(ligand__properities__web_links__web_resource__slug = 'chembl_ligand',
+        **target_filter)
     ps = ps.values('standard_type',
                 'standard_relation',
                 'standard_value',
@@ -231,8 +200,10 @@ def TargetDetails(request, **kwargs):
                 'ligand__properities__hdon',
                 'ligand__properities__hacc','protein'
                 ).annotate(num_targets = Count('protein__id', distinct=True))
+    purchasable = set(AssayExperimentSummary.objects.filter(purchasable=True, **target_filter).values_list(
+        'ligand', 'protein'))
     for record in ps:
-        record['purchasability'] = 'Yes' if len(LigandVendorLink.objects.filter(lp=record['ligand__properities_id']).exclude(vendor__name__in=['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem'])) > 0 else 'No'
+        record['purchasability'] = 'Yes' if (record['ligand__id'], record['protein']) in purchasable else 'No'
 
     context['proteins'] = ps
 
@@ -241,16 +212,13 @@ def TargetDetails(request, **kwargs):
 
 def TargetPurchasabilityDetails(request, **kwargs):
 
-    simple_selection = request.session.get('selection', False)
-    selection = Selection()
-    if simple_selection:
-        selection.importer(simple_selection)
-    if selection.targets != []:
-        prot_ids = [x.item.id for x in selection.targets]
-        ps = AssayExperiment.objects.filter(protein__in=prot_ids, ligand__properities__web_links__web_resource__slug = 'chembl_ligand')
-        context = {
-            'target': ', '.join([x.item.entry_name for x in selection.targets])
-            }
+    target_filter, target = get_target_filter(request)
+    context = {
+        'target': target
+        }
+    purchasable_ligands = AssayExperimentSummary.objects.filter(purchasable=True, **target_filter).values('ligand')
+    ps = AssayExperiment.objects.filter(ligand__properities__web_links__web_resource__slug = 'chembl_ligand',
+        ligand__in=purchasable_ligands, **target_filter)
 
     ps = ps.values('standard_type',
                 'standard_relation',
@@ -264,6 +232,8 @@ def TargetPurchasabilityDetails(request, **kwargs):
                 'ligand__properities__web_links__index',
                 'ligand__properities__vendors__vendor__id',
                 'ligand__properities__vendors__vendor__name',
+                'ligand__properities__vendors__vendor_external_id',
+                'ligand__properities__vendors__url',
                 'protein__species__common_name',
                 'protein__entry_name',
                 'ligand__properities__mw',
@@ -275,21 +245,14 @@ def TargetPurchasabilityDetails(request, **kwargs):
                 ).annotate(num_targets = Count('protein__id', distinct=True))
     purchasable = []
     for record in ps:
-        try:
-            if record['ligand__properities__vendors__vendor__name'] in ['ZINC', 'ChEMBL', 'BindingDB', 'SureChEMBL', 'eMolecules', 'MolPort', 'PubChem', 'IUPHAR/BPS Guide to PHARMACOLOGY']:
-                continue
-            tmp = LigandVendorLink.objects.filter(vendor=record['ligand__properities__vendors__vendor__id'], lp=record['ligand__properities_id'])[0]
-            record['vendor_id'] = tmp.vendor_external_id
-            record['vendor_link'] = tmp.url
-            purchasable.append(record)
-        except:
+        if record['ligand__properities__vendors__vendor__name'] in NON_VENDOR_LINK_SOURCES:
             continue
+        record['vendor_id'] = record['ligand__properities__vendors__vendor_external_id']
+        record['vendor_link'] = record['ligand__properities__vendors__url']
+        purchasable.append(record)
 
     context['proteins'] = purchasable
 
-
-
-
     return render(request, 'target_purchasability_details.html', context)
 
 
@@ -303,24 +266,29 @@ class LigandStatistics(TemplateView):
     def get_context_data (self, **kwargs):
 
         context = super().get_context_data(**kwargs)
-        assays = AssayExperiment.objects.all().prefetch_related('protein__family__parent__parent__parent', 'protein__family')
-        classes = ProteinFamily.objects.filter(slug__in=['001', '002', '003', '004', '005', '006']) #ugly but fast
-        proteins = Protein.objects.all().prefetch_related('family__parent__parent__parent')
+        context.update(statistics_snapshot('ligand_statistics'))
+        context['release_notes'] = ReleaseNotes.objects.all()[0]
+
+        return context
+
+    def get_statistics(self):
+        """Context of the statistics page, stored as a snapshot by build_statistics_snapshots"""
+        context = {}
+        classes = LigandFamilyStatistics.objects.filter(family__slug__in=['001', '002', '003', '004', '005', '006']
+            ).select_related('family').order_by('family__slug') #ugly but fast
         ligands = []
 
-        for fam in classes:
-            lig_count = len(assays.filter(protein__family__parent__parent__parent=fam).distinct('ligand'))
-            prot_count = len(proteins.filter(family__parent__parent__parent=fam).distinct('family'))
-            target_count = len(assays.filter(protein__family__parent__parent__parent=fam).distinct('protein__family'))
+        for stats in classes:
             ligands.append({
-                'name': fam.name,
-                'num_ligands': lig_count,
-                'avg_num_ligands': lig_count/prot_count,
-                'target_percentage': target_count/prot_count*100,
-                'target_count': target_count
+                'name': stats.family.name,
+                'num_ligands': stats.num_ligands,
+                'avg_num_ligands': stats.num_ligands/stats.num_receptors,
+                'target_percentage': stats.num_targets/stats.num_receptors*100,
+                'target_count': stats.num_targets
                 })
         lig_count_total = sum([x['num_ligands'] for x in ligands])
-        prot_count_total = len(proteins.distinct('family'))
+        prot_count_total = sum(LigandFamilyStatistics.objects.filter(family__parent=None).values_list(
+            'num_receptors', flat=True))
         target_count_total = sum([x['target_count'] for x in ligands])
         lig_total = {
             'num_ligands': lig_count_total,
@@ -348,8 +316,6 @@ class LigandStatistics(TemplateView):
         context['ligands_total'] = lig_total
         context['ligands_by_class'] = ligands
 
-        context['release_notes'] = ReleaseNotes.objects.all()[0]
-
         tree = PhylogeneticTreeGenerator()
         class_a_data = tree.get_tree_data(ProteinFamily.objects.get(name='Class A (Rhodopsin)'))
         context['class_a_options'] = deepcopy(tree.d3_options)
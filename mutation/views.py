@@ -11,6 +11,8 @@ from mutation.models import *
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
+from common.export import export_response
+from common.snapshots import statistics_snapshot
 from common import definitions
 
 from residue.models import Residue,ResidueNumberingScheme, ResidueGenericNumberEquivalent
@@ -73,6 +75,35 @@ class SegmentSelection(AbsSegmentSelection):
         },
     }
 
+MUTATION_DOWNLOAD_HEADERS = ['submitting_group','reference','review','data_container','data_container_number', 'protein',
+    'mutation_pos', 'generic', 'mutation_from', 'mutation_to', 'ligand_name', 'ligand_idtype', 'ligand_id',
+    'ligand_class', 'exp_type', 'exp_func',  'exp_wt_value',  'exp_wt_unit','exp_mu_effect_sign', 'exp_mu_effect_type',
+    'exp_mu_effect_value', 'exp_fold_change', 'exp_mu_effect_qual', 'exp_mu_effect_ligand_prop',  'exp_mu_ligand_ref',
+    'opt_receptor_expression', 'opt_basal_activity', 'opt_gain_of_activity', 'opt_ligand_emax', 'opt_agonist',
+    'added_date'] #'added_by',
+
+def download_mutations(mutations, used_scheme, export_format='xlsx'):
+    """Stream the raw data of mutations, with the generic number of the class of the receptor"""
+    class_generic_numbers = dict(ResidueGenericNumberEquivalent.objects.filter(scheme__slug=used_scheme,
+        default_generic_number__label__in=mutations.values('residue__generic_number__label')).values_list(
+        'default_generic_number__label', 'label'))
+    mutations_class_generic_number = {}
+    for raw, label, exp_func, basal_activity, receptor_expression in mutations.values_list('raw',
+        'residue__generic_number__label', 'exp_func', 'opt_basal_activity', 'opt_receptor_expression').iterator():
+        # mutations without a functional assay but with optional data are not shown
+        if not exp_func and (basal_activity or receptor_expression):
+            continue
+        if label in class_generic_numbers:
+            mutations_class_generic_number[raw] = class_generic_numbers[label]
+
+    fields = [h for h in MUTATION_DOWNLOAD_HEADERS if h != 'generic']
+    def rows():
+        for values in MutationRaw.objects.filter(pk__in=mutations.values('raw')).values('id', *fields).iterator():
+            values['generic'] = mutations_class_generic_number.get(values['id'], '')
+            yield [values[h] for h in MUTATION_DOWNLOAD_HEADERS]
+
+    return export_response('GPCRdb_mutant_data', MUTATION_DOWNLOAD_HEADERS, rows(), export_format)
+
 def render_mutations(request, protein = None, family = None, download = None, receptor_class = None, gn = None, aa = None, **response_kwargs):
 
     # get the user selection from session
@@ -184,6 +215,9 @@ def render_mutations(request, protein = None, family = None, download = None, re
 
 
 
+    if download:
+        return download_mutations(mutations, used_scheme, request.GET.get('format', 'xlsx'))
+
     mutations_list = {}
     mutations_list_seq = {}
     mutations_generic_number = {}
@@ -302,31 +336,25 @@ def render_mutations(request, protein = None, family = None, download = None, re
         # create an alignment object
         #print(proteins)
         #alignment_proteins = Protein.objects.filter(protein__in=proteins)
-        protein_hash = hash(tuple(sorted(ProteinConformation.objects.filter(protein__in=alignment_proteins).values_list('id',flat=True))))
-
         excluded_segment = ['C-term','N-term']
         excluded_segment = []
         segments = ProteinSegment.objects.all().exclude(slug__in = excluded_segment).prefetch_related()
-        segment_hash = hash(tuple(sorted(segments.values_list('id',flat=True))))
 
-        consensus = cache.get(str(protein_hash)+"&"+str(segment_hash)+"&consensus")
-        generic_number_objs = cache.get(str(protein_hash)+"&"+str(segment_hash)+"&generic_number_objs")
-        if generic_number_objs == None or consensus == None or consensus == []:
-            a = Alignment()
+        a = Alignment()
+        a.use_matrix = True
+        a.use_cache = True
 
-            a.load_proteins(alignment_proteins)
+        a.load_proteins(alignment_proteins)
 
-            a.load_segments(segments) #get all segments to make correct diagrams
+        a.load_segments(segments) #get all segments to make correct diagrams
 
-            # build the alignment data matrix
-            a.build_alignment()
+        # build the alignment data matrix
+        a.build_alignment()
 
-            # calculate consensus sequence + amino acid and feature frequency
-            a.calculate_statistics()
-            consensus = a.full_consensus
-            generic_number_objs = a.generic_number_objs
-            cache.set(str(protein_hash)+"&"+str(segment_hash)+"&consensus",consensus)
-            cache.set(str(protein_hash)+"&"+str(segment_hash)+"&generic_number_objs",generic_number_objs)
+        # calculate consensus sequence + amino acid and feature frequency
+        a.calculate_statistics()
+        consensus = a.full_consensus
+        generic_number_objs = a.generic_number_objs
 
         residue_list = []
         generic_numbers = []
@@ -443,58 +471,7 @@ def render_mutations(request, protein = None, family = None, download = None, re
             context['number_of_schemes'] = ''
             context['longest_name'] = {'div' : 0, 'height': 0}
 
-    if download:
-        raws = mutations.values('raw')
-        rawmutations = MutationRaw.objects.filter(pk__in = raws).all()
-
-        data = []
-        for r in rawmutations:
-            headers = []
-            values = {}
-            values = r.__dict__ #print(r.__dict__)
-            # for field, val in r:
-            #     headers.append(field)
-            #     values[field] = val
-            # print(values)
-            if values['id'] in mutations_class_generic_number:
-                values['generic'] = mutations_class_generic_number[values['id']]
-            else:
-                values['generic'] = ''
-            data.append(values)
-        headers = ['submitting_group','reference','review','data_container','data_container_number', 'protein', 'mutation_pos', 'generic', 'mutation_from', 'mutation_to',
-        'ligand_name', 'ligand_idtype', 'ligand_id', 'ligand_class',
-        'exp_type', 'exp_func',  'exp_wt_value',  'exp_wt_unit','exp_mu_effect_sign', 'exp_mu_effect_type', 'exp_mu_effect_value', 
-        'exp_fold_change',
-        'exp_mu_effect_qual', 'exp_mu_effect_ligand_prop',  'exp_mu_ligand_ref', 'opt_receptor_expression', 'opt_basal_activity',
-        'opt_gain_of_activity', 'opt_ligand_emax', 'opt_agonist', 'added_date'
-         ] #'added_by',
-
-        #EXCEL SOLUTION
-        output = BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet()
-
-        col = 0
-        for h in headers:
-            worksheet.write(0, col, h)
-            col += 1
-        row = 1
-        for d in data:
-            col = 0
-            for h in headers:
-                worksheet.write(row, col, d[h])
-                col += 1
-            row += 1
-        workbook.close()
-        output.seek(0)
-        xlsx_data = output.read()
-
-        response = HttpResponse(xlsx_data,content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = 'attachment; filename=GPCRdb_mutant_data.xlsx' #% 'mutations'
-        return response
-
-    else:
-        return render(request, 'mutation/list.html', {'mutation_tables':mutation_tables,'mutations': mutations, 'HelixBox':HelixBox, 'SnakePlot':SnakePlot, 'data':context['data'],
+    return render(request, 'mutation/list.html', {'mutation_tables':mutation_tables,'mutations': mutations, 'HelixBox':HelixBox, 'SnakePlot':SnakePlot, 'data':context['data'],
             'header':context['header'], 'longest_name':context['longest_name'], 'segments':context['segments'], 'number_of_schemes':len(numbering_schemes), 'mutations_pos_list' : json.dumps(mutations_pos_list), 'protein_ids':str(protein_ids)})
 
 # Create your views here.
@@ -643,9 +620,16 @@ def showcalculationPDB(request):
         return render(request, 'mutation/designpdb.html', context)
 
 
-@cache_page(60 * 60 * 24 *7)
 def coverage(request):
 
+    context = dict(statistics_snapshot('mutation_coverage'))
+
+    # return render(request, 'mutation/coverage.html', context)
+    return render(request, 'mutation/statistics.html', context)
+
+def coverage_statistics():
+    """Context of the mutation coverage page, stored as a snapshot by build_statistics_snapshots"""
+
     context = {}
 
     #gpcr_class = '004' #class a
@@ -878,8 +862,7 @@ def coverage(request):
     context['tree'] = json.dumps(tree)
     context['tree2'] = json.dumps(tree2)
     print("time 7")
-    # return render(request, 'mutation/coverage.html', context)
-    return render(request, 'mutation/statistics.html', context)
+    return context
 
 
 def pocket(request):
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('protein', '0001_initial'),
+        ('residue', '0003_auto_20170929_1428'),
+        ('mutational_landscape', '0002_nhsprescribings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResidueFunctionalAnnotation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sodium_pocket', models.BooleanField(default=False)),
+                ('microswitch', models.BooleanField(default=False)),
+                ('ptm', models.CharField(max_length=40, null=True)),
+                ('ligand_interactions', models.TextField(null=True)),
+                ('gprotein_contact', models.BooleanField(default=False)),
+                ('protein', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='protein.Protein')),
+                ('residue', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='functional_annotation', to='residue.Residue')),
+            ],
+            options={
+                'db_table': 'residue_functional_annotation',
+            },
+        ),
+    ]
@@ -65,6 +65,39 @@ class PTMs(models.Model):
     class Meta():
         db_table = 'residue_ptm'
 
+class ResidueFunctionalAnnotation(models.Model):
+    """Known functional roles of a residue of a wild-type receptor, built by build_functional_annotations. Only
+    residues with at least one role are stored"""
+
+    protein = models.ForeignKey('protein.Protein')
+    residue = models.OneToOneField('residue.Residue', related_name='functional_annotation')
+    sodium_pocket = models.BooleanField(default=False)
+    microswitch = models.BooleanField(default=False)
+    ptm = models.CharField(max_length=40, null=True)
+    ligand_interactions = models.TextField(null=True) # interaction types in ligand complexes of orthologs
+    gprotein_contact = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.protein.entry_name + '_' + str(self.residue.sequence_number) + '_' + self.label()
+
+    def label(self):
+        """The annotation as shown on the variant pages"""
+        functional_annotation = ''
+        if self.sodium_pocket:
+            functional_annotation +=  'SodiumPocket '
+        if self.microswitch:
+            functional_annotation +=  'MicroSwitch '
+        if self.ptm:
+            functional_annotation +=  'PTM (' + self.ptm + ') '
+        if self.ligand_interactions:
+            functional_annotation +=  'LB (' + self.ligand_interactions + ') '
+        if self.gprotein_contact:
+            functional_annotation +=  'GP (contact) '
+        return functional_annotation
+
+    class Meta():
+        db_table = 'residue_functional_annotation'
+
 # class PTMsType(models.Model):
 #     modification = models.CharField(max_length=100, unique=True)
 #
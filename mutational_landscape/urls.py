@@ -12,6 +12,7 @@ urlpatterns = [
     url(r'^protein/(?P<protein>[^/]*?)/$', views.render_variants, name='render'),
     url(r'^ajax/NaturalMutation/(?P<slug>[-\w]+)/$', views.ajaxNaturalMutation, name='ajaxNaturalMutation'),
     url(r'^ajax/PTM/(?P<slug>[-\w]+)/$', views.ajaxPTMs, name='ajaxPTMs'),
+    url(r'^ajax/FunctionalAnnotation/(?P<slug>[-\w]+)/$', views.ajaxFunctionalAnnotation, name='ajaxFunctionalAnnotation'),
     # url(r'^ajax/CancerMutation/(?P<slug>[-\w]+)/$', views.ajaxCancerMutation, name='ajaxCancerMutation'),
     # url(r'^ajax/DiseaseMutation/(?P<slug>[-\w]+)/$', views.ajaxDiseaseMutation, name='ajaxDiseaseMutation'),
     url(r'^ajax/mutant_extract', views.mutant_extract, name='mutant_extract')
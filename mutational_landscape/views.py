@@ -7,7 +7,7 @@ from django.views.decorators.cache import cache_page
 
 from protein.models import Protein, ProteinConformation, ProteinAlias, ProteinFamily, Gene, ProteinGProtein, ProteinGProteinPair
 from residue.models import Residue, ResiduePositionSet, ResidueSet
-from mutational_landscape.models import NaturalMutations, CancerMutations, DiseaseMutations, PTMs, NHSPrescribings
+from mutational_landscape.models import NaturalMutations, CancerMutations, DiseaseMutations, PTMs, NHSPrescribings, ResidueFunctionalAnnotation
 
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
 
@@ -20,6 +20,8 @@ from interaction.models import *
 from interaction.views import ajax #import x-tal interactions
 
 from common import definitions
+from common.models import ReleaseNotes
+from common.snapshots import statistics_snapshot
 from collections import OrderedDict
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
@@ -58,6 +60,13 @@ class TargetSelection(AbsTargetSelection):
     }
     default_species = False
 
+def residue_functional_annotation(residue):
+    """Functional annotation of a residue (see build_functional_annotations), empty if it has none"""
+    try:
+        return residue.functional_annotation.label()
+    except ResidueFunctionalAnnotation.DoesNotExist:
+        return ''
+
 def render_variants(request, protein = None, family = None, download = None, receptor_class = None, gn = None, aa = None, **response_kwargs):
 
     simple_selection = request.session.get('selection', False)
@@ -94,83 +103,11 @@ def render_variants(request, protein = None, family = None, download = None, rec
                 for fp in family_proteins:
                     proteins.append(fp)
 
-    NMs = NaturalMutations.objects.filter(Q(protein__in=proteins)).prefetch_related('residue__generic_number','residue__display_generic_number','residue__protein_segment','protein')
-    ptms = PTMs.objects.filter(Q(protein__in=proteins)).prefetch_related('residue')
-    ptms_dict = {}
-
-    ## MICROSWITCHES
-    micro_switches_rset = ResiduePositionSet.objects.get(name="Microswitches")
-    ms_label = []
-    for residue in micro_switches_rset.residue_position.all():
-        ms_label.append(residue.label)
-
-    ms_object = Residue.objects.filter(protein_conformation__protein=proteins[0], generic_number__label__in=ms_label)
-    ms_sequence_numbers = []
-    for ms in ms_object:
-        ms_sequence_numbers.append(ms.sequence_number)
-
-    ## SODIUM POCKET
-    sodium_pocket_rset = ResiduePositionSet.objects.get(name="Sodium pocket")
-    sp_label = []
-    for residue in sodium_pocket_rset.residue_position.all():
-        sp_label.append(residue.label)
-
-    sp_object = Residue.objects.filter(protein_conformation__protein=proteins[0], generic_number__label__in=ms_label)
-    sp_sequence_numbers = []
-    for sp in sp_object:
-        sp_sequence_numbers.append(sp.sequence_number)
-
-    for ptm in ptms:
-        ptms_dict[ptm.residue.sequence_number] = ptm.modification
-
-    ## G PROTEIN INTERACTION POSITIONS
-    # THIS SHOULD BE CLASS SPECIFIC (different set)
-    rset = ResiduePositionSet.objects.get(name='Signalling protein pocket')
-    gprotein_generic_set = []
-    for residue in rset.residue_position.all():
-        gprotein_generic_set.append(residue.label)
-
-    ### GET LB INTERACTION DATA
-    # get also ortholog proteins, which might have been crystallised to extract
-    # interaction data also from those
-    if protein:
-        orthologs = Protein.objects.filter(family__slug=proteins[0].family.slug, sequence_type__slug='wt')
-    else:
-        orthologs = Protein.objects.filter(family__slug__startswith=proteins[0].family.slug, sequence_type__slug='wt')
-
-    interactions = ResidueFragmentInteraction.objects.filter(
-        structure_ligand_pair__structure__protein_conformation__protein__parent__in=orthologs, structure_ligand_pair__annotated=True).exclude(interaction_type__type ='hidden').all()
-    interaction_data = {}
-    for interaction in interactions:
-        if interaction.rotamer.residue.generic_number:
-            sequence_number = interaction.rotamer.residue.sequence_number
-            # sequence_number = lookup[interaction.rotamer.residue.generic_number.label]
-            label = interaction.rotamer.residue.generic_number.label
-            aa = interaction.rotamer.residue.amino_acid
-            interactiontype = interaction.interaction_type.name
-            if sequence_number not in interaction_data:
-                interaction_data[sequence_number] = []
-            if interactiontype not in interaction_data[sequence_number]:
-                interaction_data[sequence_number].append(interactiontype)
-
+    NMs = NaturalMutations.objects.filter(Q(protein__in=proteins)).select_related('residue__functional_annotation').prefetch_related('residue__generic_number','residue__display_generic_number','residue__protein_segment','protein')
     jsondata = {}
     for NM in NMs:
-        functional_annotation = ''
+        functional_annotation = residue_functional_annotation(NM.residue)
         SN = NM.residue.sequence_number
-        if NM.residue.generic_number:
-            GN = NM.residue.generic_number.label
-        else:
-            GN = ''
-        if SN in sp_sequence_numbers:
-            functional_annotation +=  'SodiumPocket '
-        if SN in ms_sequence_numbers:
-            functional_annotation +=  'MicroSwitch '
-        if SN in ptms_dict:
-            functional_annotation +=  'PTM (' + ptms_dict[SN] + ') '
-        if SN in interaction_data:
-            functional_annotation +=  'LB (' + ', '.join(interaction_data[SN]) + ') '
-        if GN in gprotein_generic_set:
-            functional_annotation +=  'GP (contact) '
 
         type = NM.type
         if type == 'missense':
@@ -184,7 +121,7 @@ def render_variants(request, protein = None, family = None, download = None, rec
         # print(NM.functional_annotation)
         jsondata[SN] = [NM.amino_acid, NM.allele_frequency, NM.allele_count, NM.allele_number, NM.number_homozygotes, NM.type, effect, color, functional_annotation]
 
-    residuelist = Residue.objects.filter(protein_conformation__protein=proteins[0]).prefetch_related('protein_segment','display_generic_number','generic_number')
+    residuelist = proteins[0].get_indexed_residues()
     SnakePlot = DrawSnakePlot(
                 residuelist, "Class A", protein, nobuttons=1)
     HelixBox = DrawHelixBox(residuelist,'Class A', protein, nobuttons = 1)
@@ -224,70 +161,15 @@ def render_variants(request, protein = None, family = None, download = None, rec
 
 def ajaxNaturalMutation(request, slug, **response_kwargs):
 
-    name_of_cache = 'ajaxNaturalMutation_'+slug
-
-    ptms = PTMs.objects.filter(protein__entry_name=slug).prefetch_related('residue')
-    ptms_dict = {}
-
-    for ptm in ptms:
-        ptms_dict[ptm.residue.sequence_number] = ptm.modification
-
-    ## MICROSWITCHES
-    micro_switches_rset = ResiduePositionSet.objects.get(name="Microswitches")
-    ms_label = []
-    for residue in micro_switches_rset.residue_position.all():
-        ms_label.append(residue.label)
-
-    ms_object = Residue.objects.filter(protein_conformation__protein__entry_name=slug, generic_number__label__in=ms_label)
-    ms_sequence_numbers = []
-    for ms in ms_object:
-        ms_sequence_numbers.append(ms.sequence_number)
-
-    ## SODIUM POCKET
-    sodium_pocket_rset = ResiduePositionSet.objects.get(name="Sodium pocket")
-    sp_label = []
-    for residue in sodium_pocket_rset.residue_position.all():
-        sp_label.append(residue.label)
-
-    sp_object = Residue.objects.filter(protein_conformation__protein__entry_name=slug, generic_number__label__in=ms_label)
-    sp_sequence_numbers = []
-    for sp in sp_object:
-        sp_sequence_numbers.append(sp.sequence_number)
-
-    ## G PROTEIN INTERACTION POSITIONS
-    # THIS SHOULD BE CLASS SPECIFIC (different set)
-    rset = ResiduePositionSet.objects.get(name='Signalling protein pocket')
-    gprotein_generic_set = []
-    for residue in rset.residue_position.all():
-        gprotein_generic_set.append(residue.label)
-
-    ### GET LB INTERACTION DATA
-    # get also ortholog proteins, which might have been crystallised to extract
-    # interaction data also from those
-    p = Protein.objects.get(entry_name=slug)
-    orthologs = Protein.objects.filter(family__slug__startswith=p.family.slug, sequence_type__slug='wt')
-
-    interactions = ResidueFragmentInteraction.objects.filter(
-        structure_ligand_pair__structure__protein_conformation__protein__parent__in=orthologs, structure_ligand_pair__annotated=True).exclude(interaction_type__type ='hidden').order_by('rotamer__residue__sequence_number')
-    interaction_data = {}
-    for interaction in interactions:
-        if interaction.rotamer.residue.generic_number:
-            sequence_number = interaction.rotamer.residue.sequence_number
-            # sequence_number = lookup[interaction.rotamer.residue.generic_number.label]
-            label = interaction.rotamer.residue.generic_number.label
-            aa = interaction.rotamer.residue.amino_acid
-            interactiontype = interaction.interaction_type.name
-            if sequence_number not in interaction_data:
-                interaction_data[sequence_number] = []
-            if interactiontype not in interaction_data[sequence_number]:
-                interaction_data[sequence_number].append(interactiontype)
+    # the annotations are rebuilt with each data release
+    name_of_cache = 'ajaxNaturalMutation_{}_{}'.format(ReleaseNotes.current_version(), slug)
 
     jsondata = cache.get(name_of_cache)
 
     if jsondata == None:
         jsondata = {}
 
-        NMs = NaturalMutations.objects.filter(protein__entry_name=slug).prefetch_related('residue')
+        NMs = NaturalMutations.objects.filter(protein__entry_name=slug).select_related('residue__functional_annotation')
 
         for NM in NMs:
 
@@ -301,33 +183,48 @@ def ajaxNaturalMutation(request, slug, **response_kwargs):
                 effect = 'deleterious'
                 color = '#575c9d'
 
-            functional_annotation = ''
-            SN = NM.residue.sequence_number
-            if NM.residue.generic_number:
-                GN = NM.residue.generic_number.label
-            else:
-                GN = ''
-            if SN in sp_sequence_numbers:
-                functional_annotation +=  'SodiumPocket '
-            if SN in ms_sequence_numbers:
-                functional_annotation +=  'MicroSwitch '
-            if SN in ptms_dict:
-                functional_annotation +=  'PTM (' + ptms_dict[SN] + ') '
-            if SN in interaction_data:
-                functional_annotation +=  'LB (' + ', '.join(interaction_data[SN]) + ') '
-            if GN in gprotein_generic_set:
-                functional_annotation +=  'GP (contact) '
-
+            functional_annotation = residue_functional_annotation(NM.residue)
             if functional_annotation == '':
                 functional_annotation = '-'
             # account for multiple mutations at this position!
             jsondata[SN] = [NM.amino_acid, NM.allele_frequency, NM.allele_count, NM.allele_number, NM.number_homozygotes, NM.type, effect, color, functional_annotation]
 
         jsondata = json.dumps(jsondata)
-        response_kwargs['content_type'] = 'application/json'
 
-        cache.set(name_of_cache, jsondata, 20) # 60*60*24*2 two days timeout on cache
+        cache.set(name_of_cache, jsondata, 60*60*24*2) # two days timeout on cache
+
+    response_kwargs['content_type'] = 'application/json'
+    return HttpResponse(jsondata, **response_kwargs)
+
+def ajaxFunctionalAnnotation(request, slug, **response_kwargs):
+    """Functional annotation of the residues of a receptor, by sequence number"""
+
+    name_of_cache = 'ajaxFunctionalAnnotation_{}_{}'.format(ReleaseNotes.current_version(), slug)
+
+    jsondata = cache.get(name_of_cache)
 
+    if jsondata == None:
+        jsondata = {}
+
+        annotations = ResidueFunctionalAnnotation.objects.filter(protein__entry_name=slug).select_related(
+            'residue__generic_number').order_by('residue__sequence_number')
+
+        for annotation in annotations:
+            jsondata[annotation.residue.sequence_number] = {
+                'generic_number': annotation.residue.generic_number.label if annotation.residue.generic_number else '',
+                'sodium_pocket': annotation.sodium_pocket,
+                'microswitch': annotation.microswitch,
+                'ptm': annotation.ptm,
+                'ligand_interactions': annotation.ligand_interactions.split(', ') if annotation.ligand_interactions else [],
+                'gprotein_contact': annotation.gprotein_contact,
+                'label': annotation.label().strip(),
+                }
+
+        jsondata = json.dumps(jsondata)
+
+        cache.set(name_of_cache, jsondata, 60*60*24*2) # two days timeout on cache
+
+    response_kwargs['content_type'] = 'application/json'
     return HttpResponse(jsondata, **response_kwargs)
 
 def ajaxPTMs(request, slug, **response_kwargs):
@@ -448,9 +345,15 @@ def mutant_extract(request):
         # jsondata[mutation.residue.sequence_number].append([mutation.foldchange,ligand,qual])
     # print(jsondata)
 
-@cache_page(60*60*24*21) #  2 days
 def statistics(request):
 
+    context = dict(statistics_snapshot('variation_statistics'))
+
+    return render(request, 'variation_statistics.html', context)
+
+def variation_statistics():
+    """Context of the variant statistics page, stored as a snapshot by build_statistics_snapshots"""
+
     context = dict()
 
     families = ProteinFamily.objects.all()
@@ -560,48 +463,11 @@ def statistics(request):
     total_av_cv = round(len(NaturalMutations.objects.filter(type='missense', allele_frequency__gte=0.001))/ total_receptors,1)
     context['stats'] = {'total_mv':total_mv,'total_lof':total_lof,'total_av_rv':total_av_rv, 'total_av_cv':total_av_cv}
 
-    return render(request, 'variation_statistics.html', context)
+    return context
 
 def get_functional_sites(protein):
-
-    ## PTMs
-    ptms = list(PTMs.objects.filter(protein=protein).values_list('residue', flat=True).distinct())
-
-    ## MICROSWITCHES
-    micro_switches_rset = ResiduePositionSet.objects.get(name="Microswitches")
-    ms_label = []
-    for residue in micro_switches_rset.residue_position.all():
-        ms_label.append(residue.label)
-
-    ms_object = list(Residue.objects.filter(protein_conformation__protein=protein, generic_number__label__in=ms_label).values_list('id', flat=True).distinct())
-
-    ## SODIUM POCKET
-    sodium_pocket_rset = ResiduePositionSet.objects.get(name="Sodium pocket")
-    sp_label = []
-    for residue in sodium_pocket_rset.residue_position.all():
-        sp_label.append(residue.label)
-    sp_object = list(Residue.objects.filter(protein_conformation__protein=protein, generic_number__label__in=ms_label).values_list('id', flat=True).distinct())
-
-
-    ## G PROTEIN INTERACTION POSITIONS
-    # THIS SHOULD BE CLASS SPECIFIC (different set)
-    rset = ResiduePositionSet.objects.get(name='Signalling protein pocket')
-    gprotein_generic_set = []
-    for residue in rset.residue_position.all():
-        gprotein_generic_set.append(residue.label)
-    GP_object = list(Residue.objects.filter(protein_conformation__protein=protein, generic_number__label__in=gprotein_generic_set).values_list('id', flat=True).distinct())
-
-    ### GET LB INTERACTION DATA
-    ## get also ortholog proteins, which might have been crystallised to extract
-    ## interaction data also from those
-    orthologs = Protein.objects.filter(family__slug__startswith=protein.family.slug, sequence_type__slug='wt').prefetch_related('protein__family')
-    interaction_residues = ResidueFragmentInteraction.objects.filter(
-        structure_ligand_pair__structure__protein_conformation__protein__parent__in=orthologs, structure_ligand_pair__annotated=True).exclude(interaction_type__type ='hidden').values_list('rotamer__residue_id', flat=True).distinct()
-
-    ## Get variants of these known residues:
-    known_function_sites = set(x for l in [GP_object,sp_object,ms_object,ptms,interaction_residues] for x in l)
-    NMs = NaturalMutations.objects.filter(residue_id__in=known_function_sites)
-    return len(NMs)
+    """Number of variants of a receptor at residues with a known function (see build_functional_annotations)"""
+    return NaturalMutations.objects.filter(protein=protein, residue__functional_annotation__isnull=False).count()
 
 @cache_page(60*60*24*21)
 def economicburden(request):
@@ -0,0 +1,196 @@
+from common.alignment import MATRIX_SYMBOLS, MATRIX_UNKNOWN
+
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+# Kimura distances are undefined above ~85% difference, larger distances are capped
+MAX_DISTANCE = 10.0
+
+
+def protein_distances(codes, weights=None):
+    """Kimura protein distances between all rows of an alignment matrix (see common.alignment.MATRIX_SYMBOLS),
+    counting only columns where both sequences have a known residue. Weights are column counts, for bootstrapping"""
+    num_rows, num_columns = codes.shape
+    if weights is None:
+        weights = np.ones(num_columns)
+
+    valid = ((codes != 0) & (codes != MATRIX_UNKNOWN)).astype(np.float64)
+    compared = (valid * weights) @ valid.T
+    identical = np.zeros((num_rows, num_rows))
+    for code in range(1, len(MATRIX_SYMBOLS) - 1):
+        residues = (codes == code).astype(np.float64)
+        identical += (residues * weights) @ residues.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = 1 - identical / compared
+    p[compared == 0] = 1
+    x = np.maximum(1 - p - 0.2 * p * p, np.exp(-MAX_DISTANCE))
+    distances = -np.log(x)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def neighbor_joining(distances):
+    """Neighbor joining tree (Saitou & Nei). Leaves are row indices, internal nodes are lists of (node, branch
+    length). The root is an unrooted trifurcation, as in the output of PHYLIP neighbor"""
+    d = distances.astype(np.float64).copy()
+    nodes = list(range(len(d)))
+    while len(nodes) > 3:
+        n = len(nodes)
+        r = d.sum(axis=1)
+        q = (n - 2) * d - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = np.unravel_index(np.argmin(q), q.shape)
+        if i > j:
+            i, j = j, i
+
+        length_i = 0.5 * d[i, j] + (r[i] - r[j]) / (2 * (n - 2))
+        length_j = d[i, j] - length_i
+        new_distances = 0.5 * (d[i] + d[j] - d[i, j])
+        nodes[i] = [(nodes[i], length_i), (nodes[j], length_j)]
+
+        # the joined node replaces i, j is removed
+        d[i, :] = new_distances
+        d[:, i] = new_distances
+        d[i, i] = 0
+        d = np.delete(np.delete(d, j, axis=0), j, axis=1)
+        del nodes[j]
+
+    if len(nodes) < 3:
+        return [(node, d[0, -1] / 2) for node in nodes]
+    a, b, c = range(3)
+    return [(nodes[a], (d[a, b] + d[a, c] - d[b, c]) / 2), (nodes[b], (d[a, b] + d[b, c] - d[a, c]) / 2),
+        (nodes[c], (d[a, c] + d[b, c] - d[a, b]) / 2)]
+
+
+def upgma(distances):
+    """UPGMA tree, rooted. Same node format as neighbor_joining"""
+    d = distances.astype(np.float64).copy()
+    nodes = list(range(len(d)))
+    sizes = np.ones(len(d))
+    heights = np.zeros(len(d))
+    while len(nodes) > 1:
+        masked = d + np.diag(np.full(len(nodes), np.inf))
+        i, j = np.unravel_index(np.argmin(masked), masked.shape)
+        if i > j:
+            i, j = j, i
+
+        height = d[i, j] / 2
+        nodes[i] = [(nodes[i], height - heights[i]), (nodes[j], height - heights[j])]
+        new_distances = (sizes[i] * d[i] + sizes[j] * d[j]) / (sizes[i] + sizes[j])
+        d[i, :] = new_distances
+        d[:, i] = new_distances
+        d[i, i] = 0
+        sizes[i] += sizes[j]
+        heights[i] = height
+
+        d = np.delete(np.delete(d, j, axis=0), j, axis=1)
+        sizes = np.delete(sizes, j)
+        heights = np.delete(heights, j)
+        del nodes[j]
+
+    return nodes[0]
+
+
+def newick(tree, names, length_format='{:.5f}'):
+    """Newick string of a tree in the format of neighbor_joining"""
+    def node_string(node):
+        if isinstance(node, list):
+            return '(' + ','.join([node_string(child) + ':' + length_format.format(length)
+                for child, length in node]) + ')'
+        return names[node]
+
+    return node_string(tree) + ';'
+
+
+def tree_splits(tree, num_leaves):
+    """Splits (bipartitions) of a tree, each as the sorted leaves of the side without leaf 0"""
+    splits = []
+
+    def clade_leaves(node):
+        if not isinstance(node, list):
+            return {node}
+        leaves = set()
+        for child, length in node:
+            leaves |= clade_leaves(child)
+        if 2 <= len(leaves) <= num_leaves - 2:
+            split = leaves if 0 not in leaves else set(range(num_leaves)) - leaves
+            if len(split) >= 2:
+                splits.append(tuple(sorted(split)))
+        return leaves
+
+    for child, length in tree:
+        clade_leaves(child)
+    return set(splits)
+
+
+def bootstrap_splits(args):
+    """Count the splits of the trees of a number of bootstrap replicates"""
+    codes, seeds, use_upgma = args
+    counts = Counter()
+    num_columns = codes.shape[1]
+    for seed in seeds:
+        random_state = np.random.RandomState(seed)
+        weights = np.bincount(random_state.randint(num_columns, size=num_columns), minlength=num_columns)
+        distances = protein_distances(codes, weights)
+        tree = upgma(distances) if use_upgma else neighbor_joining(distances)
+        counts.update(tree_splits(tree, len(codes)))
+    return counts
+
+
+def consensus_tree(split_counts, num_leaves, replicates):
+    """Extended majority rule consensus tree, with the number of supporting replicates as branch lengths (as in
+    the output of PHYLIP consense). Splits are added by decreasing support if compatible with the tree"""
+    accepted = []
+    for split, count in sorted(split_counts.items(), key=lambda x: (-x[1], x[0])):
+        split_set = set(split)
+        if all([split_set <= other or other <= split_set or not (split_set & other) for other, c in accepted]):
+            accepted.append((split_set, count))
+
+    # nest the clusters (the sides without leaf 0) from large to small
+    accepted.sort(key=lambda x: -len(x[0]))
+    root = []
+    clusters = []
+    for split_set, count in accepted:
+        node = []
+        parent = root
+        for other, other_node in reversed(clusters):
+            if split_set <= other:
+                parent = other_node
+                break
+        parent.append((node, count))
+        clusters.append((split_set, node))
+
+    for leaf in range(num_leaves):
+        parent = root
+        for other, other_node in reversed(clusters):
+            if leaf in other:
+                parent = other_node
+                break
+        parent.append((leaf, replicates))
+    return root
+
+
+def bootstrap_tree(codes, replicates, use_upgma=False, seed=77, processes=None):
+    """Consensus tree of bootstrap replicates of the alignment matrix, calculated in a process pool"""
+    seeds = np.random.RandomState(seed).randint(2**31 - 1, size=replicates).tolist()
+    processes = min(processes or cpu_count(), replicates)
+    chunks = [(codes, seeds[i::processes], use_upgma) for i in range(processes)]
+
+    split_counts = Counter()
+    if processes > 1:
+        with Pool(processes) as pool:
+            for counts in pool.map(bootstrap_splits, chunks):
+                split_counts.update(counts)
+    else:
+        split_counts = bootstrap_splits(chunks[0])
+    return consensus_tree(split_counts, len(codes), replicates)
+
+
+def distance_matrix_text(distances, names):
+    """Distance matrix in PHYLIP format"""
+    lines = ['{:>5}'.format(len(names))]
+    for name, row in zip(names, distances):
+        lines.append('{:<10} '.format(name) + ' '.join(['{:.6f}'.format(x) for x in row]))
+    return '\n'.join(lines) + '\n'
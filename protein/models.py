@@ -4,6 +4,7 @@ from common.diagrams_gprotein import DrawGproteinPlot
 from common.diagrams_arrestin import DrawArrestinPlot
 
 from residue.models import Residue, ResidueNumberingScheme, ResidueGenericNumberEquivalent
+from residue.residue_index import get_residue_index
 
 class Protein(models.Model):
     parent = models.ForeignKey('self', null=True)
@@ -36,28 +37,32 @@ class Protein(models.Model):
             tmp = tmp.parent
         return tmp.name
 
+    def get_indexed_residues(self):
+        """Residues of the protein from the residue index, for the diagrams"""
+        return get_residue_index(self.entry_name).residues()
+
     def get_helical_box(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+        residuelist = self.get_indexed_residues()
         return DrawHelixBox(residuelist,self.get_protein_class(),str(self))
 
     def get_snake_plot(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+        residuelist = self.get_indexed_residues()
         return DrawSnakePlot(residuelist,self.get_protein_class(),str(self))
 
     def get_helical_box_no_buttons(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+        residuelist = self.get_indexed_residues()
         return DrawHelixBox(residuelist,self.get_protein_class(),str(self), nobuttons=1)
         
     def get_snake_plot_no_buttons(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+        residuelist = self.get_indexed_residues()
         return DrawSnakePlot(residuelist,self.get_protein_class(),str(self), nobuttons=1)
 
     def get_gprotein_plot(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+        residuelist = self.get_indexed_residues()
         return DrawGproteinPlot(residuelist,self.get_protein_class(),str(self))
 
     def get_arrestin_plot(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+        residuelist = self.get_indexed_residues()
         return DrawArrestinPlot(residuelist,self.get_protein_class(),str(self))
 
     def get_protein_family(self):
@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.db.models import Q
 from django.db import IntegrityError
+from django.db import connection
 
+from common.tools import fetch_from_cache, save_to_cache
 from protein.models import ProteinAnomaly
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
 
@@ -10,9 +12,15 @@ from collections import OrderedDict
 import yaml
 import shlex
 import os
+import hashlib
+import tempfile
+from multiprocessing import Pool
 from Bio import AlignIO
 from Bio.Align.Applications import ClustalOmegaCommandline
 
+# location of cached pairwise alignments in the build cache
+ALIGNMENT_CACHE_PATH = ['alignments', 'clustalo']
+
 def parse_scheme_tables(path):
     # get generic residue numbering schemes
     rnss = ResidueNumberingScheme.objects.all()
@@ -480,7 +488,40 @@ def format_generic_numbers(residue_numbering_scheme, schemes, sequence_number, g
     #     print(numbers)
     return numbers
 
-def align_protein_to_reference(protein, tpl_ref_pos_file_path, ref_protein):
+def clustal_align_pair(ref_sequence, sequence):
+    """Align a sequence to a reference sequence with Clustal Omega. Each call uses its own temporary directory, so
+    that parallel builds do not overwrite each other's files, and alignments are cached by the hash of both
+    sequences. Returns the aligned reference and sequence, or False if the alignment failed"""
+    logger = logging.getLogger('build')
+
+    cache_id = hashlib.md5('{}|{}'.format(ref_sequence, sequence).encode('utf-8')).hexdigest()
+    alignment = fetch_from_cache(ALIGNMENT_CACHE_PATH, cache_id)
+    if alignment:
+        return alignment
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # write sequences to files
+        seq_filename = os.sep.join([tmp_dir, "in.fa"])
+        with open(seq_filename, 'w') as seq_file:
+            seq_file.write("> ref\n")
+            seq_file.write(ref_sequence + "\n")
+            seq_file.write("> seq\n")
+            seq_file.write(sequence + "\n")
+
+        try:
+            ali_filename = os.sep.join([tmp_dir, "out.fa"])
+            acmd = ClustalOmegaCommandline(infile=seq_filename, outfile=ali_filename, force=True)
+            stdout, stderr = acmd()
+            a = AlignIO.read(ali_filename, "fasta")
+        except Exception as msg:
+            logger.error('Clustal Omega alignment failed: {}'.format(msg))
+            return False
+
+    alignment = [str(a[0].seq), str(a[1].seq)]
+    save_to_cache(ALIGNMENT_CACHE_PATH, cache_id, alignment)
+    return alignment
+
+def align_protein_to_reference(protein, tpl_ref_pos_file_path, ref_protein, alignment=None):
     logger = logging.getLogger('build')
 
     # does the template reference position file exists?
@@ -489,37 +530,27 @@ def align_protein_to_reference(protein, tpl_ref_pos_file_path, ref_protein):
         return False
     template_ref_positions = load_reference_positions(tpl_ref_pos_file_path)
 
-    # write sequences to files
-    seq_filename = "/tmp/" + protein['entry_name'] + ".fa"
-    with open(seq_filename, 'w') as seq_file:
-        seq_file.write("> ref\n")
-        seq_file.write(ref_protein.sequence + "\n")
-        seq_file.write("> seq\n")
-        seq_file.write(protein['sequence'] + "\n")
-
-    try:
-        ali_filename = "/tmp/out.fa"
-        acmd = ClustalOmegaCommandline(infile=seq_filename, outfile=ali_filename, force=True)
-        stdout, stderr = acmd()
-        a = AlignIO.read(ali_filename, "fasta")
-        logger.info("{} aligned to {}".format(protein['entry_name'], ref_protein.entry_name))
-    except:
+    # alignments can be calculated in advance, see align_proteins_to_references
+    if not alignment:
+        alignment = clustal_align_pair(ref_protein.sequence, protein['sequence'])
+    if not alignment:
         logger.error('Alignment failed for {}'.format(protein['entry_name']))
         return False
+    logger.info("{} aligned to {}".format(protein['entry_name'], ref_protein.entry_name))
 
     # find reference positions
     ref_positions = {}
     ref_positions_in_ali = {}
     for position_generic_number, rp in template_ref_positions.items():
         gaps = 0
-        for i, r in enumerate(a[0].seq, 1):
+        for i, r in enumerate(alignment[0], 1):
             if r == "-":
                 gaps += 1
             if i-gaps == rp:
                 ref_positions_in_ali[position_generic_number] = i
     for position_generic_number, rp in ref_positions_in_ali.items():
         gaps = 0
-        for i, r in enumerate(a[1].seq, 1):
+        for i, r in enumerate(alignment[1], 1):
             if r == "-":
                 gaps += 1
             if i == rp:
@@ -527,6 +558,20 @@ def align_protein_to_reference(protein, tpl_ref_pos_file_path, ref_protein):
 
     return ref_positions
 
+def align_proteins_to_references(proteins, proc=1):
+    """Batch version of align_protein_to_reference, for a list of (protein, tpl_ref_pos_file_path, ref_protein).
+    The alignments are run in a pool of proc processes"""
+    pairs = [(ref_protein.sequence, protein['sequence']) for protein, tpl_ref_pos_file_path, ref_protein in proteins]
+    if proc > 1 and len(pairs) > 1:
+        connection.close()
+        with Pool(min(proc, len(pairs))) as pool:
+            alignments = pool.starmap(clustal_align_pair, pairs)
+    else:
+        alignments = [clustal_align_pair(*pair) for pair in pairs]
+
+    return [align_protein_to_reference(protein, tpl_ref_pos_file_path, ref_protein, alignment) for
+        (protein, tpl_ref_pos_file_path, ref_protein), alignment in zip(proteins, alignments)]
+
 def generic_number_within_segment_borders(generic_number, list_of_tpl_generic_numbers):
     generic_index = generic_number.split('x')[1][:2]
     start_index = list_of_tpl_generic_numbers[0].split('x')[1][:2]
@@ -0,0 +1,122 @@
+from django.core.cache import cache
+
+from common.models import ReleaseNotes
+from residue.models import Residue
+
+from collections import OrderedDict
+import numpy as np
+
+
+class IndexedLabel:
+    """Stand-in for a ProteinSegment or ResidueGenericNumber of an indexed residue"""
+    __slots__ = ['slug', 'label']
+
+    def __init__(self, label):
+        self.slug = label
+        self.label = label
+
+    def __str__(self):
+        return self.label
+
+
+class IndexedResidue:
+    """Lightweight residue with the attributes used by the diagrams (sequence_number, amino_acid, protein_segment,
+    generic_number and display_generic_number)"""
+    __slots__ = ['sequence_number', 'amino_acid', 'protein_segment', 'generic_number', 'display_generic_number',
+        'segment_slug']
+
+    def __init__(self, sequence_number, amino_acid, segment, generic_number, display_generic_number):
+        self.sequence_number = sequence_number
+        self.amino_acid = amino_acid
+        self.protein_segment = IndexedLabel(segment) if segment else None
+        self.generic_number = IndexedLabel(generic_number) if generic_number else None
+        self.display_generic_number = IndexedLabel(display_generic_number) if display_generic_number else None
+        self.segment_slug = None
+
+    def __str__(self):
+        return self.amino_acid + str(self.sequence_number)
+
+
+class ResidueIndex:
+    """Residues of a protein as arrays (in order of sequence number), with lookups from sequence numbers, generic
+    numbers and display generic numbers to positions in the arrays. Use get_residue_index to get a cached index"""
+
+    def __init__(self, entry_name, rows):
+        """rows are (sequence number, amino acid, segment slug, generic number, display generic number)"""
+        self.entry_name = entry_name
+        self.sequence_numbers = np.array([r[0] for r in rows], dtype=np.int32)
+        self.amino_acids = ''.join([r[1] for r in rows])
+        self.segment_slugs = list(OrderedDict.fromkeys([r[2] for r in rows if r[2]]))
+        segment_codes = {slug: i for i, slug in enumerate(self.segment_slugs)}
+        self.segments = np.array([segment_codes[r[2]] if r[2] else -1 for r in rows], dtype=np.int16)
+        self.generic_numbers = [r[3] for r in rows]
+        self.display_generic_numbers = [r[4] for r in rows]
+
+        self.by_sequence_number = {int(sn): i for i, sn in enumerate(self.sequence_numbers)}
+        self.by_generic_number = {label: i for i, label in enumerate(self.generic_numbers) if label}
+        self.by_display_generic_number = {label: i for i, label in enumerate(self.display_generic_numbers) if label}
+
+    def __len__(self):
+        return len(self.sequence_numbers)
+
+    def segment(self, i):
+        code = self.segments[i]
+        return self.segment_slugs[code] if code >= 0 else None
+
+    def residue(self, i):
+        return IndexedResidue(int(self.sequence_numbers[i]), self.amino_acids[i], self.segment(i),
+            self.generic_numbers[i], self.display_generic_numbers[i])
+
+    def residues(self):
+        """All residues, for the diagrams"""
+        return [self.residue(i) for i in range(len(self))]
+
+    def position(self, label, display=False):
+        """Position of the residue with a generic number (or display generic number), or None"""
+        if display:
+            return self.by_display_generic_number.get(label)
+        return self.by_generic_number.get(label)
+
+    def positions(self, labels, display=False):
+        """Positions of the residues with any of the generic numbers, in order of sequence number"""
+        lookup = self.by_display_generic_number if display else self.by_generic_number
+        return sorted([lookup[label] for label in set(labels) if label in lookup])
+
+    def sequence_numbers_of(self, labels, display=False):
+        """Sequence numbers of the residues with any of the generic numbers, in order of sequence number"""
+        return [int(self.sequence_numbers[i]) for i in self.positions(labels, display)]
+
+    def generic_number_lookup(self, display=False):
+        """Dictionary of generic number (or display generic number): sequence number"""
+        lookup = self.by_display_generic_number if display else self.by_generic_number
+        return {label: int(self.sequence_numbers[i]) for label, i in lookup.items()}
+
+
+# indices used by this process, with the data release they were built from
+residue_indices = OrderedDict()
+MAX_RESIDUE_INDICES = 200
+RESIDUE_INDEX_CACHE_TIMEOUT = 60*60*24*7
+
+
+def get_residue_index(entry_name):
+    """Residue index of a protein, from memory, the cache or the database. Indices are rebuilt after a new data
+    release"""
+    version = ReleaseNotes.current_version()
+    memo = residue_indices.get(entry_name)
+    if memo and memo[0] == version:
+        residue_indices.move_to_end(entry_name)
+        return memo[1]
+
+    cache_key = 'residue_index_{}_{}'.format(version, entry_name)
+    index = cache.get(cache_key)
+    if index is None:
+        rows = list(Residue.objects.filter(protein_conformation__protein__entry_name=entry_name).order_by(
+            'sequence_number').values_list('sequence_number', 'amino_acid', 'protein_segment__slug',
+            'generic_number__label', 'display_generic_number__label'))
+        index = ResidueIndex(entry_name, rows)
+        cache.set(cache_key, index, RESIDUE_INDEX_CACHE_TIMEOUT)
+
+    residue_indices[entry_name] = (version, index)
+    if len(residue_indices) > MAX_RESIDUE_INDICES:
+        residue_indices.popitem(last=False)
+    return index
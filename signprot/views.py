@@ -5,6 +5,7 @@ from django.views.decorators.cache import cache_page
 
 from protein.models import Protein, ProteinConformation, ProteinAlias, ProteinFamily, Gene, ProteinGProtein, ProteinGProteinPair
 from residue.models import Residue, ResiduePositionSet
+from residue.residue_index import get_residue_index
 
 from structure.models import Structure
 from mutation.models import MutationExperiment
@@ -228,12 +229,12 @@ class TargetSelection(AbsTargetSelection):
 @cache_page(60*60*24*2)
 def Ginterface(request, protein = None):
 
-    residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=protein).prefetch_related('protein_segment','display_generic_number','generic_number')
+    residue_index = get_residue_index(protein)
     SnakePlot = DrawSnakePlot(
-                residuelist, "Class A (Rhodopsin)", protein, nobuttons=1)
+                residue_index.residues(), "Class A (Rhodopsin)", protein, nobuttons=1)
 
     # TEST
-    gprotein_residues = Residue.objects.filter(protein_conformation__protein__entry_name='gnaz_human').prefetch_related('protein_segment','display_generic_number','generic_number')
+    gprotein_residues = get_residue_index('gnaz_human').residues()
     gproteinplot = DrawGproteinPlot(
                 gprotein_residues, "Gprotein", protein)
 
@@ -258,7 +259,7 @@ def Ginterface(request, protein = None):
 
     interacting_gn = []
 
-    accessible_pos = list(residuelist.filter(display_generic_number__label__in=accessible_gn).values_list('sequence_number', flat=True))
+    accessible_pos = residue_index.sequence_numbers_of(accessible_gn, display=True)
 
     # Which of the Gs interacting_pos are conserved?
     GS_none_equivalent_interacting_pos = []
@@ -268,20 +269,21 @@ def Ginterface(request, protein = None):
         interacting_gn.append(interaction['gpcrdb'])
         gs_b2_interaction_type_long = (next((item['type'] for item in residues_browser if item['gpcrdb'] == interaction['gpcrdb']), None))
 
-        interacting_aa = residuelist.filter(display_generic_number__label__in=[interaction['gpcrdb']]).values_list('amino_acid', flat=True)
+        i = residue_index.position(interaction['gpcrdb'], display=True)
 
-        if interacting_aa:
-            interaction['aa'] = interacting_aa[0]
-            pos = residuelist.filter(display_generic_number__label__in=[interaction['gpcrdb']]).values_list('sequence_number', flat=True)[0]
+        if i is not None:
+            interacting_aa = residue_index.amino_acids[i]
+            interaction['aa'] = interacting_aa
+            pos = int(residue_index.sequence_numbers[i])
             interaction['pos'] = pos
 
             feature = names_aa[gs_b2_interaction_type_long]
 
-            if interacting_aa[0] not in exchange_table[feature]:
+            if interacting_aa not in exchange_table[feature]:
                 GS_none_equivalent_interacting_pos.append(pos)
                 GS_none_equivalent_interacting_gn.append(interaction['gpcrdb'])
 
-    GS_equivalent_interacting_pos = list(residuelist.filter(display_generic_number__label__in=interacting_gn).values_list('sequence_number', flat=True))
+    GS_equivalent_interacting_pos = residue_index.sequence_numbers_of(interacting_gn, display=True)
 
     gProteinData = ProteinGProteinPair.objects.filter(protein__entry_name=protein)
 
@@ -311,14 +313,15 @@ def ajaxInterface(request, slug, **response_kwargs):
             rsets = ResiduePositionSet.objects.get(name="Gprotein Barcode")
         # residues = Residue.objects.filter(protein_conformation__protein__entry_name=slug, display_generic_number__label=residue.label)
 
+        residue_index = get_residue_index(slug)
         jsondata = {}
         positions = []
         for x, residue in enumerate(rsets.residue_position.all()):
-            try:
-                pos = str(list(Residue.objects.filter(protein_conformation__protein__entry_name=slug, display_generic_number__label=residue.label))[0])
-            except:
+            i = residue_index.position(residue.label, display=True)
+            if i is None:
                 print("Protein has no residue position at", residue.label)
-            a = pos[1:]
+                continue
+            a = str(residue_index.sequence_numbers[i])
 
             jsondata[a] = [5, 'Receptor interface position', residue.label]
 
@@ -343,11 +346,11 @@ def ajaxBarcode(request, slug, cutoff, **response_kwargs):
 
         conserved = list(SignprotBarcode.objects.filter(protein__entry_name=slug, paralog_score__gte=cutoff, seq_identity__gte=cutoff).prefetch_related('residue__display_generic_number').values_list('residue__display_generic_number__label', flat=True))
 
-        all_positions = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('display_generic_number')
+        residue_index = get_residue_index(slug)
 
-        for res in all_positions:
-            cgn = str(res.generic_number)
-            res = str(res.sequence_number)
+        for i in range(len(residue_index)):
+            cgn = str(residue_index.generic_numbers[i])
+            res = str(residue_index.sequence_numbers[i])
             if cgn in conserved:
                 jsondata[res] = [0, 'Conserved', cgn]
             elif cgn in selectivity_pos and cgn not in conserved:
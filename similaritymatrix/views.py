@@ -51,16 +51,16 @@ def render_matrix(request):
     
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
 
     # load data from selection into the alignment
     a.load_proteins_from_selection(simple_selection)
     a.load_segments_from_selection(simple_selection)
 
-    # build the alignment data matrix
-    a.build_alignment()
-
-    # calculate consensus sequence + amino acid and feature frequency
-    a.calculate_statistics()
+    # build the alignment data matrix, unless the similarities are precomputed
+    a.use_similarity_store = True
+    if not a.similarity_store_covers():
+        a.build_alignment()
 
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity_matrix()
@@ -73,17 +73,17 @@ def render_csv_matrix(request):
     
     # create an alignment object
     a = Alignment()
+    a.use_matrix = True
     a.show_padding = False
 
     # load data from selection into the alignment
     a.load_proteins_from_selection(simple_selection)
     a.load_segments_from_selection(simple_selection)
 
-    # build the alignment data matrix
-    a.build_alignment()
-
-    # calculate consensus sequence + amino acid and feature frequency
-    a.calculate_statistics()
+    # build the alignment data matrix, unless the similarities are precomputed
+    a.use_similarity_store = True
+    if not a.similarity_store_covers():
+        a.build_alignment()
 
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity_matrix()
@@ -4,6 +4,7 @@ from django.conf import settings
 from common.views import AbsReferenceSelection
 from common.views import AbsSegmentSelection
 from common.views import AbsTargetSelection
+from common.export import export_response
 # from common.alignment_SITE_NAME import Alignment
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
@@ -135,10 +136,4 @@ def render_csv_alignment(request):
     # calculate identity and similarity of each row compared to the reference
     a.calculate_similarity()
 
-    num_of_sequences = len(a.proteins)
-    num_residue_columns = len(a.positions) + len(a.segments)
-    
-    response = render(request, 'alignment/alignment_csv.html', {'a': a, 'num_of_sequences': num_of_sequences,
-        'num_residue_columns': num_residue_columns}, content_type='text/fasta')
-    response['Content-Disposition'] = "attachment; filename=" + settings.SITE_TITLE + "_alignment.csv"
-    return response
+    return export_response(settings.SITE_TITLE + "_alignment", None, a.csv_rows(), 'csv')
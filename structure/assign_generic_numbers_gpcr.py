@@ -6,6 +6,7 @@ from Bio.PDB import *
 from Bio.PDB.PDBIO import Select
 from residue.models import Residue
 from structure.functions import BlastSearch, MappedResidue
+from structure.sequence_search import LocalSearch
 
 import Bio.PDB.Polypeptide as polypeptide
 import os,logging
@@ -20,7 +21,7 @@ class GenericNumbering(object):
     residue_list = ["ARG","ASP","GLU","HIS","ASN","GLN","LYS","SER","THR","HID","PHE","LEU","ILE","TYR","TRP","VAL","MET","PRO","CYS","ALA","GLY"]
   
     def __init__ (self, pdb_file=None, pdb_filename=None, structure=None, blast_path='blastp',
-        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']),top_results=1):
+        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']),top_results=1, local_search=False):
     
         # pdb_file can be either a name/path or a handle to an open file
         self.pdb_file = pdb_file
@@ -31,8 +32,11 @@ class GenericNumbering(object):
         self.pdb_seq = {} #Seq('')
         # list of uniprot ids returned from blast
         self.prot_id_list = []
-        #setup for local blast search
-        self.blast = BlastSearch(blast_path=blast_path, blastdb=blastdb,top_results=top_results)
+        #setup for local blast search, or the built-in search which does not need blastp
+        if local_search:
+            self.blast = LocalSearch(top_results=top_results)
+        else:
+            self.blast = BlastSearch(blast_path=blast_path, blastdb=blastdb,top_results=top_results)
         
         if self.pdb_file:
             self.pdb_structure = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', self.pdb_file)[0]
@@ -182,9 +186,10 @@ class GenericNumbering(object):
     def assign_generic_numbers(self):
         
         alignments = {}
-        #blast search goes first, looping through all the chains
-        for chain in self.pdb_seq.keys():
-            alignments[chain] = self.blast.run(self.pdb_seq[chain])
+        #blast search goes first, all the chains are searched at once
+        chains = list(self.pdb_seq.keys())
+        for chain, result in zip(chains, self.blast.run_batch([self.pdb_seq[chain] for chain in chains])):
+            alignments[chain] = result
             
         #map the results onto pdb sequence for every sequence pair from blast
         for chain in self.pdb_seq.keys():
@@ -7,6 +7,7 @@ from Bio.PDB.Polypeptide import CaPPBuilder, is_aa
 from Bio.PDB.Vector import rotaxis
 
 from django.conf import settings
+from django.core.cache import cache
 from common.selection import SimpleSelection
 from common.alignment import Alignment
 from protein.models import Protein, ProteinSegment, ProteinConformation, ProteinState
@@ -15,9 +16,12 @@ from residue.models import Residue
 from structure.models import Structure, Rotamer
 
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 from io import StringIO
 import os
 import sys
+import glob
+import hashlib
 import tempfile
 import logging
 import math
@@ -36,10 +40,15 @@ ATOM_FORMAT_STRING="%s%5i %-4s%c%3s %c%4i%c   %8.3f%8.3f%8.3f%s%6.2f      %4s%2s
 #==============================================================================
 # I have put it into separate class for the sake of future uses
 class BlastSearch(object):
-    
-    
+
+    # parsed results of recent queries, shared by all searches in the process
+    memory_cache = OrderedDict()
+    memory_cache_size = 500
+    cache_timeout = 60*60*24*7
+
     def __init__ (self, blast_path='blastp',
-        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1):
+        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1,
+        use_cache=True, processes=1):
   
         self.blast_path = blast_path
         self.blastdb = blastdb
@@ -47,34 +56,110 @@ class BlastSearch(object):
         #residues it is better to use more results to avoid getting sequence of
         #e.g.  different species
         self.top_results = top_results
-      
+        self.use_cache = use_cache
+        # number of blastp processes a batch of queries is divided over
+        self.processes = processes
+
     #takes Bio.Seq sequence as an input and returns a list of tuples with the
     #alignments
     def run (self, input_seq):
-    
-        output = []
+
+        return self.run_batch([input_seq])[0]
+
+    def run_batch (self, input_seqs):
+        """Search for a list of sequences, with one blastp call per process for all sequences that are not cached.
+        Returns a list of results in the format of run, one per sequence"""
+        seqs = [str(input_seq).strip() for input_seq in input_seqs]
+        output = [[] for seq in seqs]
+
+        # look up cached results, identical sequences are only searched once
+        queries = OrderedDict()
+        for i, seq in enumerate(seqs):
+            if not seq:
+                continue
+            cached = self.fetch_from_cache(seq) if self.use_cache else None
+            if cached is not None:
+                output[i] = cached
+            else:
+                queries.setdefault(seq, []).append(i)
+
+        if queries:
+            query_seqs = list(queries.keys())
+            num_chunks = max(1, min(self.processes, len(query_seqs)))
+            chunks = [query_seqs[c::num_chunks] for c in range(num_chunks)]
+            if num_chunks > 1:
+                pool = ThreadPool(num_chunks)
+                chunk_results = pool.map(self.run_blast, chunks)
+                pool.close()
+            else:
+                chunk_results = [self.run_blast(chunks[0])]
+
+            for chunk, results in zip(chunks, chunk_results):
+                for seq, result in zip(chunk, results):
+                    for i in queries[seq]:
+                        output[i] = result
+                    if self.use_cache:
+                        self.save_to_cache(seq, result)
+        return output
+
+    def run_blast (self, seqs):
+        """Run one blastp process for a list of sequences, and split the results by query"""
+        fasta = ''.join(['>query_{}\n{}\n'.format(i, seq) for i, seq in enumerate(seqs)])
         #Windows has problems with Popen and PIPE
         if sys.platform == 'win32':
             tmp = tempfile.NamedTemporaryFile()
-            logger.debug("Running Blast with sequence: {}".format(input_seq))
-            tmp.write(bytes(str(input_seq) + '\n', 'latin1'))
+            logger.debug("Running Blast with {} sequences".format(len(seqs)))
+            tmp.write(bytes(fasta, 'latin1'))
             tmp.seek(0)
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, stdin=tmp,
+            blast = Popen([self.blast_path, '-db', self.blastdb, '-outfmt', '5'], universal_newlines=True, stdin=tmp,
                 stdout=PIPE, stderr=PIPE)
             (blast_out, blast_err) = blast.communicate()
         else:
         #Rest of the world:
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, shell=True,
+            blast = Popen([self.blast_path, '-db', self.blastdb, '-outfmt', '5'], universal_newlines=True,
                 stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate(input=str(input_seq))
+            (blast_out, blast_err) = blast.communicate(input=fasta)
         if len(blast_err) != 0:
             logger.debug(blast_err)
-        if blast_out!='\n':
-            result = NCBIXML.read(StringIO(blast_out))
-            for aln in result.alignments[:self.top_results]:         
-                logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
-                output.append((aln.hit_id, aln))
-        return output
+
+        results = [[] for seq in seqs]
+        if blast_out.strip():
+            # one record per query, in the order of the input
+            for i, record in enumerate(NCBIXML.parse(StringIO(blast_out))):
+                for aln in record.alignments[:self.top_results]:
+                    logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
+                    results[i].append((aln.hit_id, aln))
+        return results
+
+    def db_version (self):
+        """Modification time of the database files, changes when the database is rebuilt"""
+        mtimes = [os.path.getmtime(f) for f in glob.glob(self.blastdb + '.p*')]
+        return str(max(mtimes)) if mtimes else ''
+
+    def cache_key (self, seq):
+        key = '|'.join([self.blastdb, self.db_version(), str(self.top_results), seq])
+        return 'blast_' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def fetch_from_cache (self, seq):
+        key = self.cache_key(seq)
+        if key in self.memory_cache:
+            self.memory_cache.move_to_end(key)
+            return self.memory_cache[key]
+        result = cache.get(key)
+        if result is not None:
+            self.add_to_memory_cache(key, result)
+        return result
+
+    def save_to_cache (self, seq, result):
+        key = self.cache_key(seq)
+        self.add_to_memory_cache(key, result)
+        cache.set(key, result, self.cache_timeout)
+
+    def add_to_memory_cache (self, key, result):
+        self.memory_cache[key] = result
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.memory_cache_size:
+            self.memory_cache.popitem(last=False)
 #==============================================================================
 
 class BlastSearchOnline(object):
@@ -288,16 +288,22 @@ class Validation():
         return overall_all1, overall_all2, overall_backbone1, overall_backbone2, keys1, keys2
 
     def calc_RMSD(self, list1, list2, TM_keys=None):
-        ''' Calculates RMSD between two atoms lists. The two lists have to have the same length. 
+        ''' Calculates RMSD between two atoms lists after superposition on their backbone atoms (N, CA and C, only of
+            the residues in TM_keys if given, as RotamerSuperpose). The two lists have to have the same length.
         '''
-        superpose = sp.RotamerSuperpose(list1, list2, TM_keys)
-        list2 = superpose.run()
-        array1, array2 = np.array([0,0,0]), np.array([0,0,0])
-        for a1, a2 in zip(list1, list2):
-            array1 = np.vstack((array1, list(a1.get_coord())))
-            array2 = np.vstack((array2, list(a2.get_coord())))
-        print(array1.shape,array2.shape)
-        rmsd = np.sqrt(sum(sum((array1[1:]-array2[1:])**2))/array1[1:].shape[0])
-        return rmsd
+        array1 = np.array([a.get_coord() for a in list1], dtype=np.float64)
+        array2 = np.array([a.get_coord() for a in list2], dtype=np.float64)
+        mask = np.array([self.is_fitted(a1, TM_keys) and self.is_fitted(a2, TM_keys) for a1, a2 in zip(list1, list2)],
+            dtype=bool)
+        rotations, translations, rmsd = sp.kabsch(array1, array2[None], mask[None])
+        superposed = np.dot(array2, rotations[0]) + translations[0]
+        return np.sqrt(((array1 - superposed) ** 2).sum() / array1.shape[0])
+
+    def is_fitted(self, atom, TM_keys=None):
+        ''' Whether an atom is used to superpose the atom lists in calc_RMSD.
+        '''
+        if atom.get_name() not in ['N','CA','C']:
+            return False
+        return TM_keys is None or atom.get_parent().get_full_id()[-1][1] in TM_keys
         
         
\ No newline at end of file
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import hashlib
+import json
+import zlib
+
+
+# copies of the helpers of structure.pdb_storage at the time of this migration, so that later changes of that module
+# do not change the migration
+
+def compress_pdb(pdb):
+    return zlib.compress(pdb.encode('utf-8'), 6)
+
+
+def decompress_pdb(data):
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+def hash_pdb(pdb):
+    return hashlib.sha256(pdb.encode('utf-8')).hexdigest()
+
+
+def line_key(line):
+    if line.startswith('ATOM'):
+        kind = 'ATOM'
+    elif line.startswith('HET'):
+        kind = 'HET'
+    else:
+        return ('', '', '')
+    return (kind, line[21:22], line[17:20])
+
+
+def index_pdb(pdb):
+    blocks = []
+    start = 0
+    for line in pdb.split('\n'):
+        end = start + len(line) + 1
+        key = line_key(line)
+        if blocks and tuple(blocks[-1][:3]) == key:
+            blocks[-1][4] = end
+        else:
+            blocks.append(list(key) + [start, end])
+        start = end
+    return blocks
+
+
+def dump_index(blocks):
+    return json.dumps(blocks, separators=(',', ':'))
+
+
+def compress_stored_pdbs(apps, schema_editor):
+    for model_name in ['PdbData', 'StructureModel']:
+        model = apps.get_model('structure', model_name)
+        for pk, pdb in model.objects.values_list('pk', 'pdb').iterator():
+            model.objects.filter(pk=pk).update(compressed_pdb=compress_pdb(pdb),
+                pdb_index=dump_index(index_pdb(pdb)), content_hash=hash_pdb(pdb))
+
+
+def decompress_stored_pdbs(apps, schema_editor):
+    # when the migration is reversed, the pdb fields are added again before this runs
+    for model_name in ['PdbData', 'StructureModel']:
+        model = apps.get_model('structure', model_name)
+        for pk, compressed_pdb in model.objects.values_list('pk', 'compressed_pdb').iterator():
+            model.objects.filter(pk=pk).update(pdb=decompress_pdb(compressed_pdb))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0003_structurerefinedseqsim_structurerefinedstatsrotamer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdbdata',
+            name='compressed_pdb',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='pdbdata',
+            name='pdb_index',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='pdbdata',
+            name='content_hash',
+            field=models.CharField(db_index=True, default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='structuremodel',
+            name='compressed_pdb',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='structuremodel',
+            name='pdb_index',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='structuremodel',
+            name='content_hash',
+            field=models.CharField(db_index=True, default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(compress_stored_pdbs, decompress_stored_pdbs),
+        migrations.RemoveField(
+            model_name='pdbdata',
+            name='pdb',
+        ),
+        migrations.RemoveField(
+            model_name='structuremodel',
+            name='pdb',
+        ),
+    ]
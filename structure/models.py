@@ -4,6 +4,38 @@ from django.core.cache import cache
 from io import StringIO
 from Bio.PDB import PDBIO
 
+from structure.pdb_storage import compress_pdb, decompress_pdb, hash_pdb, index_pdb, dump_index, load_index, select_blocks
+
+
+class CompressedPdb(models.Model):
+    """A PDB file, stored compressed with an index of the record types, chains and residue names of its lines (see
+    structure.pdb_storage) and a hash of its contents. The text of the file is the pdb property"""
+    compressed_pdb = models.BinaryField()
+    pdb_index = models.TextField()
+    content_hash = models.CharField(max_length=64, db_index=True)
+
+    class Meta():
+        abstract = True
+
+    @property
+    def pdb(self):
+        if not self.compressed_pdb:
+            return ''
+        return decompress_pdb(self.compressed_pdb)
+
+    @pdb.setter
+    def pdb(self, pdb):
+        self.compressed_pdb = compress_pdb(pdb)
+        self.pdb_index = dump_index(index_pdb(pdb))
+        self.content_hash = hash_pdb(pdb)
+
+    def select_pdb(self, keep):
+        """Lines of the file where keep(record type, chain, residue name) is true, see pdb_storage.line_key"""
+        if not self.compressed_pdb:
+            return ''
+        return select_blocks(self.pdb, load_index(self.pdb_index), keep)
+
+
 class Structure(models.Model):
     # linked onto the Xtal ProteinConformation, which is linked to the Xtal protein
     protein_conformation = models.ForeignKey('protein.ProteinConformation')
@@ -27,35 +59,32 @@ class Structure(models.Model):
         return self.pdb_code.index
 
     def get_cleaned_pdb(self, pref_chain=True, remove_waters=True, ligands_to_keep=None, remove_aux=False, aux_range=5.0):
-        
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
+        if pref_chain:
+            preferred_chain = self.preferred_chain[0]
+            refined = 'refined' in self.pdb_code.index
+
+        def keep(kind, chain, resname):
             save_line = False
             if pref_chain:
-                if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0] or 'refined' in self.pdb_code.index):
+                if kind and (chain == preferred_chain or refined):
                     save_line = True
             else:
                 save_line = True
-            if remove_waters and line.startswith('HET') and line[17:20] == 'HOH':
+            if remove_waters and kind == 'HET' and resname == 'HOH':
                 save_line = False
-            if ligands_to_keep and line.startswith('HET'):
-                if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
+            if ligands_to_keep and kind == 'HET':
+                if resname != 'HOH' and resname in ligands_to_keep:
                     save_line = True
-                elif line[17:20] != 'HOH':
-                    save_line=False
-            if save_line:
-                tmp.append(line)
+                elif resname != 'HOH':
+                    save_line = False
+            return save_line
 
-        return '\n'.join(tmp)
-                        
-    def get_preferred_chain_pdb(self):
+        return self.pdb_data.select_pdb(keep)
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
-            if (line.startswith('ATOM') or line.startswith('HET')) and line[21] == self.preferred_chain[0]:
-                tmp.append(line)
-        return '\n'.join(tmp)
+    def get_preferred_chain_pdb(self):
+        # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
+        preferred_chain = self.preferred_chain[0]
+        return self.pdb_data.select_pdb(lambda kind, chain, resname: kind and chain == preferred_chain)
 
     @property
     def is_refined(self):
@@ -74,11 +103,10 @@ class Structure(models.Model):
         db_table = 'structure'
 
 
-class StructureModel(models.Model):
+class StructureModel(CompressedPdb):
     protein = models.ForeignKey('protein.Protein')
     state = models.ForeignKey('protein.ProteinState')
     main_template = models.ForeignKey('structure.Structure')
-    pdb = models.TextField()
     version = models.DateField()
     
     def __repr__(self):
@@ -184,8 +212,17 @@ class StructureStabilizingAgent(models.Model):
         db_table = "structure_stabilizing_agent"
 
 
-class PdbData(models.Model):
-    pdb = models.TextField()
+class PdbDataManager(models.Manager):
+    def get_or_create_pdb(self, pdb):
+        """Stored file with the same contents as pdb, or a new one. Files are looked up by the hash of their contents"""
+        for pdb_data in self.filter(content_hash=hash_pdb(pdb)):
+            if pdb_data.pdb == pdb:
+                return pdb_data, False
+        return self.create(pdb=pdb), True
+
+
+class PdbData(CompressedPdb):
+    objects = PdbDataManager()
 
     def __str__(self):
         return self.pdb
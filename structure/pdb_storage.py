@@ -0,0 +1,67 @@
+import hashlib
+import json
+import zlib
+
+
+# compression level of stored PDB files, zlib level 6 is close to the best ratio at a fraction of the time of level 9
+COMPRESSION_LEVEL = 6
+
+
+def compress_pdb(pdb):
+    return zlib.compress(pdb.encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decompress_pdb(data):
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+def hash_pdb(pdb):
+    """SHA-256 of the contents of a PDB file, used to find stored files without comparing whole files"""
+    return hashlib.sha256(pdb.encode('utf-8')).hexdigest()
+
+
+def line_key(line):
+    """Record type (ATOM, HET for HETATM and other HET records, or an empty string for all other records), chain and
+    residue name of a line"""
+    if line.startswith('ATOM'):
+        kind = 'ATOM'
+    elif line.startswith('HET'):
+        kind = 'HET'
+    else:
+        return ('', '', '')
+    return (kind, line[21:22], line[17:20])
+
+
+def index_pdb(pdb):
+    """Index of a PDB file, a list of blocks [record type, chain, residue name, start, end] of consecutive lines with
+    the same key (see line_key). start and end are offsets in the text, end includes the line break of the last line"""
+    blocks = []
+    start = 0
+    for line in pdb.split('\n'):
+        end = start + len(line) + 1
+        key = line_key(line)
+        if blocks and tuple(blocks[-1][:3]) == key:
+            blocks[-1][4] = end
+        else:
+            blocks.append(list(key) + [start, end])
+        start = end
+    return blocks
+
+
+def dump_index(blocks):
+    return json.dumps(blocks, separators=(',', ':'))
+
+
+def load_index(index):
+    return json.loads(index)
+
+
+def select_blocks(pdb, blocks, keep):
+    """Lines of the blocks where keep(record type, chain, residue name) is true, joined by line breaks (the same as
+    joining the selected lines of pdb.split('\\n'))"""
+    selected = [b for b in blocks if keep(b[0], b[1], b[2])]
+    selection = ''.join([pdb[b[3]:b[4]] for b in selected])
+    # all selected lines end with a line break, except the last line of the file
+    if selected and selected[-1][4] <= len(pdb):
+        selection = selection[:-1]
+    return selection
@@ -0,0 +1,181 @@
+from django.conf import settings
+
+from structure.models import StructureModel
+from structure.structural_superposition import database_residues
+
+from collections import OrderedDict
+import os
+import json
+import numpy as np
+
+
+# backbone atoms compared at each generic number position
+BACKBONE_ATOMS = ['N', 'CA', 'C']
+
+# regions of the matrix besides the segments: all aligned positions, and the seven transmembrane helices
+OVERALL = 'overall'
+TM = 'TM'
+TM_SEGMENTS = ['TM1', 'TM2', 'TM3', 'TM4', 'TM5', 'TM6', 'TM7']
+
+
+def item_key(item):
+    """Key of a structure or homology model in the RMSD matrix"""
+    if isinstance(item, StructureModel):
+        return ['model', item.pk]
+    return ['structure', item.pk]
+
+
+def backbone_coordinates(item):
+    """Dictionary of generic number: (segment, array of the N, CA and C coordinates, NaN for missing atoms) of a
+    structure or homology model"""
+    pdb = item.get_cleaned_pdb()
+    residues = database_residues(item, pdb)
+    atoms = OrderedDict()
+    for line in pdb.split('\n'):
+        if not line.startswith(('ATOM', 'HETATM')) or line[12:16].strip() not in BACKBONE_ATOMS:
+            continue
+        try:
+            label, segment, display = residues.get((line[21], int(line[22:26])), (None, None, None))
+            if not label:
+                continue
+            if label not in atoms:
+                atoms[label] = (segment, np.full((len(BACKBONE_ATOMS), 3), np.nan))
+            coordinates = atoms[label][1][BACKBONE_ATOMS.index(line[12:16].strip())]
+            # first of alternative locations
+            if np.isnan(coordinates[0]):
+                coordinates[:] = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+        except ValueError:
+            continue
+    return atoms
+
+
+def pairwise_rmsd(coordinates_1, mask_1, coordinates_2, mask_2):
+    """RMSD after optimal superposition of every pair of rows of two sets of coordinates, on the points present in
+    both. coordinates are (structures x points x 3) with zeros for missing points, masks are (structures x points).
+
+    The sums needed by the Kabsch algorithm (number of common points, coordinate sums, the covariance matrix and sums
+    of squares) are matrix products over the points, so all pairs are calculated at once. The RMSD follows from the
+    singular values of the covariance matrix, without calculating rotations. Pairs with less than three common points
+    are NaN"""
+    m1 = mask_1.astype(np.float64)
+    m2 = mask_2.astype(np.float64)
+    counts = m1 @ m2.T
+    sums_1 = np.stack([coordinates_1[:, :, a] @ m2.T for a in range(3)], axis=-1)
+    sums_2 = np.stack([m1 @ coordinates_2[:, :, b].T for b in range(3)], axis=-1)
+    squares = (coordinates_1 ** 2).sum(axis=2) @ m2.T + m1 @ (coordinates_2 ** 2).sum(axis=2).T
+    covariance = np.empty(counts.shape + (3, 3))
+    for a in range(3):
+        for b in range(3):
+            covariance[:, :, a, b] = coordinates_1[:, :, a] @ coordinates_2[:, :, b].T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # center on the centroids of the common points
+        covariance -= sums_1[:, :, :, None] * sums_2[:, :, None, :] / counts[:, :, None, None]
+        squares -= ((sums_1 ** 2).sum(axis=2) + (sums_2 ** 2).sum(axis=2)) / counts
+        singular_values = np.linalg.svd(np.nan_to_num(covariance), compute_uv=False)
+        # reflections are not allowed, the smallest singular value is subtracted if the best fit is a reflection
+        signs = np.sign(np.linalg.det(np.nan_to_num(covariance)))
+        singular_values[:, :, 2] *= np.where(signs < 0, -1, 1)
+        deviations = np.maximum(squares - 2 * singular_values.sum(axis=2), 0) / counts
+        rmsd = np.sqrt(deviations)
+    rmsd[counts < 3] = np.nan
+    return rmsd
+
+
+class RMSDStore:
+    """Precomputed RMSD of all pairs of crystal structures and homology models, after superposition on the backbone
+    atoms of the generic number positions that both have. Built by build_rmsd_matrix.
+
+    There is a matrix of shape (items x items) for each region: all positions, the seven transmembrane helices, and
+    each segment with generic numbers (helices and the numbered parts of the loops)"""
+
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'rmsd_matrix'])
+    index_file = 'index.json'
+
+    def __init__(self, store_dir=None):
+        if store_dir:
+            self.store_dir = store_dir
+        self.index_path = os.sep.join([self.store_dir, self.index_file])
+        self.loaded_mtime = None
+        self.item_rows = {}
+        self.names = []
+        self.regions = {}
+
+    def load(self):
+        """Read the store index, reloading it if the store has been rebuilt. Returns False if there is no store"""
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            self.loaded_mtime = None
+            return False
+        if mtime == self.loaded_mtime:
+            return True
+
+        with open(self.index_path) as index_file:
+            index = json.load(index_file)
+        self.item_rows = {tuple(key): i for i, key in enumerate(index['items'])}
+        self.names = index['names']
+        self.regions = OrderedDict()
+        for region in index['regions']:
+            self.regions[region] = np.load(self.region_path(region, index['build']), mmap_mode='r')
+        self.loaded_mtime = mtime
+        return True
+
+    def region_path(self, region, build):
+        return os.sep.join([self.store_dir, '{}.{}.npy'.format(region, build)])
+
+    def covers(self, items, region=OVERALL):
+        """Check whether the region and all structures and homology models are in the store"""
+        if not self.load():
+            return False
+        return region in self.regions and all([tuple(item_key(item)) in self.item_rows for item in items])
+
+    def rmsd(self, items_1, items_2, region=OVERALL):
+        """RMSD (in Å) of every pair of structures or homology models, shape (len(items_1), len(items_2)). NaN for
+        pairs with less than three common positions in the region"""
+        self.load()
+        rows_1 = np.array([self.item_rows[tuple(item_key(item))] for item in items_1], dtype=np.intp)
+        rows_2 = np.array([self.item_rows[tuple(item_key(item))] for item in items_2], dtype=np.intp)
+        if not len(rows_1) or not len(rows_2):
+            return np.zeros((len(rows_1), len(rows_2)))
+        # read whole rows from the memory mapped file (sorted to keep reads sequential), then select the columns
+        order = np.argsort(rows_1)
+        rmsd = np.empty((len(rows_1), len(rows_2)))
+        rmsd[order] = self.regions[region][rows_1[order]][:, rows_2]
+        return rmsd
+
+    def closest(self, item, candidates, region=OVERALL):
+        """Candidates ordered by RMSD to item (candidates without an RMSD are left out), as (candidate, RMSD)"""
+        rmsd = self.rmsd([item], candidates, region)[0]
+        return [(candidates[i], float(rmsd[i])) for i in np.argsort(rmsd) if not np.isnan(rmsd[i])]
+
+    def create_regions(self, regions, num_items, build):
+        """Create the (empty) matrix files of a build, which are filled by blocks of rows"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        for region in regions:
+            matrix = np.lib.format.open_memmap(self.region_path(region, build), mode='w+', dtype=np.float16,
+                shape=(num_items, num_items))
+            matrix[:] = np.nan
+            del matrix
+
+    def save_rows(self, region, build, first, rmsd):
+        matrix = np.load(self.region_path(region, build), mmap_mode='r+')
+        matrix[first:first + len(rmsd)] = rmsd
+        matrix.flush()
+        del matrix
+
+    def save_index(self, items, names, regions, build):
+        """Write the index when all rows of a build are saved, and remove files of older builds"""
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_index_path, 'w') as index_file:
+            json.dump({'build': build, 'items': items, 'names': names, 'regions': regions}, index_file)
+        os.replace(tmp_index_path, self.index_path)
+
+        current_files = [os.path.basename(self.region_path(region, build)) for region in regions]
+        for file_name in os.listdir(self.store_dir):
+            if file_name.endswith('.npy') and file_name not in current_files:
+                os.remove(os.sep.join([self.store_dir, file_name]))
+
+
+# shared store instance, the index is reloaded when the store is rebuilt
+rmsd_store = RMSDStore()
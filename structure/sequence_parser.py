@@ -4,6 +4,7 @@ from residue.models import Residue
 from protein.models import Protein, ProteinSegment
 from structure.models import Structure
 from structure.functions import BlastSearch, BlastSearchOnline
+from structure.sequence_search import LocalSearch
 
 from Bio import SeqIO, pairwise2
 from Bio.PDB import PDBParser, PPBuilder
@@ -174,13 +175,16 @@ class SequenceParser(object):
 
     residue_list = ["ARG","ASP","GLU","HIS","ASN","GLN","LYS","SER","THR", "HIS", "HID","PHE","LEU","ILE","TYR","TRP","VAL","MET","PRO","CYS","ALA","GLY"]
 
-    def __init__(self, pdb_file=None, sequence=None, wt_protein_id=None):
+    def __init__(self, pdb_file=None, sequence=None, wt_protein_id=None, local_search=False):
 
         # dictionary of 'ParsedResidue' object storing information about alignments and bw numbers
         self.mapping = {}
         self.residues = {}
         self.segments = {}
-        self.blast = BlastSearch(blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_human_blastdb']))
+        if local_search:
+            self.blast = LocalSearch(human_only=True)
+        else:
+            self.blast = BlastSearch(blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_human_blastdb']))
         
 
         if pdb_file is not None:
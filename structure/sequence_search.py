@@ -0,0 +1,254 @@
+from Bio.Blast.Record import Alignment as BlastAlignment, HSP
+
+from common.alignment import MATRIX_CODES, MATRIX_SYMBOLS, MATRIX_UNKNOWN, BLOSUM62_ARRAY
+from protein.models import Protein
+
+import math
+import logging
+import numpy as np
+
+
+logger = logging.getLogger("protwis")
+
+# residue codes of the 20 standard amino acids (see common.alignment.MATRIX_SYMBOLS), used for k-mers
+STANDARD_CODES = 20
+NUM_CODES = len(MATRIX_SYMBOLS)
+
+
+def encode_sequence(sequence):
+    """Sequence string as an array of matrix codes"""
+    return np.array([MATRIX_CODES.get(aa, MATRIX_UNKNOWN) for aa in str(sequence).upper()], dtype=np.intp)
+
+
+def sequence_kmers(codes, k):
+    """Codes and start positions of all k-mers of standard amino acids in an encoded sequence"""
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    windows = np.stack([codes[i:len(codes) - k + i + 1] for i in range(k)], axis=1)
+    valid = ((windows >= 1) & (windows <= STANDARD_CODES)).all(axis=1)
+    kmers = (windows * (NUM_CODES ** np.arange(k - 1, -1, -1))).sum(axis=1)
+    positions = np.arange(len(kmers))
+    return kmers[valid], positions[valid]
+
+
+def smith_waterman(query, subject, gap_open, gap_extend, band=None, masked=None):
+    """Local alignment of two encoded sequences with affine gap costs (gap_open is the cost of the first residue of
+    a gap) and BLOSUM62 scores. Rows are computed as vectors, horizontal gaps with a running maximum. band is an
+    optional (lowest, highest) diagonal (subject position - query position), masked an optional boolean array of
+    query positions that can not be aligned. Returns score, aligned codes (-1 for gaps) and 1-based start positions"""
+    m, n = len(query), len(subject)
+    scores = BLOSUM62_ARRAY[query][:, subject].astype(np.int32)
+    if masked is not None:
+        scores[masked] = -1000
+    low = -10**6
+
+    H = np.zeros((m + 1, n + 1), dtype=np.int32)
+    E = np.full((m + 1, n + 1), low, dtype=np.int32)
+    F = np.full((m + 1, n + 1), low, dtype=np.int32)
+    columns = np.arange(n + 1)
+    extensions = columns * gap_extend
+    for i in range(1, m + 1):
+        F[i, 1:] = np.maximum(H[i - 1, 1:] - gap_open, F[i - 1, 1:] - gap_extend)
+        h = np.zeros(n + 1, dtype=np.int32)
+        h[1:] = np.maximum(np.maximum(H[i - 1, :-1] + scores[i - 1], F[i, 1:]), 0)
+        if band:
+            outside = (columns - i < band[0]) | (columns - i > band[1])
+            h[outside] = 0
+
+        # best horizontal gap ending in each column: max over k < j of h[k] - gap_open - (j - k - 1) * gap_extend
+        best = np.maximum.accumulate(h + extensions)
+        E[i, 1:] = best[:-1] - gap_open - extensions[:-1]
+        H[i] = np.maximum(h, E[i])
+        H[i, 0] = 0
+        if band:
+            H[i, outside] = 0
+            E[i, outside] = low
+
+    i, j = np.unravel_index(np.argmax(H), H.shape)
+    score = int(H[i, j])
+    aligned_query = []
+    aligned_subject = []
+    state = 'H'
+    while i > 0 and j > 0:
+        if state == 'H':
+            if H[i, j] == 0:
+                break
+            if H[i, j] == H[i - 1, j - 1] + scores[i - 1, j - 1]:
+                aligned_query.append(query[i - 1])
+                aligned_subject.append(subject[j - 1])
+                i -= 1
+                j -= 1
+                continue
+            state = 'E' if H[i, j] == E[i, j] else 'F'
+        if state == 'E':
+            # gap in the query
+            aligned_query.append(-1)
+            aligned_subject.append(subject[j - 1])
+            if E[i, j] == H[i, j - 1] - gap_open:
+                state = 'H'
+            j -= 1
+        else:
+            # gap in the subject
+            aligned_query.append(query[i - 1])
+            aligned_subject.append(-1)
+            if F[i, j] == H[i - 1, j] - gap_open:
+                state = 'H'
+            i -= 1
+
+    return score, aligned_query[::-1], aligned_subject[::-1], int(i) + 1, int(j) + 1
+
+
+class LocalSearch(object):
+    """Built-in alternative to structure.functions.BlastSearch, searching the wt protein sequences without the blastp
+    binary. Candidates are found with a k-mer index, and aligned with a (banded) Smith-Waterman. The output has the
+    same format as BlastSearch.run, a list of (protein id, Bio.Blast.Record.Alignment)"""
+
+    # gap costs of blastp (open 11, extend 1), as the cost of the first and each following residue of a gap
+    gap_open = 12
+    gap_extend = 1
+    # Karlin-Altschul parameters of BLOSUM62 with these gap costs, for the expect values
+    karlin_lambda = 0.267
+    karlin_k = 0.041
+    kmer_size = 3
+
+    # k-mer indices by database, built once per process
+    indices = {}
+
+    def __init__(self, human_only=False, top_results=1, candidates=10, max_hsps=5, min_score=40, band_width=32):
+        self.human_only = human_only
+        self.top_results = top_results
+        # number of proteins with most shared k-mers that are aligned
+        self.candidates = candidates
+        self.max_hsps = max_hsps
+        self.min_score = min_score
+        self.band_width = band_width
+
+    def get_index(self):
+        key = 'human' if self.human_only else 'all'
+        if key not in self.indices:
+            self.indices[key] = self.build_index()
+        return self.indices[key]
+
+    def build_index(self):
+        """Sorted k-mers of all wt sequences (the same proteins as the BLAST databases)"""
+        proteins = Protein.objects.filter(sequence_type__slug='wt')
+        if self.human_only:
+            proteins = proteins.filter(species__common_name='Human')
+
+        index = {'ids': [], 'names': [], 'sequences': []}
+        kmer_codes = []
+        kmer_proteins = []
+        for i, (pk, entry_name, sequence) in enumerate(proteins.values_list('pk', 'entry_name', 'sequence')):
+            codes = encode_sequence(sequence)
+            index['ids'].append(pk)
+            index['names'].append(entry_name)
+            index['sequences'].append(codes)
+            kmers = np.unique(sequence_kmers(codes, self.kmer_size)[0])
+            kmer_codes.append(kmers)
+            kmer_proteins.append(np.full(len(kmers), i, dtype=np.intp))
+
+        kmer_codes = np.concatenate(kmer_codes) if kmer_codes else np.zeros(0, dtype=np.intp)
+        kmer_proteins = np.concatenate(kmer_proteins) if kmer_proteins else np.zeros(0, dtype=np.intp)
+        order = np.argsort(kmer_codes, kind='mergesort')
+        index['kmer_codes'] = kmer_codes[order]
+        index['kmer_proteins'] = kmer_proteins[order]
+        index['total_length'] = sum([len(s) for s in index['sequences']])
+        return index
+
+    def find_candidates(self, index, query_kmers):
+        """Proteins sharing most k-mers with the query"""
+        kmers = np.unique(query_kmers)
+        starts = np.searchsorted(index['kmer_codes'], kmers, side='left')
+        counts = np.searchsorted(index['kmer_codes'], kmers, side='right') - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        proteins = index['kmer_proteins'][np.repeat(starts, counts) + offsets]
+        shared = np.bincount(proteins, minlength=len(index['ids']))
+        candidates = np.argsort(-shared, kind='mergesort')[:self.candidates]
+        return [c for c in candidates if shared[c] > 0]
+
+    def get_band(self, query_kmers, query_positions, subject):
+        """Range of diagonals with repeated k-mer hits, widened by band_width. None (no band) if there are none"""
+        subject_kmers, subject_positions = sequence_kmers(subject, self.kmer_size)
+        order = np.argsort(subject_kmers, kind='mergesort')
+        subject_kmers, subject_positions = subject_kmers[order], subject_positions[order]
+        starts = np.searchsorted(subject_kmers, query_kmers, side='left')
+        counts = np.searchsorted(subject_kmers, query_kmers, side='right') - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        diagonals = (subject_positions[np.repeat(starts, counts) + offsets] - np.repeat(query_positions, counts))
+        diagonals, hits = np.unique(diagonals, return_counts=True)
+        diagonals = diagonals[hits > 1]
+        if not len(diagonals):
+            return None
+        return diagonals.min() - self.band_width, diagonals.max() + self.band_width
+
+    def make_hsp(self, score, aligned_query, aligned_subject, query_start, subject_start, query_length,
+        total_length):
+        hsp = HSP()
+        hsp.score = score
+        hsp.bits = (self.karlin_lambda * score - math.log(self.karlin_k)) / math.log(2)
+        hsp.expect = self.karlin_k * query_length * total_length * math.exp(-self.karlin_lambda * score)
+        hsp.query = ''.join(['-' if c < 0 else MATRIX_SYMBOLS[c] for c in aligned_query])
+        hsp.sbjct = ''.join(['-' if c < 0 else MATRIX_SYMBOLS[c] for c in aligned_subject])
+        match = []
+        for q, s in zip(aligned_query, aligned_subject):
+            if q < 0 or s < 0:
+                match.append(' ')
+            elif q == s:
+                match.append(MATRIX_SYMBOLS[q])
+            elif BLOSUM62_ARRAY[q, s] > 0:
+                match.append('+')
+            else:
+                match.append(' ')
+        hsp.match = ''.join(match)
+        hsp.identities = sum([1 for q, s in zip(aligned_query, aligned_subject) if q == s and q >= 0])
+        hsp.positives = hsp.match.count('+') + hsp.identities
+        hsp.gaps = hsp.query.count('-') + hsp.sbjct.count('-')
+        hsp.align_length = len(aligned_query)
+        hsp.query_start = query_start
+        hsp.query_end = query_start + len([c for c in aligned_query if c >= 0]) - 1
+        hsp.sbjct_start = subject_start
+        hsp.sbjct_end = subject_start + len([c for c in aligned_subject if c >= 0]) - 1
+        return hsp
+
+    def run(self, input_seq):
+        index = self.get_index()
+        query = encode_sequence(input_seq)
+        query_kmers, query_positions = sequence_kmers(query, self.kmer_size)
+        if not len(query_kmers):
+            return []
+
+        hits = []
+        for c in self.find_candidates(index, query_kmers):
+            subject = index['sequences'][c]
+            band = self.get_band(query_kmers, query_positions, subject)
+
+            # additional HSPs are searched in the parts of the query that are not aligned yet
+            masked = np.zeros(len(query), dtype=bool)
+            hsps = []
+            while len(hsps) < self.max_hsps:
+                score, aligned_query, aligned_subject, query_start, subject_start = smith_waterman(query, subject,
+                    self.gap_open, self.gap_extend, band, masked)
+                if score < self.min_score:
+                    break
+                hsp = self.make_hsp(score, aligned_query, aligned_subject, query_start, subject_start, len(query),
+                    index['total_length'])
+                hsps.append(hsp)
+                masked[hsp.query_start - 1:hsp.query_end] = True
+
+            if hsps:
+                alignment = BlastAlignment()
+                alignment.hit_id = str(index['ids'][c])
+                alignment.hit_def = index['names'][c]
+                alignment.length = len(subject)
+                alignment.hsps = hsps
+                hits.append(alignment)
+
+        hits.sort(key=lambda x: -x.hsps[0].score)
+        output = []
+        for aln in hits[:self.top_results]:
+            logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
+            output.append((aln.hit_id, aln))
+        return output
+
+    def run_batch(self, input_seqs):
+        return [self.run(input_seq) for input_seq in input_seqs]
@@ -8,58 +8,307 @@ from Bio.PDB import *
 from Bio.Seq import Seq
 from structure.functions import *
 from structure.assign_generic_numbers_gpcr import GenericNumbering
+from django.core.cache import cache
+import uuid
+
+from common.models import ReleaseNotes
 from protein.models import Protein
-from structure.models import Structure
+from residue.models import Residue
+from structure.models import Structure, StructureModel
 from interaction.models import ResidueFragmentInteraction
 
 logger = logging.getLogger("protwis")
-#==============================================================================  
-class ProteinSuperpose(object):
-  
-    
-
-    def __init__ (self, ref_file, alt_files, simple_selection):
-    
-        self.selection = SelectionParser(simple_selection)
-        self.ref_struct = PDBParser(PERMISSIVE=True).get_structure('ref', ref_file)[0]
-        assert self.ref_struct, self.logger.error("Can't parse the ref file %s".format(ref_file))
-        if self.selection.generic_numbers != [] or self.selection.helices != []:
-            if not check_gn(self.ref_struct):
-                gn_assigner = GenericNumbering(structure=self.ref_struct)
-                self.ref_struct = gn_assigner.assign_generic_numbers()
-      
-        self.alt_structs = []
-        for alt_id, alt_file in enumerate(alt_files):
+#==============================================================================
+def kabsch(reference, mobile, mask):
+    ''' Batched Kabsch algorithm. reference (positions x 3) and mobile (structures x positions x 3) are coordinates of
+        the same positions, mask (structures x positions) marks the positions present in both.
+
+        Returns the rotations (structures x 3 x 3) and translations (structures x 3) that superpose each structure on
+        the reference as coordinates @ rotation + translation (as Bio.PDB.Superimposer), and the RMSD after
+        superposition. Structures with less than three positions get the identity transformation and a NaN RMSD.
+    '''
+    weights = mask[:, :, None].astype(np.float64)
+    counts = weights.sum(axis=1)
+    valid = counts[:, 0] >= 3
+    counts[counts == 0] = 1
+    ref_centers = (weights * reference[None]).sum(axis=1) / counts
+    mobile_centers = (weights * mobile).sum(axis=1) / counts
+    ref_centered = (reference[None] - ref_centers[:, None]) * weights
+    mobile_centered = (mobile - mobile_centers[:, None]) * weights
+
+    covariance = np.einsum('spi,spj->sij', mobile_centered, ref_centered)
+    u, singular_values, vt = np.linalg.svd(covariance)
+    # avoid reflections by flipping the axis of the smallest singular value
+    signs = np.sign(np.linalg.det(np.matmul(u, vt)))
+    signs[signs == 0] = 1
+    u[:, :, 2] *= signs[:, None]
+    rotations = np.matmul(u, vt)
+    translations = ref_centers - np.einsum('si,sij->sj', mobile_centers, rotations)
+
+    deviations = np.einsum('spi,sij->spj', mobile_centered, rotations) - ref_centered
+    rmsd = np.sqrt((deviations ** 2).sum(axis=(1, 2)) / counts[:, 0])
+    rotations[~valid] = np.eye(3)
+    translations[~valid] = 0
+    rmsd[~valid] = np.nan
+    return rotations, translations, rmsd
+
+
+def parse_ca_atoms(pdb):
+    ''' Chain, residue number and coordinates of the CA atoms of a PDB file (the first of alternative locations).
+    '''
+    atoms = OrderedDict()
+    for line in pdb.split('\n'):
+        if line.startswith(('ATOM', 'HETATM')) and line[12:16] == ' CA ':
+            try:
+                key = (line[21], int(line[22:26]))
+                if key not in atoms:
+                    atoms[key] = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+            except ValueError:
+                continue
+    return atoms
+
+
+def transform_pdb(pdb, rotation, translation):
+    ''' Apply a rotation and translation to the coordinates of the ATOM and HETATM records of a PDB file.
+    '''
+    lines = pdb.split('\n')
+    atoms = [i for i, line in enumerate(lines) if line.startswith(('ATOM', 'HETATM'))]
+    if not atoms:
+        return pdb
+    coordinates = np.array([[lines[i][30:38], lines[i][38:46], lines[i][46:54]] for i in atoms], dtype=np.float64)
+    coordinates = np.dot(coordinates, rotation) + translation
+    for i, (x, y, z) in zip(atoms, coordinates.tolist()):
+        lines[i] = '{}{:8.3f}{:8.3f}{:8.3f}{}'.format(lines[i][:30], x, y, z, lines[i][54:])
+    return '\n'.join(lines)
+
+
+def select_residues(pdb, keep):
+    ''' ATOM and HETATM records of the residues where keep(chain, residue number) is true.
+    '''
+    lines = []
+    for line in pdb.split('\n'):
+        if line.startswith(('ATOM', 'HETATM')):
+            try:
+                if keep(line[21], int(line[22:26])):
+                    lines.append(line)
+            except ValueError:
+                continue
+    lines.append('END')
+    return '\n'.join(lines) + '\n'
+
+
+def generic_number_bfactors(display):
+    ''' B-factors of the CA (GPCRdb number) and N (Ballesteros-Weinstein number) atoms for a display generic number,
+        as written by GenericNumbering. PDB files allow two decimals, so GPCRdb numbers x.xx1 are negative.
+    '''
+    bw, gpcrdb = display.split('x')
+    gpcrdb = '{}.{}'.format(bw.split('.')[0], gpcrdb)
+    if len(gpcrdb.split('.')[1]) > 2:
+        gpcrdb = '-' + gpcrdb[:4]
+    return float(gpcrdb), float(bw)
+
+
+def annotate_pdb(pdb, residues):
+    ''' Write the generic numbers of the residues (see generic_number_bfactors) in the B-factor column of the CA and
+        N atoms of a PDB file.
+    '''
+    lines = pdb.split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith(('ATOM', 'HETATM')) and line[12:16] in (' CA ', ' N  '):
             try:
-                tmp_struct = PDBParser(PERMISSIVE=True).get_structure(alt_id, alt_file)[0]
-                if self.selection.generic_numbers != [] or self.selection.helices != []:
-                    if not check_gn(tmp_struct):
-                        gn_assigner = GenericNumbering(structure=tmp_struct)
-                        self.alt_structs.append(gn_assigner.assign_generic_numbers())
-                        self.alt_structs[-1].id = alt_id
-                    else:
-                        self.alt_structs.append(tmp_struct)
-            except Exception as e:
-                logger.warning("Can't parse the file {!s}\n{!s}".format(alt_id, e))
-        self.selector = CASelector(self.selection, self.ref_struct, self.alt_structs)
-
-    def run (self):
-    
-        if self.alt_structs == []:
+                display = residues.get((line[21], int(line[22:26])), (None, None, None))[2]
+                if not display or 'x' not in display:
+                    continue
+                ca_bfactor, n_bfactor = generic_number_bfactors(display)
+            except ValueError:
+                continue
+            bfactor = ca_bfactor if line[12:16] == ' CA ' else n_bfactor
+            if bfactor != 0.:
+                lines[i] = '{:<60}{:6.2f}{}'.format(line[:60], bfactor, line[66:])
+    return '\n'.join(lines)
+
+
+def assign_residues(pdb):
+    ''' Generic numbers, segments and display generic numbers of the residues of a PDB file that is not in the
+        database, assigned by GenericNumbering. Returns a dictionary of (chain, residue number): (generic number,
+        segment, display generic number).
+    '''
+    pdb_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(pdb))[0]
+    gn_assigner = GenericNumbering(structure=pdb_struct)
+    gn_assigner.assign_generic_numbers()
+    residues = {}
+    for chain, chain_residues in gn_assigner.residues.items():
+        for number, mapped in chain_residues.items():
+            label = None
+            if mapped.display:
+                bw, gpcrdb = mapped.display.split('x')
+                label = '{}x{}'.format(bw.split('.')[0], gpcrdb)
+            residues[(chain, number)] = (label, mapped.segment or None, mapped.display or None)
+    return residues
+
+
+# cached residue annotations of structures and homology models are replaced after a new data release
+SUPERPOSITION_CACHE_TIMEOUT = 60*60*24*7
+
+# superpositions are kept for downloading for a day
+SUPERPOSITION_RESULT_TIMEOUT = 60*60*24
+
+def database_residues(item, pdb):
+    ''' Generic numbers, segments and display generic numbers of the residues of a structure or homology model, from
+        the database (or cache). Structure residues are numbered as in the PDB file, homology models as the receptor.
+    '''
+    if isinstance(item, StructureModel):
+        cache_key = 'superposition_numbers_{}_model_{}'.format(ReleaseNotes.current_version(), item.pk)
+        residues = Residue.objects.filter(protein_conformation__protein=item.protein_id)
+    else:
+        cache_key = 'superposition_numbers_{}_structure_{}'.format(ReleaseNotes.current_version(), item.pk)
+        residues = Residue.objects.filter(protein_conformation=item.protein_conformation_id)
+    numbers = cache.get(cache_key)
+    if numbers is None:
+        numbers = {number: (label, segment, display) for number, label, segment, display in residues.values_list(
+            'sequence_number', 'generic_number__label', 'protein_segment__slug', 'display_generic_number__label')}
+        cache.set(cache_key, numbers, SUPERPOSITION_CACHE_TIMEOUT)
+    return {key: numbers[key[1]] for key in parse_ca_atoms(pdb) if key[1] in numbers}
+
+
+class SuperposedStructure(object):
+    ''' A structure to superpose: the name of its file, the PDB file, and the generic number, segment and display
+        generic number of each residue by (chain, residue number). The transformation is set by BatchSuperpose and
+        only applied to the file when it is written. Files of structures and homology models are not pickled (e.g.
+        into the cache), but read from the database again when they are needed.
+    '''
+    def __init__(self, name, pdb, residues, item=None):
+        self.name = name
+        self._pdb = pdb
+        self.residues = residues
+        self.source = (type(item), item.pk) if item is not None else None
+        self.rotation = np.eye(3)
+        self.translation = np.zeros(3)
+        self.rmsd = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.source:
+            state['_pdb'] = None
+        return state
+
+    @property
+    def pdb(self):
+        if self._pdb is None:
+            model, pk = self.source
+            self._pdb = model.objects.get(pk=pk).get_cleaned_pdb()
+        return self._pdb
+
+    @classmethod
+    def from_item(cls, name, item):
+        ''' Structure or homology model from a selection. Falls back to GenericNumbering if the residue numbers of
+            the file do not match the database.
+        '''
+        pdb = item.get_cleaned_pdb()
+        residues = database_residues(item, pdb)
+        if len([r for r in residues.values() if r[0]]) < 3:
+            residues = assign_residues(pdb)
+        return cls(name, pdb, residues, item)
+
+    @classmethod
+    def from_file(cls, name, pdb):
+        return cls(name, pdb, assign_residues(pdb))
+
+    def ca_coordinates(self):
+        ''' Dictionary of generic number: coordinates of the CA atoms.
+        '''
+        coordinates = OrderedDict()
+        for key, coordinate in parse_ca_atoms(self.pdb).items():
+            label = self.residues.get(key, (None, None, None))[0]
+            if label and label not in coordinates:
+                coordinates[label] = coordinate
+        return coordinates
+
+    def generic_numbers(self):
+        return set([label for label, segment, display in self.residues.values() if label])
+
+    def superposed_pdb(self, keep=None):
+        ''' The transformed file with the generic numbers in the B-factor column of the CA and N atoms (as written
+            by GenericNumbering), optionally only the residues where keep(generic number, segment) is true.
+        '''
+        pdb = annotate_pdb(transform_pdb(self.pdb, self.rotation, self.translation), self.residues)
+        if keep is None:
+            return pdb
+        return select_residues(pdb, lambda chain, number: keep(*self.residues.get((chain, number), (None, None,
+            None))[:2]))
+
+
+class BatchSuperpose(object):
+    ''' Superpose structures on a reference by the CA atoms of the selected generic numbers and helices. The
+        coordinates of all structures are stacked in one array and superposed at once (see kabsch).
+
+        @param reference: SuperposedStructure \n
+        @param structures: list of SuperposedStructure objects to be superposed \n
+        @param parsed_selection: SelectionParser
+    '''
+    def __init__(self, reference, structures, parsed_selection):
+        self.reference = reference
+        self.structures = structures
+        self.generic_numbers = set([gn.replace('.', 'x') for gn in parsed_selection.generic_numbers])
+        self.helices = set([str(helix) for helix in parsed_selection.helices])
+
+    def is_selected(self, label):
+        return label in self.generic_numbers or label.split('x')[0] in self.helices
+
+    def run(self):
+        if not self.structures:
             logger.error("No structures to align!")
             return []
-    
-        super_imposer = Superimposer()
-        for alt_struct in self.alt_structs:
-            try:
-                ref, alt = self.selector.get_consensus_atom_sets(alt_struct.id)
-                super_imposer.set_atoms(ref, alt)
-                super_imposer.apply(alt_struct.get_atoms())
-                logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, super_imposer.rms))
-            except Exception as msg:
-                logger.error("Failed to superpose structures {} and {}\n{}".format(self.ref_struct.id, alt_struct.id, msg))
 
-        return self.alt_structs
+        ref_coordinates = self.reference.ca_coordinates()
+        positions = [label for label in ref_coordinates if self.is_selected(label)]
+        columns = {label: i for i, label in enumerate(positions)}
+        reference = np.array([ref_coordinates[label] for label in positions], dtype=np.float64).reshape(-1, 3)
+        mobile = np.zeros((len(self.structures), len(positions), 3))
+        mask = np.zeros((len(self.structures), len(positions)), dtype=bool)
+        for i, structure in enumerate(self.structures):
+            for label, coordinate in structure.ca_coordinates().items():
+                if label in columns:
+                    mobile[i, columns[label]] = coordinate
+                    mask[i, columns[label]] = True
+
+        rotations, translations, rmsd = kabsch(reference, mobile, mask)
+        for structure, rotation, translation, structure_rmsd in zip(self.structures, rotations, translations, rmsd):
+            if np.isnan(structure_rmsd):
+                logger.error("Failed to superpose structures {} and {}\nLess than three common CA atoms".format(
+                    self.reference.name, structure.name))
+                continue
+            structure.rotation = rotation
+            structure.translation = translation
+            structure.rmsd = float(structure_rmsd)
+            logger.info("RMS(reference, model {!s}) = {:f}".format(structure.name, structure.rmsd))
+        return self.structures
+
+    def consensus_generic_numbers(self):
+        ''' Selected generic numbers of the reference that are in any of the superposed structures.
+        '''
+        ref_numbers = set([label for label in self.reference.generic_numbers() if self.is_selected(label)])
+        consensus = set()
+        for structure in self.structures:
+            consensus |= ref_numbers & structure.generic_numbers()
+        return consensus
+
+    def save(self):
+        ''' Store the superposition in the cache for downloading, and return its cache key (which is kept in the
+            session instead of the superposition).
+        '''
+        cache_key = 'superposition_{}'.format(uuid.uuid4().hex)
+        cache.set(cache_key, self, SUPERPOSITION_RESULT_TIMEOUT)
+        return cache_key
+
+    @staticmethod
+    def load(cache_key):
+        ''' A superposition stored by save, or None if it has expired.
+        '''
+        # sessions from before superpositions were cached hold the superposition itself
+        if not isinstance(cache_key, str):
+            return None
+        return cache.get(cache_key)
 
 #==============================================================================  
 class FragmentSuperpose(object):
@@ -0,0 +1,198 @@
+from django.conf import settings
+
+from residue.models import Residue
+from structure.models import Rotamer
+
+import Bio.PDB as PDB
+from Bio.PDB.Atom import Atom
+from Bio.PDB.Residue import Residue as PDBResidue
+from collections import OrderedDict
+from io import StringIO
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+logger = logging.getLogger('homology_modeling')
+
+ATOM_DTYPE = np.dtype([('name', 'U4'), ('fullname', 'U4'), ('element', 'U2'), ('altloc', 'U1'), ('serial', 'i4'),
+    ('bfactor', 'f4'), ('occupancy', 'f4')])
+RESIDUE_DTYPE = np.dtype([('group', 'U8'), ('key', 'U16'), ('label', 'U16'), ('sequence_number', 'i4'),
+    ('resname', 'U3'), ('hetfield', 'U8'), ('resseq', 'i4'), ('icode', 'U1'), ('start', 'i4'), ('end', 'i4')])
+
+# group of the rotamer residues, the other groups are the segments of the structure array
+ROTAMER_GROUP = 'rotamer'
+
+
+def structure_rotamers(structure):
+    """Rotamers of the preferred chain of a structure, as (display generic number label, sequence number, atoms).
+    The rotamer of each residue is selected as in GPCRDBParsingPDB.fetch_residues_from_pdb"""
+    rotamers = OrderedDict()
+    for rotamer in Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation,
+        structure__preferred_chain=structure.preferred_chain).select_related('residue__display_generic_number',
+        'pdbdata').order_by('residue__sequence_number'):
+        rotamers.setdefault(rotamer.residue_id, []).append(rotamer)
+
+    output = []
+    for residue_rotamers in rotamers.values():
+        rotamer = residue_rotamers[0]
+        if len(residue_rotamers) > 1:
+            chain_rotamers = [r for r in residue_rotamers if not r.pdbdata.pdb.startswith('COMPND')
+                and r.pdbdata.pdb[21] in structure.preferred_chain]
+            if not chain_rotamers:
+                continue
+            rotamer = chain_rotamers[0]
+
+        rota_struct = PDB.PDBParser(QUIET=True).get_structure('structure', StringIO(rotamer.pdbdata.pdb))[0]
+        residues = [residue for chain in rota_struct for residue in chain]
+        if not residues:
+            continue
+        label = rotamer.residue.display_generic_number.label if rotamer.residue.display_generic_number else ''
+        output.append((label, rotamer.residue.sequence_number, [atom for residue in residues for atom in residue]))
+    return output
+
+
+def template_version(structure):
+    """Hash of the PDB data and the residue annotation (segments and generic numbers) of a structure. A stored
+    template is only used if it was made from the same data"""
+    version = hashlib.sha256(structure.pdb_data.content_hash.encode('utf-8'))
+    for residue in Residue.objects.filter(protein_conformation=structure.protein_conformation).order_by(
+        'sequence_number').values_list('sequence_number', 'protein_segment__slug', 'generic_number__label',
+        'display_generic_number__label'):
+        version.update(repr(residue).encode('utf-8'))
+    return version.hexdigest()
+
+
+class TemplateStore(object):
+    """Coordinates of template structures for homology modeling, parsed and annotated with generic numbers once.
+    Each structure is stored as three NumPy arrays (coordinates, atoms and residues), memory-mapped when read. The
+    residues are the segments of GPCRDBParsingPDB.pdb_array_creator, and the rotamers of the structure"""
+
+    store_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'homology_models', 'templates'])
+
+    # loaded structures, and whether the stored template of a structure is up to date, shared by all instances of a
+    # process
+    structures = {}
+    current = {}
+
+    def path(self, structure):
+        return os.sep.join([self.store_dir, structure.pdb_code.index])
+
+    def exists(self, structure):
+        """Check whether a structure is stored, and was stored from its current data (see template_version)"""
+        pdb_code = structure.pdb_code.index
+        if pdb_code in self.structures:
+            return True
+        if pdb_code not in self.current:
+            try:
+                with open(os.sep.join([self.path(structure), 'version'])) as version_file:
+                    stored_version = version_file.read()
+            except OSError:
+                return False
+            self.current[pdb_code] = stored_version == template_version(structure)
+            if not self.current[pdb_code]:
+                logger.warning('Stored template {} is out of date, run build_homology_model_templates'.format(
+                    pdb_code))
+        return self.current[pdb_code]
+
+    def save(self, structure, pdb_array, rotamers):
+        """Store the output of pdb_array_creator, and rotamers as returned by structure_rotamers"""
+        residues = []
+        atoms = []
+        coords = []
+
+        def add_residue(group, key, label, sequence_number, atom_list):
+            start = len(atoms)
+            for atom in atom_list:
+                atoms.append((atom.get_name(), atom.get_fullname(), atom.element or '', atom.get_altloc(),
+                    atom.get_serial_number() or 0, atom.get_bfactor(), atom.get_occupancy() or 0))
+                coords.append(atom.get_coord())
+            if atom_list:
+                parent = atom_list[0].get_parent()
+                hetfield, resseq, icode = parent.get_id()
+                resname = parent.get_resname()
+            else:
+                hetfield, resseq, icode, resname = ' ', 0, ' ', ''
+            residues.append((group, key, label, sequence_number, resname, hetfield, resseq, icode, start, len(atoms)))
+
+        for segment, segment_residues in pdb_array.items():
+            for gn, atom_list in segment_residues.items():
+                add_residue(segment, gn, '', 0, atom_list)
+        for label, sequence_number, atom_list in rotamers:
+            add_residue(ROTAMER_GROUP, '', label, sequence_number, atom_list)
+
+        # write to a new directory, then point the link of the structure to it, so that the template is always
+        # available and workers never read a partially written structure
+        path = self.path(structure)
+        os.makedirs(self.store_dir, exist_ok=True)
+        data_path = tempfile.mkdtemp(prefix=structure.pdb_code.index + '.', dir=self.store_dir)
+        np.save(os.sep.join([data_path, 'coords.npy']), np.array(coords, dtype=np.float32).reshape(-1, 3))
+        np.save(os.sep.join([data_path, 'atoms.npy']), np.array(atoms, dtype=ATOM_DTYPE))
+        np.save(os.sep.join([data_path, 'residues.npy']), np.array(residues, dtype=RESIDUE_DTYPE))
+        with open(os.sep.join([data_path, 'version']), 'w') as version_file:
+            version_file.write(template_version(structure))
+
+        previous_path = os.path.realpath(path) if os.path.islink(path) else None
+        if os.path.isdir(path) and not os.path.islink(path):
+            # templates stored before versioning are plain directories
+            shutil.rmtree(path)
+        tmp_link = path + '.link'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(data_path), tmp_link)
+        os.replace(tmp_link, path)
+        if previous_path and previous_path != os.path.realpath(data_path):
+            shutil.rmtree(previous_path, ignore_errors=True)
+        self.structures.pop(structure.pdb_code.index, None)
+        self.current[structure.pdb_code.index] = True
+
+    def load(self, structure):
+        pdb_code = structure.pdb_code.index
+        if pdb_code not in self.structures:
+            path = self.path(structure)
+            data = {}
+            for name in ['coords', 'atoms', 'residues']:
+                data[name] = np.load(os.sep.join([path, name + '.npy']), mmap_mode='r')
+
+            # rotamer lookups by display generic number and sequence number
+            data['rotamers'] = {}
+            for i in np.nonzero(data['residues']['group'] == ROTAMER_GROUP)[0]:
+                residue = data['residues'][i]
+                if residue['label']:
+                    data['rotamers'][str(residue['label'])] = i
+                data['rotamers'][int(residue['sequence_number'])] = i
+            self.structures[pdb_code] = data
+        return self.structures[pdb_code]
+
+    def make_atoms(self, data, index):
+        """New Bio.PDB atoms of a stored residue, which can be modified by the caller"""
+        row = data['residues'][index]
+        residue = PDBResidue((str(row['hetfield']), int(row['resseq']), str(row['icode'])), str(row['resname']), ' ')
+        for i in range(row['start'], row['end']):
+            a = data['atoms'][i]
+            residue.add(Atom(str(a['name']), np.array(data['coords'][i], dtype='f'), float(a['bfactor']),
+                float(a['occupancy']), str(a['altloc']), str(a['fullname']), int(a['serial']),
+                element=str(a['element'])))
+        return residue.get_list()
+
+    def pdb_array(self, structure, segments):
+        """Structure array in the format of pdb_array_creator, with (at least) the given segments"""
+        data = self.load(structure)
+        output = OrderedDict([(segment, OrderedDict()) for segment in segments])
+        for i, row in enumerate(data['residues']):
+            if row['group'] == ROTAMER_GROUP:
+                continue
+            output.setdefault(str(row['group']), OrderedDict())[str(row['key'])] = self.make_atoms(data, i)
+        return output
+
+    def rotamer(self, structure, label=None, sequence_number=None):
+        """Display generic number label and atoms of a rotamer, by display generic number label or sequence number.
+        Returns None if the rotamer is not stored"""
+        data = self.load(structure)
+        index = data['rotamers'].get(label if label else int(sequence_number))
+        if index is None:
+            return None
+        return str(data['residues'][index]['label']), self.make_atoms(data, index)
@@ -1,3 +1,117 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from structure.pdb_storage import (compress_pdb, decompress_pdb, hash_pdb, index_pdb, dump_index, load_index,
+    select_blocks)
+from structure.rmsd_matrix import pairwise_rmsd, RMSDStore
+
+from collections import namedtuple
+import numpy as np
+import shutil
+import tempfile
+
+
+PDB = '\n'.join([
+    'HEADER    MEMBRANE PROTEIN                        01-JAN-20   1ABC',
+    'ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00  0.00           N',
+    'ATOM      2  CA  ALA A   1      11.639   6.071  -5.147  1.00  0.00           C',
+    'ATOM      3  N   GLY B   1      12.104   7.134  -7.504  1.00  0.00           N',
+    'HETATM    4  C1  RET A 401      13.104   8.134  -8.504  1.00  0.00           C',
+    'HETATM    5  O   HOH A 501      14.104   9.134  -9.504  1.00  0.00           O',
+    'END',
+])
+
+
+class PdbStorageTest(SimpleTestCase):
+
+    def test_compression(self):
+        self.assertEqual(decompress_pdb(compress_pdb(PDB)), PDB)
+        # data read from a binary field can be a memoryview
+        self.assertEqual(decompress_pdb(memoryview(compress_pdb(PDB))), PDB)
+        self.assertLess(len(compress_pdb(PDB * 10)), len(PDB))
+        self.assertEqual(hash_pdb(PDB), hash_pdb(decompress_pdb(compress_pdb(PDB))))
+        self.assertNotEqual(hash_pdb(PDB), hash_pdb(PDB + '\n'))
+
+    def test_index(self):
+        blocks = load_index(dump_index(index_pdb(PDB)))
+        self.assertEqual([b[:3] for b in blocks], [['', '', ''], ['ATOM', 'A', 'ALA'], ['ATOM', 'B', 'GLY'],
+            ['HET', 'A', 'RET'], ['HET', 'A', 'HOH'], ['', '', '']])
+
+        lines = PDB.split('\n')
+        self.assertEqual(select_blocks(PDB, blocks, lambda kind, chain, residue: True), PDB)
+        self.assertEqual(select_blocks(PDB, blocks, lambda kind, chain, residue: chain == 'A'),
+            '\n'.join([lines[i] for i in [1, 2, 4, 5]]))
+        self.assertEqual(select_blocks(PDB, blocks, lambda kind, chain, residue: kind == 'ATOM' and chain == 'B'),
+            lines[3])
+        self.assertEqual(select_blocks(PDB, blocks, lambda kind, chain, residue: kind == 'HET' and residue != 'HOH'),
+            lines[4])
+        self.assertEqual(select_blocks(PDB, blocks, lambda kind, chain, residue: False), '')
+
+    def test_trailing_line_break(self):
+        pdb = PDB + '\n'
+        blocks = index_pdb(pdb)
+        self.assertEqual(select_blocks(pdb, blocks, lambda kind, chain, residue: True), pdb)
+        self.assertEqual(select_blocks(pdb, blocks, lambda kind, chain, residue: kind == 'ATOM'),
+            '\n'.join(PDB.split('\n')[1:4]))
+
+
+def kabsch_rmsd(coordinates_1, coordinates_2):
+    """RMSD after superposition of two sets of points, with the rotation of the Kabsch algorithm"""
+    p = coordinates_1 - coordinates_1.mean(axis=0)
+    q = coordinates_2 - coordinates_2.mean(axis=0)
+    u, s, vt = np.linalg.svd(p.T @ q)
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1, 1, d]) @ u.T
+    return np.sqrt(((p @ rotation.T - q) ** 2).sum(axis=1).mean())
+
+
+def rotation_matrix(angle):
+    return np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+
+
+# stand-in for a Structure in the RMSD store
+Item = namedtuple('Item', ['pk'])
+
+
+class RMSDMatrixTest(SimpleTestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(1)
+        self.coordinates = random.normal(scale=10, size=(4, 20, 3))
+        # the second structure is a rotated and moved copy of the first
+        self.coordinates[1] = self.coordinates[0] @ rotation_matrix(1).T + [5, -3, 2]
+        self.mask = np.ones((4, 20), dtype=bool)
+        self.mask[2, :5] = False
+        self.mask[3, 2:] = False
+        self.coordinates[~self.mask] = 0
+
+    def test_pairwise_rmsd(self):
+        rmsd = pairwise_rmsd(self.coordinates, self.mask, self.coordinates, self.mask)
+        self.assertEqual(rmsd.shape, (4, 4))
+        self.assertAlmostEqual(rmsd[0, 0], 0, places=5)
+        self.assertAlmostEqual(rmsd[0, 1], 0, places=5)
+        np.testing.assert_allclose(rmsd[:3, :3], rmsd[:3, :3].T, atol=1e-6)
+        # only the points present in both structures are compared
+        common = self.mask[0] & self.mask[2]
+        self.assertAlmostEqual(rmsd[0, 2], kabsch_rmsd(self.coordinates[0][common], self.coordinates[2][common]))
+        # less than three common points
+        self.assertTrue(np.isnan(rmsd[0, 3]))
+
+    def test_store(self):
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = RMSDStore(store_dir)
+            items = [Item(pk) for pk in [11, 12, 13, 14]]
+            rmsd = pairwise_rmsd(self.coordinates, self.mask, self.coordinates, self.mask)
+            store.create_regions(['overall'], 4, 1)
+            store.save_rows('overall', 1, 0, rmsd[:2])
+            store.save_rows('overall', 1, 2, rmsd[2:])
+            store.save_index([['structure', item.pk] for item in items], ['A', 'B', 'C', 'D'], ['overall'], 1)
+
+            self.assertTrue(store.covers(items))
+            self.assertFalse(store.covers(items, 'TM1'))
+            self.assertFalse(store.covers([Item(15)]))
+            np.testing.assert_allclose(store.rmsd(items[2:0:-1], items[:3]), rmsd[2:0:-1, :3], rtol=1e-3, atol=1e-3)
+            # the structure without an RMSD is left out
+            self.assertEqual([item.pk for item, value in store.closest(items[0], items[1:])], [12, 13])
+        finally:
+            shutil.rmtree(store_dir)
@@ -1,7 +1,7 @@
 from django.shortcuts import render
 from django.conf import settings
 from django.views.generic import TemplateView, View
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, Http404
 from django.db.models import Count, Q, Prefetch
 from django import forms
 from django.core.cache import cache
@@ -12,7 +12,7 @@ from protein.models import Gene, ProteinSegment, IdentifiedSites
 from structure.models import Structure, StructureModel, StructureModelStatsRotamer, StructureModelSeqSim, StructureRefinedStatsRotamer, StructureRefinedSeqSim
 from structure.functions import CASelector, SelectionParser, GenericNumbersSelector, SubstructureSelector, check_gn
 from structure.assign_generic_numbers_gpcr import GenericNumbering
-from structure.structural_superposition import ProteinSuperpose,FragmentSuperpose
+from structure.structural_superposition import BatchSuperpose, SuperposedStructure, FragmentSuperpose
 from structure.forms import *
 from interaction.models import ResidueFragmentInteraction,StructureLigandInteraction
 from protein.models import Protein, ProteinFamily
@@ -22,11 +22,13 @@ from common.views import AbsSegmentSelection,AbsReferenceSelection
 from common.selection import Selection, SelectionItem
 from common.extensions import MultiFileField
 from common.models import ReleaseNotes
+from common.snapshots import statistics_snapshot
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
 import inspect
 import os
+import uuid
 import time
 import zipfile
 import math
@@ -48,6 +50,36 @@ import sys
 
 class_tree = {'001':'A','002':'B1','003':'B2','004':'C','005':'F','006':'T'}
 
+# uploaded and generated files are kept in the cache for a day, the session only keeps their cache keys
+SESSION_FILE_TIMEOUT = 60*60*24
+
+def session_file_put(session, key, value):
+    """Store a file (or files) in the cache, and its cache key in the session"""
+    cache_key = 'session_file_{}'.format(uuid.uuid4().hex)
+    cache.set(cache_key, value, SESSION_FILE_TIMEOUT)
+    session[key] = cache_key
+
+def session_file_get(session, key):
+    """A file stored by session_file_put, or None if there is none or it has expired"""
+    cache_key = session.get(key)
+    # sessions from before files were cached hold the files themselves
+    if not isinstance(cache_key, str):
+        return None
+    return cache.get(cache_key)
+
+def uploaded_pdb(uploaded_file):
+    """Name and contents of an uploaded PDB file"""
+    return (uploaded_file.name, uploaded_file.read().decode('UTF-8'))
+
+SUPERPOSITION_ITEM_TYPES = ['structure', 'structure_model', 'structure_model_Inactive', 'structure_model_Intermediate', 'structure_model_Active']
+
+def superposition_file_name(selection_item, suffix=''):
+    item = selection_item.item
+    if selection_item.type == 'structure':
+        return '{}_{}{}.pdb'.format(item.protein_conformation.protein.entry_name, item.pdb_code.index, suffix)
+    return 'Class{}_{}_{}_{}_GPCRdb{}.pdb'.format(class_tree[item.protein.family.slug[:3]], item.protein.entry_name,
+        item.state.name, item.main_template.pdb_code.index, suffix)
+
 class StructureBrowser(TemplateView):
     """
     Fetching Structure data for browser
@@ -82,7 +114,7 @@ class ServeHomologyModels(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(ServeHomologyModels, self).get_context_data(**kwargs)
         try:
-            context['structure_model'] = StructureModel.objects.all().defer('pdb').prefetch_related(
+            context['structure_model'] = StructureModel.objects.all().defer('compressed_pdb', 'pdb_index').prefetch_related(
                 "protein__family",
                 "state",
                 "protein__family__parent__parent__parent",
@@ -270,6 +302,14 @@ class StructureStatistics(TemplateView):
 
     def get_context_data (self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context.update(statistics_snapshot('structure_statistics'))
+        context['release_notes'] = ReleaseNotes.objects.all()[0]
+
+        return context
+
+    def get_statistics(self):
+        """Context of the statistics page, stored as a snapshot by build_statistics_snapshots"""
+        context = {}
 
         families = ProteinFamily.objects.all()
         lookup = {}
@@ -312,7 +352,6 @@ class StructureStatistics(TemplateView):
         context['unique_gprots_by_class'] = self.count_by_class(unique_gprots, lookup)
         context['unique_active'] = len(unique_active)
         context['unique_active_by_class'] = self.count_by_class(unique_active, lookup)
-        context['release_notes'] = ReleaseNotes.objects.all()[0]
 
         context['chartdata'] = self.get_per_family_cumulative_data_series(years, unique_structs, lookup)
         context['chartdata_y'] = self.get_per_family_data_series(years, unique_structs, lookup)
@@ -774,15 +813,15 @@ class GenericNumberingResults(TemplateView):
 
     def post (self, request, *args, **kwargs):
 
-        generic_numbering = GenericNumbering(StringIO(request.FILES['pdb_file'].file.read().decode('UTF-8',"ignore")))
+        generic_numbering = GenericNumbering(StringIO(request.FILES['pdb_file'].file.read().decode('UTF-8',"ignore")),
+            local_search=True)
         out_struct = generic_numbering.assign_generic_numbers()
         out_stream = StringIO()
         io = PDBIO()
         io.set_structure(out_struct)
         io.save(out_stream)
         if len(out_stream.getvalue()) > 0:
-            request.session['gn_outfile'] = out_stream
-            request.session['gn_outfname'] = request.FILES['pdb_file'].name
+            session_file_put(request.session, 'gn_outfile', (request.FILES['pdb_file'].name, out_stream.getvalue()))
             self.success = True
         else:
             self.input_file = request.FILES['pdb_file'].name
@@ -859,14 +898,18 @@ class GenericNumberingDownload(View):
         if self.kwargs['substructure'] == 'custom':
             return HttpResponseRedirect('/structure/generic_numbering_selection')
 
+        gn_outfile = session_file_get(request.session, 'gn_outfile')
+        if not gn_outfile:
+            return HttpResponseRedirect('/structure/generic_numbering_index')
+        gn_outfname, gn_pdb = gn_outfile
+
         simple_selection = self.request.session.get('selection', False)
         selection = Selection()
         if simple_selection:
             selection.importer(simple_selection)
         out_stream = StringIO()
         io = PDBIO()
-        request.session['gn_outfile'].seek(0)
-        gn_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure(request.session['gn_outfname'], request.session['gn_outfile'])[0]
+        gn_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure(gn_outfname, StringIO(gn_pdb))[0]
 
         if self.kwargs['substructure'] == 'full':
             io.set_structure(gn_struct)
@@ -876,7 +919,7 @@ class GenericNumberingDownload(View):
             io.set_structure(gn_struct)
             io.save(out_stream, GenericNumbersSelector(parsed_selection=SelectionParser(selection)))
 
-        root, ext = os.path.splitext(request.session['gn_outfname'])
+        root, ext = os.path.splitext(gn_outfname)
         response = HttpResponse(content_type="chemical/x-pdb")
         response['Content-Disposition'] = 'attachment; filename="{}_GPCRDB.pdb"'.format(root)
         response.write(out_stream.getvalue())
@@ -1004,9 +1047,9 @@ class SuperpositionWorkflowSelection(AbsSegmentSelection):
             selection.importer(simple_selection)
         
         if 'ref_file' in request.FILES:
-            request.session['ref_file'] = request.FILES['ref_file']
+            session_file_put(request.session, 'ref_file', uploaded_pdb(request.FILES['ref_file']))
         if 'alt_files' in request.FILES:
-            request.session['alt_files'] = request.FILES.getlist('alt_files')
+            session_file_put(request.session, 'alt_files', [uploaded_pdb(f) for f in request.FILES.getlist('alt_files')])
 
         context = super(SuperpositionWorkflowSelection, self).get_context_data(**kwargs)
         context['selection'] = {}
@@ -1081,37 +1124,26 @@ class SuperpositionWorkflowResults(TemplateView):
         if simple_selection:
             selection.importer(simple_selection)
 
-        if 'ref_file' in self.request.session.keys():
-            ref_file = StringIO(self.request.session['ref_file'].file.read().decode('UTF-8'))
+        ref_file = session_file_get(self.request.session, 'ref_file')
+        alt_files = session_file_get(self.request.session, 'alt_files')
+        if ref_file:
+            reference = SuperposedStructure.from_file(*ref_file)
         elif selection.reference != []:
-            ref_file = StringIO(selection.reference[0].item.get_cleaned_pdb())
-        if 'alt_files' in self.request.session.keys():
-            alt_files = [StringIO(alt_file.file.read().decode('UTF-8')) for alt_file in self.request.session['alt_files']]
+            reference = SuperposedStructure.from_item(superposition_file_name(selection.reference[0], '_ref'),
+                selection.reference[0].item)
+        if alt_files:
+            alt_structs = [SuperposedStructure.from_file(*alt_file) for alt_file in alt_files]
         elif selection.targets != []:
-            alt_files = [StringIO(x.item.get_cleaned_pdb()) for x in selection.targets if x.type in ['structure', 'structure_model', 'structure_model_Inactive', 'structure_model_Intermediate', 'structure_model_Active']]
+            alt_structs = [SuperposedStructure.from_item(superposition_file_name(x), x.item) for x in selection.targets
+                if x.type in SUPERPOSITION_ITEM_TYPES]
 
-        superposition = ProteinSuperpose(deepcopy(ref_file),alt_files, selection)
+        superposition = BatchSuperpose(reference, alt_structs, SelectionParser(selection))
         out_structs = superposition.run()
-        if 'alt_files' in self.request.session.keys():
-            alt_file_names = [x.name for x in self.request.session['alt_files']]
-        else:
-            alt_file_names = []
-            for x in selection.targets:
-                if x.type=='structure':
-                    alt_file_names.append('{}_{}.pdb'.format(x.item.protein_conformation.protein.entry_name, x.item.pdb_code.index))
-                elif x.type=='structure_model' or x.type=='structure_model_Inactive' or x.type=='structure_model_Intermediate' or x.type=='structure_model_Active':
-                    alt_file_names.append('Class{}_{}_{}_{}_GPCRdb.pdb'.format(class_tree[x.item.protein.family.slug[:3]], x.item.protein.entry_name, x.item.state.name, x.item.main_template.pdb_code.index))
         if len(out_structs) == 0:
             self.success = False
         elif len(out_structs) >= 1:
-            io = PDBIO()
-            self.request.session['alt_structs'] = {}
-            for alt_struct, alt_file_name in zip(out_structs, alt_file_names):
-                tmp = StringIO()
-                io.set_structure(alt_struct)
-                io.save(tmp)
-                self.request.session['alt_structs'][alt_file_name] = tmp
-
+            # the superposed files are written when they are downloaded, the session only keeps the cache key
+            self.request.session['superposition'] = superposition.save()
             self.success = True
 
         attributes = inspect.getmembers(self, lambda a:not(inspect.isroutine(a)))
@@ -1130,79 +1162,28 @@ class SuperpositionWorkflowDownload(View):
         if self.kwargs['substructure'] == 'select':
             return HttpResponseRedirect('/structure/superposition_workflow_selection')
 
-        io = PDBIO()
+        superposition = BatchSuperpose.load(self.request.session.get('superposition'))
+        if not superposition:
+            return HttpResponseRedirect('/structure/superposition_workflow_index')
+
         out_stream = BytesIO()
         zipf = zipfile.ZipFile(out_stream, 'w')
         simple_selection = self.request.session.get('selection', False)
         selection = Selection()
         if simple_selection:
             selection.importer(simple_selection)
-        self.alt_substructure_mapping = {}
-        #reference
-        if 'ref_file' in request.session.keys():
-            self.request.session['ref_file'].file.seek(0)
-            ref_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(self.request.session['ref_file'].file.read().decode('UTF-8')))[0]
-            gn_assigner = GenericNumbering(structure=ref_struct)
-            gn_assigner.assign_generic_numbers()
-            self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
-            ref_name = self.request.session['ref_file'].name
-        elif selection.reference != []:
-            ref_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', StringIO(selection.reference[0].item.get_cleaned_pdb()))[0]
-            gn_assigner = GenericNumbering(structure=ref_struct)
-            gn_assigner.assign_generic_numbers()
-            self.ref_substructure_mapping = gn_assigner.get_substructure_mapping_dict()
-            if selection.reference[0].type=='structure':
-                ref_name = '{}_{}_ref.pdb'.format(selection.reference[0].item.protein_conformation.protein.entry_name, selection.reference[0].item.pdb_code.index)
-            elif selection.reference[0].type=='structure_model' or selection.reference[0].type=='structure_model_Inactive' or selection.reference[0].type=='structure_model_Intermediate' or selection.reference[0].type=='structure_model_Active':
-                ref_name = 'Class{}_{}_{}_{}_GPCRdb_ref.pdb'.format(class_tree[selection.reference[0].item.protein.family.slug[:3]], selection.reference[0].item.protein.entry_name, 
-                                                                    selection.reference[0].item.state.name, selection.reference[0].item.main_template.pdb_code.index)
-
-        alt_structs = {}
-        for alt_id, st in self.request.session['alt_structs'].items():
-            st.seek(0)
-            alt_structs[alt_id] = PDBParser(PERMISSIVE=True, QUIET=True).get_structure(alt_id, st)[0]
-            gn_assigner = GenericNumbering(structure=alt_structs[alt_id])
-            gn_assigner.assign_generic_numbers()
-            self.alt_substructure_mapping[alt_id] = gn_assigner.get_substructure_mapping_dict()
-
-        if self.kwargs['substructure'] == 'full':
-
-            io.set_structure(ref_struct)
-            tmp = StringIO()
-            io.save(tmp)
-            zipf.writestr(ref_name, tmp.getvalue())
-
-            for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp)
-                zipf.writestr(alt_name, tmp.getvalue())
-
-        elif self.kwargs['substructure'] == 'substr':
-
-            consensus_gn_set = CASelector(SelectionParser(selection), ref_struct, alt_structs.values()).get_consensus_gn_set()
-            io.set_structure(ref_struct)
-            tmp = StringIO()
-            io.save(tmp, GenericNumbersSelector(consensus_gn_set))
-            zipf.writestr(ref_name, tmp.getvalue())
-            for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp, GenericNumbersSelector(consensus_gn_set))
-                zipf.writestr(alt_name, tmp.getvalue())
 
+        keep = None
+        if self.kwargs['substructure'] == 'substr':
+            consensus_gn_set = superposition.consensus_generic_numbers()
+            keep = lambda label, segment: label in consensus_gn_set
         elif self.kwargs['substructure'] == 'custom':
+            parsed_selection = SelectionParser(selection)
+            segments = set(['TM{}'.format(tm) for tm in parsed_selection.helices] + parsed_selection.substructures)
+            keep = lambda label, segment: segment in segments
 
-            io.set_structure(ref_struct)
-            tmp = StringIO()
-            io.save(tmp, SubstructureSelector(self.ref_substructure_mapping, parsed_selection=SelectionParser(selection)))
-            
-            zipf.writestr(ref_name, tmp.getvalue())
-            for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp, SubstructureSelector(self.alt_substructure_mapping[alt_name], parsed_selection=SelectionParser(selection)))
-                zipf.writestr(alt_name, tmp.getvalue())
+        for structure in [superposition.reference] + superposition.structures:
+            zipf.writestr(structure.name, structure.superposed_pdb(keep))
 
         zipf.close()
         if len(out_stream.getvalue()) > 0:
@@ -1211,9 +1192,9 @@ class SuperpositionWorkflowDownload(View):
             response.write(out_stream.getvalue())
 
         if 'ref_file' in request.FILES:
-            request.session['ref_file'] = request.FILES['ref_file']
+            session_file_put(request.session, 'ref_file', uploaded_pdb(request.FILES['ref_file']))
         if 'alt_files' in request.FILES:
-            request.session['alt_files'] = request.FILES.getlist('alt_files')
+            session_file_put(request.session, 'alt_files', [uploaded_pdb(f) for f in request.FILES.getlist('alt_files')])
 
 
         return response
@@ -1332,7 +1313,8 @@ class FragmentSuperpositionResults(TemplateView):
                     zipf.writestr("representative_fragments//{!s}".format(fragment.generate_filename()), tmp.getvalue())
             zipf.close()
             if len(out_stream.getvalue()) > 0:
-                request.session['outfile'] = { 'interacting_moiety_residue_fragments.zip' : out_stream, }
+                session_file_put(request.session, 'outfile', {'interacting_moiety_residue_fragments.zip':
+                    out_stream.getvalue()})
                 self.outfile = 'interacting_moiety_residue_fragments.zip'
                 self.success = True
                 self.zip = 'zip'
@@ -1558,7 +1540,7 @@ class PDBClean(TemplateView):
             simple_selection = selection.exporter()
 
             request.session['selection'] = simple_selection
-            request.session['cleaned_structures'] = out_stream
+            session_file_put(request.session, 'cleaned_structures', out_stream.getvalue())
 
         attributes = inspect.getmembers(self, lambda a:not(inspect.isroutine(a)))
         for a in attributes:
@@ -1650,8 +1632,12 @@ class PDBDownload(View):
         if self.kwargs['substructure'] == 'select':
             return HttpResponseRedirect('/structure/pdb_segment_selection')
 
+        cleaned_structures = session_file_get(request.session, 'cleaned_structures')
+        if cleaned_structures is None:
+            return HttpResponseRedirect('/structure/pdb_download_index')
+
         if self.kwargs['substructure'] == 'full':
-            out_stream = request.session['cleaned_structures']
+            out_stream = BytesIO(cleaned_structures)
 
         elif self.kwargs['substructure'] == 'custom':
             simple_selection = request.session.get('selection', False)
@@ -1659,7 +1645,7 @@ class PDBDownload(View):
             if simple_selection:
                 selection.importer(simple_selection)
             io = PDBIO()
-            zipf_in = zipfile.ZipFile(request.session['cleaned_structures'], 'r')
+            zipf_in = zipfile.ZipFile(BytesIO(cleaned_structures), 'r')
             out_stream = BytesIO()
             zipf_out = zipfile.ZipFile(out_stream, 'w', zipfile.ZIP_DEFLATED)
             for name in zipf_in.namelist():
@@ -1837,20 +1823,24 @@ def SingleModelDownload(request, modelname, state, csv=False):
 def ServePdbOutfile (request, outfile, replacement_tag):
 
     root, ext = os.path.splitext(outfile)
-    out_stream = request.session['outfile'][outfile]
+    outfiles = session_file_get(request.session, 'outfile') or {}
+    if outfile not in outfiles:
+        raise Http404('The file has expired')
     response = HttpResponse(content_type="chemical/x-pdb")
     response['Content-Disposition'] = 'attachment; filename="{}_{}.pdb"'.format(root, replacement_tag)
-    response.write(out_stream.getvalue())
+    response.write(outfiles[outfile])
 
     return response
 
 
 def ServeZipOutfile (request, outfile):
 
-    out_stream = request.session['outfile'][outfile]
+    outfiles = session_file_get(request.session, 'outfile') or {}
+    if outfile not in outfiles:
+        raise Http404('The file has expired')
     response = HttpResponse(content_type="application/zip")
     response['Content-Disposition'] = 'attachment; filename="{}"'.format(outfile)
-    response.write(out_stream.getvalue())
+    response.write(outfiles[outfile])
 
     return response
 